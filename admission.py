@@ -0,0 +1,197 @@
+"""
+Controle de admissão e modo degradado das rotas dos dispositivos.
+
+Com o Postgres lento, cada poll segurava uma thread do gunicorn esperando o
+banco até o worker inteiro travar. Por worker:
+
+- Admissao limita quantas requisições dos dispositivos rodam ao mesmo tempo
+  (DISPOSITIVOS_MAX_SIMULTANEAS); quem não consegue vaga em
+  DISPOSITIVOS_ESPERA_SEG recebe 503 com Retry-After na hora, e as threads
+  que sobram continuam atendendo o painel;
+- SaudeBanco é um disjuntor: BANCO_FALHAS_DEGRADAR erros (ou chamadas mais
+  lentas que BANCO_LENTO_SEG) seguidos põem as rotas em modo degradado por
+  BANCO_PAUSA_SEG; depois uma requisição testa o banco e, se der certo, o
+  modo normal volta;
+- em modo degradado o link atual e a contagem saem do último valor lido
+  (UltimoValor) e os heartbeats ficam em HeartbeatsAdiados até o banco voltar.
+"""
+import os
+import time
+import random
+import threading
+
+from metrics import BANCO_DEGRADADO, HEARTBEATS_ADIADOS, HEARTBEATS_PERDIDOS
+
+DISPOSITIVOS_MAX_SIMULTANEAS = int(os.environ.get('DISPOSITIVOS_MAX_SIMULTANEAS', 4))  # de 8 threads por worker
+DISPOSITIVOS_ESPERA_SEG = float(os.environ.get('DISPOSITIVOS_ESPERA_SEG', 0.05))
+DISPOSITIVOS_RETRY_AFTER_SEG = int(os.environ.get('DISPOSITIVOS_RETRY_AFTER_SEG', 5))
+BANCO_FALHAS_DEGRADAR = int(os.environ.get('BANCO_FALHAS_DEGRADAR', 3))
+BANCO_LENTO_SEG = float(os.environ.get('BANCO_LENTO_SEG', 1.0))
+BANCO_PAUSA_SEG = float(os.environ.get('BANCO_PAUSA_SEG', 10))
+HEARTBEATS_ADIADOS_MAX = int(os.environ.get('HEARTBEATS_ADIADOS_MAX', 10000))
+HEARTBEATS_ADIADOS_FLUSH_SEG = float(os.environ.get('HEARTBEATS_ADIADOS_FLUSH_SEG', 5))
+
+
+class BancoIndisponivel(Exception):
+    """O disjuntor está aberto: a chamada nem foi feita"""
+    pass
+
+
+def retry_after():
+    """Segundos para o header Retry-After, espalhados para os dispositivos não voltarem juntos"""
+    return random.randint(DISPOSITIVOS_RETRY_AFTER_SEG, 2 * DISPOSITIVOS_RETRY_AFTER_SEG)
+
+
+class Admissao:
+    """Semáforo com espera curta: entrar() devolve False se não houver vaga a tempo"""
+
+    def __init__(self, limite, espera_seg):
+        self.limite = limite
+        self._espera = espera_seg
+        self._vagas = threading.BoundedSemaphore(limite)
+        self._lock = threading.Lock()
+        self.em_uso = 0
+
+    def entrar(self):
+        if not self._vagas.acquire(timeout=self._espera):
+            return False
+        with self._lock:
+            self.em_uso += 1
+        return True
+
+    def sair(self):
+        with self._lock:
+            self.em_uso -= 1
+        self._vagas.release()
+
+
+class SaudeBanco:
+    """
+    Disjuntor das chamadas ao banco feitas pelas rotas dos dispositivos.
+    `relogio` devolve segundos monotônicos.
+    """
+
+    def __init__(self, falhas_max, lento_seg, pausa_seg, relogio=time.monotonic):
+        self._falhas_max = falhas_max
+        self._lento = lento_seg
+        self._pausa = pausa_seg
+        self.relogio = relogio
+        self._lock = threading.Lock()
+        self._falhas = 0
+        self._degradado_ate = None  # None = modo normal
+        self._testando = False
+        self.ultimo_erro = None
+
+    @property
+    def degradado(self):
+        return self._degradado_ate is not None
+
+    def _permitir(self):
+        with self._lock:
+            if self._degradado_ate is None:
+                return True
+            # Passada a pausa, só uma requisição por vez testa o banco
+            if self.relogio() >= self._degradado_ate and not self._testando:
+                self._testando = True
+                return True
+            return False
+
+    def _sucesso(self):
+        with self._lock:
+            self._falhas = 0
+            self._testando = False
+            if self._degradado_ate is not None:
+                self._degradado_ate = None
+                BANCO_DEGRADADO.set(0)
+
+    def _falha(self, erro):
+        with self._lock:
+            self._falhas += 1
+            self.ultimo_erro = erro
+            if self._testando or self._falhas >= self._falhas_max:
+                self._degradado_ate = self.relogio() + self._pausa
+                BANCO_DEGRADADO.set(1)
+            self._testando = False
+
+    def executar(self, funcao, *args):
+        """Chama o storage se o disjuntor deixar (senão BancoIndisponivel); erros e lentidão contam como falha"""
+        if not self._permitir():
+            raise BancoIndisponivel(self.ultimo_erro)
+        inicio = self.relogio()
+        try:
+            resultado = funcao(*args)
+        except Exception as e:
+            self._falha(f"{type(e).__name__}: {e}")
+            raise
+        duracao = self.relogio() - inicio
+        if duracao >= self._lento:
+            # O resultado vale, mas o banco está lento demais para seguir mandando os dispositivos para lá
+            self._falha(f"lento: {duracao:.2f}s")
+        else:
+            self._sucesso()
+        return resultado
+
+    def estado(self):
+        with self._lock:
+            return {
+                "degradado": self._degradado_ate is not None,
+                "falhas_seguidas": self._falhas,
+                "proximo_teste_em_seg": (round(max(0.0, self._degradado_ate - self.relogio()), 1)
+                                         if self._degradado_ate is not None else None),
+                "ultimo_erro": self.ultimo_erro
+            }
+
+
+class UltimoValor:
+    """Último valor lido do banco (por worker), servido no modo degradado"""
+
+    def __init__(self):
+        self._valor = None
+        self._lido_em = None
+
+    def guardar(self, valor):
+        self._valor, self._lido_em = valor, time.monotonic()
+
+    def obter(self):
+        """(valor, idade em segundos), ou (None, None) se nunca foi lido"""
+        if self._lido_em is None:
+            return None, None
+        return self._valor, time.monotonic() - self._lido_em
+
+
+class HeartbeatsAdiados:
+    """device_ids que não puderam ser gravados; gravar() manda todos num comando só"""
+
+    def __init__(self, maximo):
+        self._maximo = maximo
+        self._lock = threading.Lock()
+        self._pendentes = set()
+
+    def __len__(self):
+        return len(self._pendentes)
+
+    def adicionar(self, device_id):
+        with self._lock:
+            if device_id not in self._pendentes and len(self._pendentes) >= self._maximo:
+                HEARTBEATS_PERDIDOS.inc()
+                return False
+            self._pendentes.add(device_id)
+            HEARTBEATS_ADIADOS.set(len(self._pendentes))
+            return True
+
+    def gravar(self, saude, storage):
+        """Grava os pendentes pelo disjuntor; se falhar, eles voltam para a próxima tentativa"""
+        with self._lock:
+            if not self._pendentes:
+                return 0
+            lote, self._pendentes = self._pendentes, set()
+        try:
+            saude.executar(storage.registrar_heartbeats, lote)
+        except Exception:
+            with self._lock:
+                self._pendentes |= lote
+                HEARTBEATS_ADIADOS.set(len(self._pendentes))
+            raise
+        with self._lock:
+            HEARTBEATS_ADIADOS.set(len(self._pendentes))
+        return len(lote)
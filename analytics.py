@@ -0,0 +1,120 @@
+"""
+Projeções das metas mensais de todas as músicas.
+
+plays_diarios do mês e musicas_controle são carregados uma vez num DataFrame
+e as métricas saem de operações vetorizadas sobre a matriz músicas x dias,
+sem uma consulta por música. O resultado fica em cache até mudar a
+versão dos plays (storage.versao_plays) ou o dia.
+"""
+import time
+import calendar
+import datetime
+import threading
+
+import numpy as np
+import pandas as pd
+
+JANELA_RITMO_DIAS = 7  # dias completos usados no ritmo diário
+
+
+def projetar_metas(controles, plays, hoje):
+    """
+    controles: linhas de musicas_controle; plays: [{track_id, data, plays}]
+    do mês de `hoje`. Retorna uma linha por música com:
+    - ritmo_diario: média dos últimos JANELA_RITMO_DIAS dias completos do mês
+      (no dia 1, os plays de hoje até agora);
+    - projecao_mes: plays até ontem + hoje (o maior entre o já tocado e o
+      ritmo) + ritmo x dias que faltam;
+    - necessario_por_dia: plays por dia, contando hoje, para chegar à meta;
+    - dias_em_risco: dias completos do mês abaixo do ritmo linear da meta
+      (meta_mensal / dias do mês).
+    """
+    if not controles:
+        return []
+    dias_no_mes = calendar.monthrange(hoje.year, hoje.month)[1]
+    dia = hoje.day
+
+    metas = pd.DataFrame(controles, columns=['track_id', 'nome', 'meta_mensal']).set_index('track_id')
+    dias = pd.DataFrame(plays, columns=['track_id', 'data', 'plays'])
+    # Matriz músicas x dias do mês (0 onde não houve plays)
+    if dias.empty:
+        matriz = np.zeros((len(metas), dias_no_mes), dtype=np.int64)
+    else:
+        dias['dia'] = pd.to_datetime(dias['data']).dt.day
+        matriz = (
+            dias.pivot_table(index='track_id', columns='dia', values='plays', aggfunc='sum', fill_value=0)
+            .reindex(index=metas.index, columns=range(1, dias_no_mes + 1), fill_value=0)
+            .to_numpy(dtype=np.int64)
+        )
+
+    meta = metas['meta_mensal'].fillna(0).to_numpy(dtype=np.int64)
+    completos = matriz[:, :dia - 1]
+    plays_hoje = matriz[:, dia - 1]
+    ate_ontem = completos.sum(axis=1)
+    plays_mes = ate_ontem + plays_hoje
+
+    janela = min(JANELA_RITMO_DIAS, dia - 1)
+    ritmo = completos[:, -janela:].mean(axis=1) if janela else plays_hoje.astype(np.float64)
+    projecao = ate_ontem + np.maximum(plays_hoje, ritmo) + ritmo * (dias_no_mes - dia)
+    necessario = np.maximum(meta - plays_mes, 0) / (dias_no_mes - dia + 1)
+    em_risco_dia = completos < (meta / dias_no_mes)[:, None]
+    dias_em_risco = np.where(meta > 0, em_risco_dia.sum(axis=1), 0)
+    percentual = np.divide(projecao * 100, meta, out=np.zeros_like(projecao, dtype=np.float64), where=meta > 0)
+
+    resultado = pd.DataFrame({
+        'track_id': metas.index,
+        'nome': metas['nome'].to_numpy(),
+        'meta_mensal': meta,
+        'plays_mes': plays_mes,
+        'plays_hoje': plays_hoje,
+        'ritmo_diario': np.round(ritmo, 1),
+        'projecao_mes': np.round(projecao).astype(np.int64),
+        'percentual_projetado': np.round(percentual, 1),
+        'necessario_por_dia': np.ceil(necessario).astype(np.int64),
+        'dias_em_risco': dias_em_risco,
+        'em_risco': (meta > 0) & (projecao < meta),
+    })
+    # Tipos NumPy -> Python para o jsonify
+    return [
+        {chave: (valor.item() if isinstance(valor, np.generic) else valor) for chave, valor in linha.items()}
+        for linha in resultado.to_dict('records')
+    ]
+
+
+class AnaliseMetas:
+    """
+    Cache das projeções. A cada `intervalo_verificacao` segundos no máximo uma
+    consulta leve (storage.versao_plays) confere se houve plays novos; só então
+    os dados do mês são recarregados e as projeções recalculadas.
+    """
+
+    def __init__(self, storage, hoje, intervalo_verificacao):
+        self._storage = storage
+        self._hoje = hoje
+        self._intervalo = intervalo_verificacao
+        self._lock = threading.Lock()
+        self._chave = None
+        self._resultado = None
+        self._verificado_em = 0.0
+
+    def obter(self):
+        with self._lock:
+            agora = time.monotonic()
+            if self._resultado is not None and agora - self._verificado_em < self._intervalo:
+                return self._resultado
+            hoje = self._hoje()
+            inicio_mes = hoje.replace(day=1)
+            chave = (hoje, self._storage.versao_plays(inicio_mes))
+            if chave != self._chave:
+                self._resultado = {
+                    "mes": hoje.strftime('%Y-%m'),
+                    "dia": hoje.day,
+                    "dias_no_mes": calendar.monthrange(hoje.year, hoje.month)[1],
+                    "calculado_em": datetime.datetime.now().isoformat(timespec='seconds'),
+                    "musicas": projetar_metas(
+                        self._storage.listar_controles(), self._storage.plays_por_dia(inicio_mes), hoje
+                    )
+                }
+                self._chave = chave
+            self._verificado_em = time.monotonic()
+            return self._resultado
@@ -1,28 +1,55 @@
 import os
-import math
-import psycopg2
-from psycopg2.extras import RealDictCursor
+import json
+import base64
+import itertools
 import datetime # Importando modulo inteiro para evitar conflitos
 import decimal
-from flask import Flask, render_template, request, redirect, url_for, jsonify
+import functools
+from flask import Flask, render_template, request, redirect, url_for, jsonify, stream_with_context
 from flask_cors import CORS
 import threading
 import time
 import requests
-import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 import pandas as pd
 import logging
+import uuid
+import sql_profiler
+import logs
+import tracing
+from storage import criar_storage, chave_pagina, ORDENACOES, EXPORTACOES, STATUS_PENDENTE, STATUS_EXECUCAO, STATUS_FILA
+from config import ConfigService, CONFIG_SCHEMA
+from motor import Motor, FOLGA_CICLO_SEG, DEVICE_TIMEOUT_SECONDS, dica_polling
+from dashboard import SnapshotPainel
+from admission import (
+    Admissao, SaudeBanco, UltimoValor, HeartbeatsAdiados, BancoIndisponivel, retry_after,
+    DISPOSITIVOS_MAX_SIMULTANEAS, DISPOSITIVOS_ESPERA_SEG, BANCO_FALHAS_DEGRADAR, BANCO_LENTO_SEG,
+    BANCO_PAUSA_SEG, HEARTBEATS_ADIADOS_MAX, HEARTBEATS_ADIADOS_FLUSH_SEG
+)
+import export
+from analytics import AnaliseMetas
+from spotify_client import (
+    AgendadorSpotify, CacheTokenArquivo, SpotifyLimitado, SPOTIFY_TOKEN_CACHE, criar_cliente as criar_cliente_spotify
+)
+from metrics import (
+    instrumentar, registrar_requisicao, gerar_metricas,
+    MOTOR_CICLO, MOTOR_ATRASO, MOTOR_ERROS, HEARTBEATS, DISPOSITIVOS_REJEITADAS, DISPOSITIVOS_DEGRADADAS
+)
 
-# Configuração de logs
-logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+# Configuração de logs (JSON, escritos por uma thread em segundo plano; veja logs.py)
+logs.configurar()
+log = logging.getLogger('loop.app')
+log_motor = logging.getLogger('loop.motor')
+log_http = logging.getLogger('loop.http')
+log_dispositivos = logging.getLogger('loop.dispositivos')  # polls e heartbeats: amostrado
 
 # --- CONFIGURAÇÃO ---
 app = Flask(__name__, template_folder='templates')
 CORS(app)  # Permite requisições do Flutter
 
-# Configuração do banco de dados
+# Configuração do banco de dados (STORAGE_BACKEND=memory roda sem Postgres)
 DATABASE_URL = os.environ.get('DATABASE_URL', 'postgresql://localhost/loop_playlist')
+storage = instrumentar(criar_storage(dsn=DATABASE_URL))
 
 # Configuração de Threads
 # Garante que apenas uma thread de automação rode por vez (mesmo com workers)
@@ -33,31 +60,52 @@ SPOTIPY_CLIENT_ID = os.environ.get("SPOTIPY_CLIENT_ID", "24ec1e4013d948ba87c2e85
 SPOTIPY_CLIENT_SECRET = os.environ.get("SPOTIPY_CLIENT_SECRET", "4d57f99be4834ed682684e607aeb3337")
 
 try:
-    sp = spotipy.Spotify(auth_manager=SpotifyClientCredentials(
+    # Token compartilhado entre os workers; retentativas ficam por conta do AgendadorSpotify
+    sp = criar_cliente_spotify(SpotifyClientCredentials(
         client_id=SPOTIPY_CLIENT_ID,
-        client_secret=SPOTIPY_CLIENT_SECRET
+        client_secret=SPOTIPY_CLIENT_SECRET,
+        cache_handler=CacheTokenArquivo(SPOTIFY_TOKEN_CACHE)
     ))
+    agendador_spotify = AgendadorSpotify(sp)
 except Exception as e:
-    print(f"Erro ao configurar Spotify: {e}")
+    log.error(f"Erro ao configurar Spotify: {e}")
     sp = None
 
-# Variável global para o link atual (atualizada pelo motor)
-current_link_data = {
-    "link": "",
-    "duracao_min": 3.0,
-    "nome": "",
-    "timestamp": 0
-}
-
 # Configurações globais
-DEVICE_TIMEOUT_SECONDS = 300 # 5 minutos
+ARQUIVAMENTO_INTERVALO_SEG = int(os.environ.get('ARQUIVAMENTO_INTERVALO_SEG', 60))
+HISTORICO_LIMITE_MAX = 200
+HISTORICO_LOTE_MAX_TRACKS = 100
+HISTORICO_LOTE_MAX_DIAS = 366
+HISTORICO_LOTE_DIAS_PADRAO = 30
+IDEMPOTENCIA_VALIDADE_SEG = 24 * 3600
+LOTE_MAX_IDS = 1000  # ids por requisição nas operações em lote
+
+# Listagens paginadas (/api/all_songs, /api/playlists, /get_data)
+PAGINA_LIMITE_PADRAO = 50
+PAGINA_LIMITE_MAX = 1000
+PAGINA_STREAM_MIN = 200  # a partir daqui a página é enviada em streaming, linha a linha
+PARAMETROS_PAGINA = ('limit', 'cursor', 'sort', 'order', 'status', 'track_id', 'q')
+STATUS_ATIVOS = [STATUS_PENDENTE, STATUS_EXECUCAO]
+
+# Exportação: linhas por lote (cursor do servidor) e exportações simultâneas por worker
+EXPORTACAO_LOTE = int(os.environ.get('EXPORTACAO_LOTE', 5000))
+EXPORTACAO_MAX_SIMULTANEAS = int(os.environ.get('EXPORTACAO_MAX_SIMULTANEAS', 2))
+exportacoes_livres = threading.BoundedSemaphore(EXPORTACAO_MAX_SIMULTANEAS)
+
+# Intervalo máximo entre verificações de plays novos para as projeções de metas
+ANALISE_VERIFICACAO_SEG = float(os.environ.get('ANALISE_VERIFICACAO_SEG', 30))
 
-config = {
-    "quantidade_aparelhos": 200,
-    "reset_automatico": 1
-}
+# Intervalo de recálculo do snapshot do painel (um cálculo por intervalo no cluster todo)
+PAINEL_INTERVALO_SEG = float(os.environ.get('PAINEL_INTERVALO_SEG', 5))
+
+# Intervalo máximo entre verificações da versão da config no banco
+CONFIG_REFRESH_SEG = float(os.environ.get('CONFIG_REFRESH_SEG', 10))
 
 # --- FUNÇÕES AUXILIARES ---
+def spotify(metodo, *args, **kwargs):
+    """Chama um método do cliente spotipy pelo agendador (limite de taxa, retentativas, métricas)"""
+    return agendador_spotify.chamar(metodo, *args, **kwargs)
+
 def get_id_from_url(url):
     """Extrai apenas o ID do link do Spotify"""
     try:
@@ -65,242 +113,53 @@ def get_id_from_url(url):
     except:
         return ""
 
-# --- FUNÇÕES DO BANCO DE DADOS ---
-def get_db_connection():
-    """Cria conexão com o PostgreSQL"""
-    conn = psycopg2.connect(DATABASE_URL, cursor_factory=RealDictCursor)
-    return conn
+def leitura_replica(rota):
+    """Rota só de leitura que tolera dados alguns segundos atrasados: consultas podem ir para a réplica"""
+    @functools.wraps(rota)
+    def envolvida(*args, **kwargs):
+        with storage.replica():
+            return rota(*args, **kwargs)
+    return envolvida
 
-def init_db():
-    """Inicializa as tabelas do banco de dados"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Tabela de músicas/playlist (Versão Base)
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS playlist (
-            id SERIAL PRIMARY KEY,
-            link_musica TEXT NOT NULL,
-            nome_musica TEXT NOT NULL,
-            plays_desejados INTEGER DEFAULT 0,
-            plays_atuais INTEGER DEFAULT 0,
-            plays_mensais INTEGER DEFAULT 0,
-            status TEXT DEFAULT 'Pendente',
-            duracao_min REAL DEFAULT 3.0,
-            data_adicao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Migração: Adicionar novos campos na tabela playlist
-    new_columns = [
-        ("track_id", "TEXT"),
-        ("playlist_id", "TEXT"),
-        ("plays_hoje", "INTEGER DEFAULT 0"),
-        ("data_ultimo_play", "DATE DEFAULT CURRENT_DATE")
-    ]
-    
-    for col_name, col_type in new_columns:
+def altera_fila(rota):
+    """Rota que escreve na fila: o snapshot do painel é recalculado e gravado para o cluster todo"""
+    @functools.wraps(rota)
+    def envolvida(*args, **kwargs):
         try:
-            cur.execute(f'ALTER TABLE playlist ADD COLUMN IF NOT EXISTS {col_name} {col_type}')
-        except Exception as e:
-            # Fallback para versões antigas do Postgres
-            conn.rollback()
-            try:
-                cur.execute(f'ALTER TABLE playlist ADD COLUMN {col_name} {col_type}')
-            except:
-                conn.rollback()
-    
-    # Nova Tabela: playlists (para gerenciamento)
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS playlists (
-            id SERIAL PRIMARY KEY,
-            url TEXT NOT NULL,
-            nome TEXT,
-            data_adicao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Nova Tabela: musicas_controle (meta mensal)
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS musicas_controle (
-            id SERIAL PRIMARY KEY,
-            track_id TEXT UNIQUE NOT NULL,
-            nome TEXT,
-            meta_mensal INTEGER DEFAULT 0,
-            plays_diarios INTEGER DEFAULT 0,
-            mes_atual TEXT,
-            plays_mes_atual INTEGER DEFAULT 0
-        )
-    ''')
-    
-    # Tabela de configuração
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS config (
-            id SERIAL PRIMARY KEY,
-            chave TEXT UNIQUE NOT NULL,
-            valor TEXT NOT NULL
-        )
-    ''')
-    
-    # Tabela de dispositivos conectados (heartbeat)
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS devices (
-            id SERIAL PRIMARY KEY,
-            device_id TEXT UNIQUE NOT NULL,
-            last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-    
-    # Nova Tabela: plays_diarios (histórico de plays por dia)
-    cur.execute('''
-        CREATE TABLE IF NOT EXISTS plays_diarios (
-            id SERIAL PRIMARY KEY,
-            track_id TEXT NOT NULL,
-            data DATE NOT NULL,
-            plays INTEGER DEFAULT 0,
-            UNIQUE(track_id, data)
-        )
-    ''')
-    
-    # Inserir configuração padrão se não existir
-    default_configs = [
-        ('quantidade_aparelhos', '200'),
-        ('reset_automatico', '1') # 1 = Sim, 0 = Não
-    ]
-    
-    for chave, valor in default_configs:
-        cur.execute('''
-            INSERT INTO config (chave, valor) VALUES (%s, %s)
-            ON CONFLICT (chave) DO NOTHING
-        ''', (chave, valor))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-    print("✅ Banco de dados inicializado com sucesso!")
-
-def carregar_playlist():
-    """Carrega todas as músicas do banco"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM playlist ORDER BY id')
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return [dict(row) for row in rows]
-
-def salvar_musica(link, nome, plays_desejados, duracao_min):
-    """Adiciona uma nova música"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO playlist (link_musica, nome_musica, plays_desejados, duracao_min, status)
-        VALUES (%s, %s, %s, %s, 'Pendente')
-    ''', (link, nome, plays_desejados, duracao_min))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def atualizar_musica(id, plays_atuais, plays_mensais, status):
-    """Atualiza uma música existente"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        UPDATE playlist SET plays_atuais = %s, plays_mensais = %s, status = %s
-        WHERE id = %s
-    ''', (plays_atuais, plays_mensais, status, id))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def deletar_musica(id):
-    """Remove uma música"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('DELETE FROM playlist WHERE id = %s', (id,))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def carregar_config():
-    """Carrega configurações do banco"""
-    global config
-    try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('SELECT chave, valor FROM config')
-        rows = cur.fetchall()
-        for row in rows:
-            config[row['chave']] = int(row['valor']) if row['valor'].isdigit() else row['valor']
-        cur.close()
-        conn.close()
-    except:
-        pass
-
-def salvar_config_db(chave, valor):
-    """Salva uma configuração no banco"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO config (chave, valor) VALUES (%s, %s)
-        ON CONFLICT (chave) DO UPDATE SET valor = %s
-    ''', (chave, str(valor), str(valor)))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def registrar_heartbeat(device_id):
-    """Registra que um dispositivo está ativo"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO devices (device_id, last_seen) VALUES (%s, CURRENT_TIMESTAMP)
-        ON CONFLICT (device_id) DO UPDATE SET last_seen = CURRENT_TIMESTAMP
-    ''', (device_id,))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def contar_dispositivos_ativos():
-    """Conta dispositivos que fizeram heartbeat nos últimos 5 minutos"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute(f'''
-        SELECT COUNT(*) as count FROM devices 
-        WHERE last_seen > NOW() - INTERVAL '{DEVICE_TIMEOUT_SECONDS} seconds'
-    ''')
-    result = cur.fetchone()
-    cur.close()
-    conn.close()
-    return result['count'] if result else 0
-
-def get_playlists_db():
-    """Retorna todas as playlists cadastradas"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('SELECT * FROM playlists ORDER BY id')
-    rows = cur.fetchall()
-    cur.close()
-    conn.close()
-    return [dict(row) for row in rows]
-
-def adicionar_playlist_db(url, nome):
-    """Adiciona uma nova playlist"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('INSERT INTO playlists (url, nome) VALUES (%s, %s)', (url, nome))
-    conn.commit()
-    cur.close()
-    conn.close()
-
-def remover_playlist_db(id):
-    """Remove uma playlist pelo ID"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('DELETE FROM playlists WHERE id = %s', (id,))
-    conn.commit()
-    cur.close()
-    conn.close()
+            return rota(*args, **kwargs)
+        finally:
+            painel.invalidar()
+    return envolvida
+
+def resposta_indisponivel():
+    """503 com Retry-After para os dispositivos tentarem de novo mais tarde"""
+    DISPOSITIVOS_REJEITADAS.labels(request.url_rule.rule).inc()
+    espera = retry_after()
+    return jsonify({"error": "Servidor ocupado, tente novamente", "retry_after": espera}), 503, {'Retry-After': str(espera)}
+
+def admitir_dispositivo(rota):
+    """Rota dos dispositivos: no máximo DISPOSITIVOS_MAX_SIMULTANEAS por worker, senão 503 na hora"""
+    @functools.wraps(rota)
+    def envolvida(*args, **kwargs):
+        if not admissao_dispositivos.entrar():
+            return resposta_indisponivel()
+        try:
+            return rota(*args, **kwargs)
+        finally:
+            admissao_dispositivos.sair()
+    return envolvida
+
+# Estado por worker das rotas dos dispositivos (veja admission.py)
+admissao_dispositivos = Admissao(DISPOSITIVOS_MAX_SIMULTANEAS, DISPOSITIVOS_ESPERA_SEG)
+saude_banco = SaudeBanco(BANCO_FALHAS_DEGRADAR, BANCO_LENTO_SEG, BANCO_PAUSA_SEG)
+ultimo_link = UltimoValor()
+ultima_contagem = UltimoValor()
+heartbeats_adiados = HeartbeatsAdiados(HEARTBEATS_ADIADOS_MAX)
+
+config_service = ConfigService(storage, CONFIG_SCHEMA, CONFIG_REFRESH_SEG)
+motor = Motor(storage, config_service, DEVICE_TIMEOUT_SECONDS)
+# Mesmo dia do CURRENT_DATE gravado em plays_diarios (banco em UTC)
+analise_metas = AnaliseMetas(storage, lambda: motor.relogio().date(), ANALISE_VERIFICACAO_SEG)
 
 # --- LÓGICA DE NEGÓCIO ---
 
@@ -318,25 +177,25 @@ def validar_musica_playlists(link_musica, plays_desejados_dia, meta_mensal, dura
         
     # Busca informações da música
     try:
-        track_info = sp.track(track_id)
+        track_info = spotify('track', track_id)
         nome_musica = track_info['name']
         
         # Se usuário definiu duração manual, usa ela
         if duracao_manual and float(duracao_manual) > 0.0:
             duracao_min = float(duracao_manual)
-            print(f"⏱️ Usando duração manual: {duracao_min} min")
+            log.info(f"⏱️ Usando duração manual: {duracao_min} min")
         else:
             duracao_min = round(track_info['duration_ms'] / 60000, 1)
             
         # Artista - Nome
         artistas = ", ".join([artist['name'] for artist in track_info['artists']])
         nome_completo = f"{artistas} - {nome_musica}"
-        print(f"🎵 Validando: {nome_completo}")
+        log.info(f"🎵 Validando: {nome_completo}")
     except Exception as e:
         return {"error": f"Erro ao buscar música no Spotify: {e}"}
 
     # Busca todas as playlists cadastradas
-    playlists = get_playlists_db()
+    playlists = storage.listar_playlists()
     
     encontrados = []
     
@@ -352,7 +211,7 @@ def validar_musica_playlists(link_musica, plays_desejados_dia, meta_mensal, dura
             offset = 0
             found = False
             while True:
-                response = sp.playlist_tracks(pl_id, fields="items(track(id)),next", limit=100, offset=offset)
+                response = spotify('playlist_tracks', pl_id, fields="items(track(id)),next", limit=100, offset=offset)
                 for item in response['items']:
                     if item['track'] and item['track']['id'] == track_id:
                          # Link com contexto da playlist
@@ -369,8 +228,11 @@ def validar_musica_playlists(link_musica, plays_desejados_dia, meta_mensal, dura
                     break
                 offset += 100
                 
+        except SpotifyLimitado as e:
+            # Sem isso a playlist seria pulada e a música cadastrada só nas demais
+            return {"error": str(e)}
         except Exception as e:
-            print(f"Erro ao verificar playlist {pl['url']}: {e}")
+            log.error(f"Erro ao verificar playlist {pl['url']}: {e}")
             continue
 
     if not encontrados:
@@ -402,280 +264,212 @@ def validar_musica_playlists(link_musica, plays_desejados_dia, meta_mensal, dura
         
     return resultado
 
-def salvar_validacao(resultado):
-    """Salva o resultado da validação no banco"""
-    musica = resultado['musica']
-    
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # 1. Salva/Atualiza o controle da música (meta mensal)
-    cur.execute('''
-        INSERT INTO musicas_controle (track_id, nome, meta_mensal, plays_diarios, mes_atual)
-        VALUES (%s, %s, %s, %s, TO_CHAR(CURRENT_DATE, 'YYYY-MM'))
-        ON CONFLICT (track_id) DO UPDATE SET 
-            meta_mensal = %s,
-            plays_diarios = %s,
-            nome = %s
-    ''', (musica['track_id'], musica['nome'], musica['meta_mensal'], 
-          len(resultado['entradas']) * resultado['entradas'][0]['plays_desejados'], # Total diário estimado
-          musica['meta_mensal'], 
-          len(resultado['entradas']) * resultado['entradas'][0]['plays_desejados'],
-          musica['nome']))
-    
-    # 2. Adiciona as entradas na fila de execução
-    for entrada in resultado['entradas']:
-        cur.execute('''
-            INSERT INTO playlist (link_musica, nome_musica, plays_desejados, duracao_min, status, track_id, playlist_id)
-            VALUES (%s, %s, %s, %s, 'Pendente', %s, %s)
-        ''', (entrada['link_musica'], entrada['nome_musica'], entrada['plays_desejados'], 
-              entrada['duracao_min'], entrada['track_id'], entrada['playlist_id']))
-              
-    conn.commit()
-    cur.close()
-    conn.close()
-
-
 # --- MOTOR DE AUTOMAÇÃO ---
 
-def executar_reset_diario():
-    """Executa o reset diário dos plays"""
-    print(f"[{time.strftime('%H:%M:%S')}] 🔄 Executando reset diário...")
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Resetar plays_hoje de todas as músicas
-    cur.execute("UPDATE playlist SET plays_hoje = 0")
-    
-    # Reativar músicas que não atingiram a meta mensal
-    # 1. Busca metas
-    cur.execute("SELECT track_id, meta_mensal, plays_mes_atual FROM musicas_controle")
-    metas = cur.fetchall()
-    
-    reativadas = 0
-    for m in metas:
-        if m['plays_mes_atual'] < m['meta_mensal']:
-            # Reseta plays_atuais e status para Pendente
-            cur.execute('''
-                UPDATE playlist 
-                SET plays_atuais = 0, status = 'Pendente' 
-                WHERE track_id = %s
-            ''', (m['track_id'],))
-            reativadas += 1
-            
-    # Atualiza data do último reset
-    hoje_str = datetime.datetime.now().strftime('%Y-%m-%d')
-    cur.execute('''
-        INSERT INTO config (chave, valor) VALUES ('last_reset_date', %s)
-        ON CONFLICT (chave) DO UPDATE SET valor = %s
-    ''', (hoje_str, hoje_str))
-    
-    conn.commit()
-    cur.close()
-    conn.close()
-    print(f"✅ Reset concluído! {reativadas} músicas reativadas para o novo dia.")
+def motor_arquivamento():
+    """Loop em segundo plano que mantém a fila quente pequena"""
+    while True:
+        time.sleep(ARQUIVAMENTO_INTERVALO_SEG)
+        try:
+            arquivadas = storage.arquivar_concluidas()
+            if arquivadas:
+                log.info(f"📦 {arquivadas} entradas concluídas arquivadas.")
+        except Exception as e:
+            log.error(f"Erro no arquivamento: {e}")
+
+def motor_heartbeats_adiados():
+    """Loop em segundo plano que grava os heartbeats adiados quando o banco volta"""
+    while True:
+        time.sleep(HEARTBEATS_ADIADOS_FLUSH_SEG)
+        try:
+            gravados = heartbeats_adiados.gravar(saude_banco, storage)
+            if gravados:
+                log_dispositivos.info(f"💓 {gravados} heartbeats adiados gravados.")
+        except BancoIndisponivel:
+            pass
+        except Exception as e:
+            log.warning(f"⚠️ Heartbeats adiados continuam pendentes: {e}")
 
 def motor_automacao():
     """Loop principal que processa a playlist"""
-    global current_link_data
-    print(">>> Motor de automação iniciado. <<<")
+    log_motor.info(">>> Motor de automação iniciado. <<<")
     
-    # Aguarda o banco estar pronto
-    time.sleep(5)
+    # Retoma o ciclo interrompido por um reinício: espera só o que falta dele
+    try:
+        espera = motor.retomar()
+    except Exception as e:
+        log_motor.error(f"Erro ao retomar o ciclo do motor: {e}")
+        espera = 0
+    inicio_previsto = time.monotonic() + espera
+    time.sleep(espera)
     
     while True:
+        inicio_ciclo = time.monotonic()
+        if inicio_previsto is not None:
+            MOTOR_ATRASO.observe(max(0.0, inicio_ciclo - inicio_previsto))
+        
         try:
-            carregar_config()
-            
-            # 1. VERIFICAÇÃO DE DISPOSITIVOS ONLINE
-            dispositivos_online = contar_dispositivos_ativos()
-            
-            # Se não há dispositivos, pausa o sistema
-            if dispositivos_online == 0:
-                print(f"[{time.strftime('%H:%M:%S')}] 💤 Sem dispositivos online. Aguardando...")
-                current_link_data = {
-                    "link": "",
-                    "duracao_min": 3.0,
-                    "nome": "",
-                    "timestamp": 0
-                }
-                time.sleep(30)
-                continue
-                
-            # 2. PROCESSO DE RESET DIÁRIO (21h)
-            try:
-                # Usando namespace explicito datetime.datetime e datetime.timedelta
-                agora = datetime.datetime.utcnow() - datetime.timedelta(hours=3) # Horário de Brasília
-                hoje_str = agora.strftime('%Y-%m-%d')
-                
-                # Verifica se já resetou hoje
-                last_reset = config.get('last_reset_date', '')
-                
-                # Reseta se for >= 21h e ainda não tiver resetado hoje
-                if agora.hour >= 21 and last_reset != hoje_str and config.get('reset_automatico', 1) == 1:
-                    executar_reset_diario()
-                    carregar_config() # Recarrega config
-            except Exception as e:
-                print(f"Erro no reset diário: {e}")
-
-            # 3. PROCESSAMENTO DA FILA
-            playlist = carregar_playlist()
-            
-            # Encontra a primeira música pendente ou em execução
-            musica_atual = None
-            for m in playlist:
-                if m['status'] in ['Em Execução', 'Pendente']:
-                    musica_atual = m
-                    break
-            
-            if musica_atual:
-                musica_id = musica_atual['id']
-                
-                # Se está Pendente, marca como Em Execução
-                if musica_atual['status'] == 'Pendente':
-                    atualizar_musica(
-                        musica_id,
-                        musica_atual['plays_atuais'],
-                        musica_atual['plays_mensais'],
-                        'Em Execução'
-                    )
-                
-                # Verifica se ainda precisa tocar mais vezes
-                if musica_atual['plays_atuais'] < musica_atual['plays_desejados']:
-                    duracao = musica_atual['duracao_min']
-                    intervalo_ciclo_seg = (duracao * 60) + 10
-                    
-                    # Atualiza o link atual para os dispositivos
-                    current_link_data = {
-                        "link": musica_atual['link_musica'],
-                        "duracao_min": duracao,
-                        "nome": musica_atual['nome_musica'],
-                        "timestamp": int(time.time() + musica_atual['plays_atuais']) # Garante timestamp único por play
-                    }
-                    
-                    # Usa dispositivos online (já verificado > 0)
-                    if dispositivos_online == 0: dispositivos_online = 1
-                    
-                    print(f"[{time.strftime('%H:%M:%S')}] Enviando '{musica_atual['nome_musica']}' | "
-                          f"Dispositivos: {dispositivos_online} | "
-                          f"Progresso: {musica_atual['plays_atuais'] + dispositivos_online}/{musica_atual['plays_desejados']}")
-                    
-                    # Calcula plays a somar baseado em dispositivos online
-                    plays_a_somar = min(
-                        dispositivos_online,
-                        musica_atual['plays_desejados'] - musica_atual['plays_atuais']
-                    )
-                    
-                    # Atualiza os plays no banco (Plays Atuais, Plays Mensais, Plays Hoje)
-                    # Preciso atualizar plays_hoje e plays_mes_atual na tabela de controle também
-                    conn = get_db_connection()
-                    cur = conn.cursor()
-                    
-                    # Atualiza playlist
-                    cur.execute('''
-                        UPDATE playlist SET 
-                            plays_atuais = plays_atuais + %s, 
-                            plays_mensais = plays_mensais + %s,
-                            plays_hoje = plays_hoje + %s,
-                            data_ultimo_play = CURRENT_DATE,
-                            status = 'Em Execução'
-                        WHERE id = %s
-                    ''', (plays_a_somar, plays_a_somar, plays_a_somar, musica_id))
-                    
-                    # Atualiza controle (Meta Mensal)
-                    if musica_atual.get('track_id'):
-                        cur.execute('''
-                            UPDATE musicas_controle SET plays_mes_atual = plays_mes_atual + %s
-                            WHERE track_id = %s
-                        ''', (plays_a_somar, musica_atual['track_id']))
-                        
-                        # Registra histórico diário para gráficos
-                        cur.execute('''
-                            INSERT INTO plays_diarios (track_id, data, plays)
-                            VALUES (%s, CURRENT_DATE, %s)
-                            ON CONFLICT (track_id, data) 
-                            DO UPDATE SET plays = plays_diarios.plays + %s
-                        ''', (musica_atual['track_id'], plays_a_somar, plays_a_somar))
-                        
-                    conn.commit()
-                    cur.close()
-                    conn.close()
-                    
-                    # Aguarda o tempo do ciclo
-                    time.sleep(intervalo_ciclo_seg)
-                else:
-                    # Concluiu todos os plays DO DIA/LOTE
-                    atualizar_musica(
-                        musica_id,
-                        musica_atual['plays_atuais'],
-                        musica_atual['plays_mensais'],
-                        'Concluído'
-                    )
-                    time.sleep(1)
-            else:
-                # Não há músicas na fila
-                # Verifica reset manual ou automático aqui também se necessário
-                time.sleep(30)
-                
+            espera = motor.passo()
         except Exception as e:
-            print(f"ERRO NO MOTOR: {e}")
-            time.sleep(15)
+            log_motor.error(f"ERRO NO MOTOR: {e}", exc_info=True)
+            MOTOR_ERROS.inc()
+            espera = 15
+        
+        MOTOR_CICLO.observe(time.monotonic() - inicio_ciclo)
+        inicio_previsto = time.monotonic() + espera
+        time.sleep(espera)
+
+# --- MÉTRICAS ---
+# Rotas chamadas pelos dispositivos a cada poucos segundos: log amostrado
+ROTAS_DISPOSITIVOS = {'/api/current_link', '/api/heartbeat', '/api/devices_count'}
+
+@app.before_request
+def iniciar_medicao():
+    request.inicio_medicao = time.perf_counter()
+    # Aceita o id de um proxy/cliente (X-Request-ID) ou gera um
+    request.request_id = (request.headers.get('X-Request-ID') or uuid.uuid4().hex)[:64]
+    request.token_log = logs.definir_request_id(request.request_id)
+    # Trace amostrado (X-Trace: 1 força); rotas dos dispositivos com taxa própria, bem menor
+    rota = request.url_rule.rule if request.url_rule else 'desconhecida'
+    request.token_trace = tracing.iniciar(
+        f"{request.method} {rota}", request.request_id,
+        tracing.TRACE_TAXA_DISPOSITIVOS if rota in ROTAS_DISPOSITIVOS else tracing.TRACE_TAXA,
+        request.headers.get('X-Trace') == '1'
+    )
+
+@app.after_request
+def finalizar_medicao(response):
+    inicio = getattr(request, 'inicio_medicao', None)
+    if inicio is not None:
+        # Usa o padrão da rota (ex: /delete/<int:id>) para manter a cardinalidade baixa
+        rota = request.url_rule.rule if request.url_rule else 'desconhecida'
+        duracao = time.perf_counter() - inicio
+        registrar_requisicao(rota, request.method, response.status_code, duracao)
+        (log_dispositivos if rota in ROTAS_DISPOSITIVOS else log_http).info(
+            f"{request.method} {rota} {response.status_code}",
+            extra={'campos': {
+                "metodo": request.method, "rota": rota, "status": response.status_code,
+                "duracao_ms": round(duracao * 1000, 2)
+            }}
+        )
+        response.headers['X-Request-ID'] = request.request_id
+    token = getattr(request, 'token_trace', None)
+    if token is not None:
+        request.token_trace = None
+        trace = tracing.finalizar(token)
+        if trace is not None:
+            response.headers['Server-Timing'] = tracing.server_timing(trace)
+    return response
+
+@app.teardown_request
+def limpar_contexto_log(erro=None):
+    token = getattr(request, 'token_trace', None)
+    if token is not None:
+        tracing.finalizar(token)
+    token = getattr(request, 'token_log', None)
+    if token is not None:
+        logs.limpar_request_id(token)
+
+@app.route('/metrics')
+def api_metrics():
+    """Métricas no formato texto do Prometheus (agregadas entre os workers)"""
+    corpo, content_type = gerar_metricas()
+    return corpo, 200, {'Content-Type': content_type}
 
 # --- API ENDPOINTS PARA O FLUTTER ---
+def registrar_heartbeat_dispositivo(device_id):
+    """Grava o heartbeat; com o banco indisponível ele fica para depois. Devolve 'gravado', 'adiado' ou 'perdido'"""
+    HEARTBEATS.inc()
+    try:
+        saude_banco.executar(storage.registrar_heartbeat, device_id)
+        return 'gravado'
+    except Exception:
+        return 'adiado' if heartbeats_adiados.adicionar(device_id) else 'perdido'
+
 @app.route('/api/current_link')
+@admitir_dispositivo
 def api_current_link():
     """Retorna o link atual para os dispositivos Flutter - busca direto do banco"""
     device_id = request.args.get('device_id', 'unknown')
     
     # Registra heartbeat do dispositivo
-    try:
-        registrar_heartbeat(device_id)
-    except:
-        pass
+    registrar_heartbeat_dispositivo(device_id)
     
     # Busca a música em execução diretamente do banco (resolve problema de workers)
+    degradado = False
     try:
-        playlist = carregar_playlist()
-        for m in playlist:
-            if m['status'] == 'Em Execução':
-                # Timestamp usando time.time() para sempre aumentar
-                # O app Flutter vai comparar o LINK, não o timestamp
-                # Timestamp só indica que o servidor está respondendo
-                unique_timestamp = int(time.time())
-                
-                return jsonify({
-                    "link": m['link_musica'],
-                    "duracao_min": float(m['duracao_min']),
-                    "nome": m['nome_musica'],
-                    "timestamp": unique_timestamp
-                })
+        m = saude_banco.executar(storage.musica_em_execucao)
+        ultimo_link.guardar(m)
     except Exception as e:
-        print(f"Erro ao buscar link: {e}")
+        if not isinstance(e, BancoIndisponivel):
+            log.error(f"Erro ao buscar link: {e}")
+        # Modo degradado: o último link que este worker leu do banco
+        m, idade = ultimo_link.obter()
+        if idade is None:
+            return resposta_indisponivel()
+        DISPOSITIVOS_DEGRADADAS.labels('/api/current_link').inc()
+        degradado = True
     
-    # Se não tem música em execução, retorna vazio
-    return jsonify({
-        "link": "",
-        "duracao_min": 3.0,
-        "nome": "",
-        "timestamp": 0
-    })
+    if m:
+        # Timestamp usando time.time() para sempre aumentar
+        # O app Flutter vai comparar o LINK, não o timestamp
+        # Timestamp só indica que o servidor está respondendo
+        unique_timestamp = int(time.time())
+        # O link não muda antes do próximo ciclo do motor: o dispositivo pode esperar até lá
+        proxima_troca, poll_apos = dica_polling(m.get('proxima_troca'), time.time())
+        resposta = {
+            "link": m['link_musica'],
+            "duracao_min": float(m['duracao_min']),
+            "nome": m['nome_musica'],
+            "timestamp": unique_timestamp,
+            "proxima_troca": proxima_troca,
+            "poll_apos": poll_apos
+        }
+    else:
+        # Se não tem música em execução, retorna vazio
+        resposta = {
+            "link": "",
+            "duracao_min": 3.0,
+            "nome": "",
+            "timestamp": 0,
+            "proxima_troca": None,
+            "poll_apos": dica_polling(None, time.time())[1]
+        }
+    if degradado:
+        # Sem banco não há pressa: o próximo poll não vem antes do Retry-After
+        resposta.update(degradado=True, poll_apos=max(resposta['poll_apos'], retry_after()))
+    return jsonify(resposta)
 
 @app.route('/api/heartbeat', methods=['POST'])
+@admitir_dispositivo
 def api_heartbeat():
-    """Registra que um dispositivo está ativo"""
+    """Registra que um dispositivo está ativo (com o banco indisponível, grava depois)"""
     data = request.get_json() or {}
     device_id = data.get('device_id', 'unknown')
     
-    try:
-        registrar_heartbeat(device_id)
+    resultado = registrar_heartbeat_dispositivo(device_id)
+    if resultado == 'gravado':
         return jsonify({"status": "ok"})
-    except Exception as e:
-        return jsonify({"status": "error", "message": str(e)}), 500
+    if resultado == 'adiado':
+        DISPOSITIVOS_DEGRADADAS.labels('/api/heartbeat').inc()
+        return jsonify({"status": "ok", "adiado": True})
+    return resposta_indisponivel()
 
 @app.route('/api/devices_count')
+@admitir_dispositivo
 def api_devices_count():
     """Retorna quantos dispositivos estão ativos"""
-    count = contar_dispositivos_ativos()
+    try:
+        count = saude_banco.executar(storage.contar_dispositivos_ativos, DEVICE_TIMEOUT_SECONDS)
+        ultima_contagem.guardar(count)
+    except Exception as e:
+        if not isinstance(e, BancoIndisponivel):
+            log.error(f"Erro ao contar dispositivos: {e}")
+        count, idade = ultima_contagem.obter()
+        if idade is None:
+            return resposta_indisponivel()
+        DISPOSITIVOS_DEGRADADAS.labels('/api/devices_count').inc()
+        return jsonify({"count": count, "degradado": True})
     return jsonify({"count": count})
 
 def serialize_data(data):
@@ -690,13 +484,81 @@ def serialize_data(data):
         return float(data)
     return data
 
+# --- PAGINAÇÃO ---
+def pedido_paginado():
+    """Sem nenhum parâmetro de paginação/filtro as listagens mantêm a resposta antiga (tudo)"""
+    return any(p in request.args for p in PARAMETROS_PAGINA)
+
+def codificar_cursor(chave):
+    return base64.urlsafe_b64encode(json.dumps(list(chave)).encode()).decode().rstrip('=')
+
+def decodificar_cursor(texto):
+    if not texto:
+        return None
+    try:
+        chave = json.loads(base64.urlsafe_b64decode(texto + '=' * (-len(texto) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Cursor inválido")
+    if not isinstance(chave, list) or not chave:
+        raise ValueError("Cursor inválido")
+    return tuple(chave)
+
+def parametros_pagina(tabela, ordem_padrao='id', desc_padrao=False):
+    """Lê limit, cursor, sort e order da query string (ValueError se inválidos)"""
+    limite = min(max(int(request.args.get('limit', PAGINA_LIMITE_PADRAO)), 1), PAGINA_LIMITE_MAX)
+    ordem = request.args.get('sort', ordem_padrao)
+    if ordem not in ORDENACOES[tabela]:
+        raise ValueError(f"sort deve ser um de: {', '.join(ORDENACOES[tabela])}")
+    sentido = request.args.get('order', 'desc' if desc_padrao else 'asc')
+    if sentido not in ('asc', 'desc'):
+        raise ValueError("order deve ser asc ou desc")
+    cursor = decodificar_cursor(request.args.get('cursor'))
+    if cursor is not None and len(cursor) != (1 if ordem == 'id' else 2):
+        raise ValueError("Cursor inválido")
+    return limite, cursor, ordem, sentido == 'desc'
+
+def resposta_pagina(rows, limite, ordem, extras=None):
+    """
+    {...extras, items, next_cursor} a partir de `limite + 1` linhas. Páginas
+    grandes são geradas item a item em vez de montar o JSON inteiro na memória.
+    """
+    proximo = codificar_cursor(chave_pagina(rows[limite - 1], ordem)) if len(rows) > limite else None
+    itens = rows[:limite]
+    extras = serialize_data(extras or {})
+    if len(itens) < PAGINA_STREAM_MIN:
+        return jsonify({**extras, "items": serialize_data(itens), "next_cursor": proximo})
+
+    def gerar():
+        yield '{'
+        for chave, valor in extras.items():
+            yield f'{json.dumps(chave)}: {app.json.dumps(valor)}, '
+        yield '"items": ['
+        for i, linha in enumerate(itens):
+            yield (', ' if i else '') + app.json.dumps(serialize_data(linha))
+        yield f'], "next_cursor": {json.dumps(proximo)}}}'
+    return app.response_class(stream_with_context(gerar()), mimetype='application/json')
+
 @app.route('/api/playlists', methods=['GET'])
+@leitura_replica
 def api_get_playlists():
+    """Playlists cadastradas; com limit/cursor/q responde paginado ({items, next_cursor})"""
+    if pedido_paginado():
+        try:
+            limite, cursor, ordem, desc = parametros_pagina('playlists')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        try:
+            rows = storage.listar_playlists_pagina(limite + 1, cursor, desc, request.args.get('q'))
+            return resposta_pagina(rows, limite, ordem)
+        except Exception as e:
+            log.error(f"Erro ao buscar playlists: {e}")
+            return jsonify({"error": str(e)}), 500
+
     try:
-        playlists = get_playlists_db()
+        playlists = storage.listar_playlists()
         return jsonify(serialize_data(playlists))
     except Exception as e:
-        print(f"Erro ao buscar playlists: {e}")
+        log.error(f"Erro ao buscar playlists: {e}")
         return jsonify([]) # Retorna lista vazia em vez de 500
 
 @app.route('/api/playlists', methods=['POST'])
@@ -710,21 +572,22 @@ def api_add_playlist():
     if sp:
         try:
             pl_id = get_id_from_url(url)
-            pl_data = sp.playlist(pl_id, fields="name")
+            pl_data = spotify('playlist', pl_id, fields="name")
             nome = pl_data['name']
         except:
             pass
             
-    adicionar_playlist_db(url, nome)
+    storage.adicionar_playlist(url, nome)
     return jsonify({"status": "ok", "nome": nome})
 
 @app.route('/api/playlists/<int:id>', methods=['DELETE'])
 def api_remove_playlist(id):
-    remover_playlist_db(id)
+    storage.remover_playlist(id)
     return jsonify({"status": "ok"})
 # --- ENDPOINT PARA ADICIONAR MÚSICA ---
 
 @app.route('/api/add_music_smart', methods=['POST'])
+@altera_fila
 def api_add_music_smart():
     """Adiciona música com validação - processamento síncrono"""
     data = request.json
@@ -736,6 +599,16 @@ def api_add_music_smart():
     if not link:
         return jsonify({"status": "error", "message": "Link obrigatório"}), 400
     
+    # Mesma chave = mesma adição (ex: duplo clique): devolve a resposta da primeira
+    chave = request.headers.get('Idempotency-Key') or data.get('idempotency_key')
+    if chave:
+        existente = storage.reservar_idempotencia(chave, IDEMPOTENCIA_VALIDADE_SEG)
+        if existente is not None:
+            if existente['resposta'] is None:
+                return jsonify({"status": "error", "message": "Esta adição já está em andamento"}), 409
+            return app.response_class(existente['resposta'], mimetype='application/json')
+    
+    concluida = False
     try:
         # Processa de forma síncrona (mais confiável com múltiplos workers)
         resultado = validar_musica_playlists(link, plays_diarios, meta_mensal, duracao_manual)
@@ -743,145 +616,177 @@ def api_add_music_smart():
         if "error" in resultado:
             return jsonify({"status": "error", "message": resultado["error"]}), 400
         
-        # Salva no banco
-        salvar_validacao(resultado)
+        # Salva no banco (upsert: repetir a adição não duplica a fila)
+        storage.salvar_validacao(resultado)
         
-        return jsonify({
+        resposta = {
             "status": "completed",
             "message": f"Sucesso! Encontrada em {len(resultado['playlists_encontradas'])} playlists.",
             "resultado": resultado
-        })
+        }
+        if chave:
+            storage.concluir_idempotencia(chave, json.dumps(resposta))
+        concluida = True
+        return jsonify(resposta)
     except Exception as e:
-        print(f"Erro ao adicionar música: {e}")
+        log.error(f"Erro ao adicionar música: {e}")
         return jsonify({"status": "error", "message": f"Erro interno: {str(e)}"}), 500
+    finally:
+        # Erros não ficam gravados: o cliente pode tentar de novo com a mesma chave
+        if chave and not concluida:
+            storage.liberar_idempotencia(chave)
+
+def calcular_stats():
+    """Estatísticas por música para a tela de controle"""
+    # Busca dados de controle e plays de hoje (soma de todas as playlists de cada música)
+    controles = storage.listar_controles()
+    plays_hoje_por_track = storage.plays_hoje_por_track()
+    
+    stats = []
+    for c in controles:
+        track_id = c['track_id']
+        plays_hoje = plays_hoje_por_track.get(track_id, 0)
+        
+        status_meta = "Em Progresso"
+        percentual = 0
+        if c['meta_mensal'] > 0:
+            percentual = (c['plays_mes_atual'] / c['meta_mensal']) * 100
+            if percentual >= 100:
+                status_meta = "Meta Atingida!"
+            elif percentual >= 90:
+                status_meta = "Perto da Meta"
+        
+        stats.append({
+            "nome": c['nome'],
+            "plays_hoje": plays_hoje,
+            "plays_mes": c['plays_mes_atual'],
+            "meta_mensal": c['meta_mensal'],
+            "percentual": round(percentual, 1),
+            "status_meta": status_meta,
+            "track_id": track_id
+        })
+    
+    return stats
+
+def calcular_painel():
+    """Estado do painel compartilhado entre as abas abertas (ver dashboard.py)"""
+    devices_online = storage.contar_dispositivos_ativos(DEVICE_TIMEOUT_SECONDS)
+    tempo_restante_seg, tempo_planejado_seg = storage.tempos_fila(devices_online, FOLGA_CICLO_SEG)
+    return serialize_data({
+        'tempo_restante_seg': tempo_restante_seg,
+        'tempo_planejado_seg': tempo_planejado_seg,
+        'devices_online': devices_online,
+        # Primeira página da fila ativa, a que todas as abas pedem a cada 5s
+        'fila': storage.listar_fila_pagina(PAGINA_LIMITE_PADRAO + 1, status=STATUS_ATIVOS),
+        'stats': calcular_stats()
+    })
+
+painel = SnapshotPainel(storage, calcular_painel, PAINEL_INTERVALO_SEG)
 
 @app.route('/get_stats')
+@leitura_replica
 def get_stats():
-    """Retorna estatísticas para a tela de controle"""
+    """Retorna estatísticas para a tela de controle (do snapshot do painel; header Age = idade)"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Busca dados de controle
-        cur.execute('SELECT * FROM musicas_controle')
-        controles = cur.fetchall()
-        
-        stats = []
-        for c in controles:
-            track_id = c['track_id']
-            
-            # Calcula plays hoje (soma de todas as playlists dessa música)
-            cur.execute('SELECT SUM(plays_hoje) as hoje FROM playlist WHERE track_id = %s', (track_id,))
-            res = cur.fetchone()
-            plays_hoje = res['hoje'] if res and res['hoje'] else 0
-            
-            status_meta = "Em Progresso"
-            percentual = 0
-            if c['meta_mensal'] > 0:
-                percentual = (c['plays_mes_atual'] / c['meta_mensal']) * 100
-                if percentual >= 100:
-                    status_meta = "Meta Atingida!"
-                elif percentual >= 90:
-                    status_meta = "Perto da Meta"
-            
-            stats.append({
-                "nome": c['nome'],
-                "plays_hoje": plays_hoje,
-                "plays_mes": c['plays_mes_atual'],
-                "meta_mensal": c['meta_mensal'],
-                "percentual": round(percentual, 1),
-                "status_meta": status_meta,
-                "track_id": track_id
-            })
-        
-        cur.close()
-        conn.close()
-        return jsonify(serialize_data(stats))
+        dados, idade = painel.obter()
+        return jsonify(dados['stats']), 200, {'Age': str(int(idade))}
     except Exception as e:
-        print(f"Erro ao buscar estatísticas: {e}")
+        log.error(f"Erro ao buscar estatísticas: {e}")
         return jsonify([]) # Retorna lista vazia para não quebrar a tela
 
+@app.route('/api/goals')
+@leitura_replica
+def api_goals():
+    """
+    Projeção de fim de mês de todas as músicas: ritmo diário, projeção, plays
+    por dia necessários para a meta e dias abaixo do ritmo (?em_risco=1 filtra)
+    """
+    try:
+        analise = analise_metas.obter()
+    except Exception as e:
+        log.error(f"Erro ao calcular projeções: {e}")
+        return jsonify({"error": str(e)}), 500
+    
+    musicas = analise['musicas']
+    track_id = request.args.get('track_id')
+    if track_id:
+        musicas = [m for m in musicas if m['track_id'] == track_id]
+    if request.args.get('em_risco') == '1':
+        musicas = [m for m in musicas if m['em_risco']]
+    return jsonify({**analise, "musicas": musicas})
+
 @app.route('/api/all_songs')
+@leitura_replica
 def api_all_songs():
-    """Retorna todas as músicas do banco (musicas_controle)"""
+    """
+    Retorna as músicas do banco (musicas_controle). Com limit/cursor/sort/order/
+    track_id/q responde paginado ({items, next_cursor}); sem eles, a lista inteira.
+    """
+    if pedido_paginado():
+        try:
+            limite, cursor, ordem, desc = parametros_pagina('musicas_controle', desc_padrao=True)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        try:
+            rows = storage.listar_controles_pagina(
+                limite + 1, cursor, ordem, desc, request.args.get('track_id'), request.args.get('q')
+            )
+            return resposta_pagina(rows, limite, ordem)
+        except Exception as e:
+            log.error(f"Erro ao buscar músicas: {e}")
+            return jsonify({"error": str(e)}), 500
+
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        cur.execute('SELECT * FROM musicas_controle ORDER BY id DESC')
-        songs = [dict(row) for row in cur.fetchall()]
-        cur.close()
-        conn.close()
-        return jsonify(songs)
+        songs = storage.listar_controles()
+        return jsonify(serialize_data(songs))
     except Exception as e:
-        print(f"Erro ao buscar músicas: {e}")
+        log.error(f"Erro ao buscar músicas: {e}")
         return jsonify([])
 
 @app.route('/api/songs/<int:song_id>', methods=['DELETE'])
+@altera_fila
 def api_delete_song(song_id):
     """Deleta uma música específica do banco"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Pega o track_id antes de deletar
-        cur.execute('SELECT track_id FROM musicas_controle WHERE id = %s', (song_id,))
-        row = cur.fetchone()
-        
-        if row:
-            track_id = row['track_id']
-            # Deleta da tabela de controle
-            cur.execute('DELETE FROM musicas_controle WHERE id = %s', (song_id,))
-            # Deleta histórico diário
-            cur.execute('DELETE FROM plays_diarios WHERE track_id = %s', (track_id,))
-            # Deleta da playlist (fila)
-            cur.execute('DELETE FROM playlist WHERE track_id = %s', (track_id,))
-            
-        conn.commit()
-        cur.close()
-        conn.close()
+        storage.remover_controle(song_id)
         return jsonify({"success": True})
     except Exception as e:
-        print(f"Erro ao deletar música: {e}")
+        log.error(f"Erro ao deletar música: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/songs/bulk_delete', methods=['POST'])
+@altera_fila
+def api_bulk_delete_songs():
+    """Deleta várias músicas do banco numa transação ({"ids": [...]}); retorna o que foi removido por tabela"""
+    try:
+        ids = ids_do_lote()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        removidas = storage.remover_controles(ids)
+        return jsonify({"success": True, **removidas})
+    except Exception as e:
+        log.error(f"Erro ao deletar músicas: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/songs/delete_all', methods=['DELETE'])
+@altera_fila
 def api_delete_all_songs():
     """Deleta TODAS as músicas do banco"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Deleta tudo
-        cur.execute('DELETE FROM musicas_controle')
-        cur.execute('DELETE FROM plays_diarios')
-        cur.execute('DELETE FROM playlist')
-        
-        conn.commit()
-        cur.close()
-        conn.close()
-        return jsonify({"success": True, "message": "Todas as músicas foram deletadas!"})
+        removidas = storage.remover_todas_musicas()
+        return jsonify({"success": True, "message": "Todas as músicas foram deletadas!", **removidas})
     except Exception as e:
-        print(f"Erro ao deletar tudo: {e}")
+        log.error(f"Erro ao deletar tudo: {e}")
         return jsonify({"error": str(e)}), 500
 
 @app.route('/api/plays_history/<track_id>')
+@leitura_replica
 def api_plays_history(track_id):
     """Retorna histórico de plays diários para um track específico"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
         # Busca últimos 30 dias de histórico
-        cur.execute('''
-            SELECT data, plays FROM plays_diarios 
-            WHERE track_id = %s 
-            ORDER BY data DESC 
-            LIMIT 30
-        ''', (track_id,))
-        
-        rows = cur.fetchall()
-        cur.close()
-        conn.close()
+        rows = storage.historico_plays(track_id, 30)
         
         # Formata para o gráfico
         history = []
@@ -896,110 +801,192 @@ def api_plays_history(track_id):
         
         return jsonify(history)
     except Exception as e:
-        print(f"Erro ao buscar histórico: {e}")
+        log.error(f"Erro ao buscar histórico: {e}")
         return jsonify([])
 
-@app.route('/api/config', methods=['POST'])
-def api_update_config():
-    data = request.json
-    chave = data.get('chave')
-    valor = data.get('valor')
-    
-    if not chave or valor is None:
-        return jsonify({"error": "Dados inválidos"}), 400
-        
-    # Salva no banco
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute('''
-        INSERT INTO config (chave, valor) VALUES (%s, %s)
-        ON CONFLICT (chave) DO UPDATE SET valor = %s
-    ''', (chave, str(valor), str(valor)))
-    conn.commit()
-    cur.close()
-    conn.close()
+@app.route('/api/plays_history')
+@leitura_replica
+def api_plays_history_batch():
+    """
+    Plays diários de várias músicas numa consulta só (?track_ids=a,b&from=AAAA-MM-DD&to=AAAA-MM-DD;
+    padrão: últimos 30 dias). Formato colunar, com todos os dias do intervalo (0 sem plays):
+    {inicio, fim, datas: [...], series: {track_id: [plays por dia]}}
+    """
+    track_ids = list(dict.fromkeys(t for t in request.args.get('track_ids', '').split(',') if t))
+    if not track_ids:
+        return jsonify({"error": "track_ids obrigatório"}), 400
+    if len(track_ids) > HISTORICO_LOTE_MAX_TRACKS:
+        return jsonify({"error": f"No máximo {HISTORICO_LOTE_MAX_TRACKS} track_ids por requisição"}), 400
+    try:
+        # Mesmo dia do CURRENT_DATE gravado em plays_diarios
+        fim = datetime.date.fromisoformat(request.args['to']) if 'to' in request.args else motor.relogio().date()
+        inicio = (datetime.date.fromisoformat(request.args['from']) if 'from' in request.args
+                  else fim - datetime.timedelta(days=HISTORICO_LOTE_DIAS_PADRAO - 1))
+    except ValueError:
+        return jsonify({"error": "Datas inválidas (use AAAA-MM-DD)"}), 400
+    dias = (fim - inicio).days + 1
+    if not 0 < dias <= HISTORICO_LOTE_MAX_DIAS:
+        return jsonify({"error": f"Intervalo deve ter de 1 a {HISTORICO_LOTE_MAX_DIAS} dias"}), 400
     
-    # Atualiza global
-    config[chave] = int(valor) if str(valor).isdigit() else valor
+    try:
+        series = {t: [0] * dias for t in track_ids}
+        for row in storage.historico_plays_lote(track_ids, inicio, fim):
+            series[row['track_id']][(row['data'] - inicio).days] = row['plays']
+    except Exception as e:
+        log.error(f"Erro ao buscar histórico: {e}")
+        return jsonify({"error": str(e)}), 500
     
-    return jsonify({"status": "ok"})
+    return jsonify({
+        "inicio": inicio.isoformat(),
+        "fim": fim.isoformat(),
+        "datas": [(inicio + datetime.timedelta(days=d)).isoformat() for d in range(dias)],
+        "series": series
+    })
 
-# --- ROTAS DA INTERFACE WEB ---
-def calcular_tempo_restante_fila(playlist, dispositivos_online):
-    """Calcula tempo restante para completar a playlist baseado em dispositivos online"""
-    tempo_total_seg = 0
-    
-    # Usa dispositivos online, mínimo 1 para evitar divisão por zero
-    qtd_dispositivos = max(dispositivos_online, 1)
+@app.route('/api/queue_history')
+def api_queue_history():
+    """Retorna as entradas arquivadas da fila, paginadas da mais recente para a mais antiga"""
+    try:
+        limite = min(max(int(request.args.get('limit', 50)), 1), HISTORICO_LIMITE_MAX)
+        antes_de = request.args.get('before', type=int)  # cursor: arquivo_id da última linha recebida
+        track_id = request.args.get('track_id')
+    except ValueError:
+        return jsonify({"error": "Parâmetros inválidos"}), 400
     
-    for row in playlist:
-        if row['status'] != 'Concluído':
-            plays_restantes = row['plays_desejados'] - row['plays_atuais']
-            
-            if plays_restantes > 0:
-                ciclos_necessarios = math.ceil(plays_restantes / qtd_dispositivos)
-                intervalo_ciclo = (row['duracao_min'] * 60) + 10
-                tempo_total_seg += ciclos_necessarios * intervalo_ciclo
+    try:
+        # Busca uma linha a mais para saber se existe próxima página
+        rows = storage.listar_arquivo(limite + 1, antes_de, track_id)
+        proximo = rows[limite - 1]['arquivo_id'] if len(rows) > limite else None
+        return jsonify({
+            "items": serialize_data(rows[:limite]),
+            "next_cursor": proximo
+        })
+    except Exception as e:
+        log.error(f"Erro ao buscar histórico da fila: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/export/<conjunto>')
+@leitura_replica
+def api_export(conjunto):
+    """
+    Exporta plays_diarios, musicas_controle, fila ou arquivo inteiros em CSV
+    ou Parquet (?format=), em streaming e com memória constante
+    """
+    if conjunto not in EXPORTACOES:
+        return jsonify({"error": f"Conjunto inválido; use um de: {', '.join(EXPORTACOES)}"}), 404
+    formato = request.args.get('format', 'csv')
+    if formato not in export.FORMATOS:
+        return jsonify({"error": "format deve ser csv ou parquet"}), 400
+    if formato == 'parquet' and not export.parquet_disponivel():
+        return jsonify({"error": "Exportação em Parquet indisponível (pyarrow não instalado)"}), 501
     
-    return tempo_total_seg
+    # Cada exportação segura uma thread e uma conexão até o fim: limita por worker
+    if not exportacoes_livres.acquire(blocking=False):
+        return jsonify({"error": "Muitas exportações em andamento; tente novamente"}), 429, {'Retry-After': '30'}
+    cursor_lotes = storage.exportar(conjunto, EXPORTACAO_LOTE)
+    try:
+        # Busca o primeiro lote antes de responder: erro de banco ainda vira 500, não um arquivo cortado
+        primeiro = next(cursor_lotes, None)
+    except Exception as e:
+        exportacoes_livres.release()
+        log.error(f"Erro ao exportar {conjunto}: {e}")
+        return jsonify({"error": str(e)}), 500
+    lotes = itertools.chain([primeiro] if primeiro else [], cursor_lotes)
+    # O gerador não usa o contexto da requisição: dispensa o stream_with_context
+    resposta = app.response_class(export.gerar(formato, lotes, EXPORTACOES[conjunto][2]), mimetype=export.FORMATOS[formato])
+    # Fecha o cursor nomeado e libera a vaga mesmo se o cliente desistir no meio
+    resposta.call_on_close(cursor_lotes.close)
+    resposta.call_on_close(exportacoes_livres.release)
+    nome = f"loop-{conjunto}-{datetime.date.today().isoformat()}.{formato}"
+    resposta.headers['Content-Disposition'] = f'attachment; filename="{nome}"'
+    return resposta
 
-def calcular_tempo_planejado_fila(playlist, dispositivos_online):
-    """Calcula tempo total planejado desde o início baseado em dispositivos online"""
-    tempo_total_seg = 0
+@app.route('/api/config', methods=['POST'])
+def api_update_config():
+    """Atualiza uma chave ({chave, valor}) ou várias de uma vez ({valores: {...}})"""
+    data = request.json or {}
+    valores = data.get('valores')
+    if valores is None:
+        chave = data.get('chave')
+        valor = data.get('valor')
+        if not chave or valor is None:
+            return jsonify({"error": "Dados inválidos"}), 400
+        valores = {chave: valor}
     
-    # Usa dispositivos online, mínimo 1 para evitar divisão por zero
-    qtd_dispositivos = max(dispositivos_online, 1)
+    if not isinstance(valores, dict) or not valores:
+        return jsonify({"error": "Dados inválidos"}), 400
     
-    for row in playlist:
-        if row['status'] != 'Concluído':
-            plays_totais = row['plays_desejados']
-            
-            if plays_totais > 0:
-                ciclos_necessarios = math.ceil(plays_totais / qtd_dispositivos)
-                intervalo_ciclo = (row['duracao_min'] * 60) + 10
-                tempo_total_seg += ciclos_necessarios * intervalo_ciclo
+    try:
+        config_service.atualizar(valores)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
     
-    return tempo_total_seg
+    return jsonify({"status": "ok", "config": config_service.snapshot()})
 
+# --- ROTAS DA INTERFACE WEB ---
 @app.route('/')
 def index():
-    playlist = carregar_playlist()
-    devices_online = contar_dispositivos_ativos()
-    tempo_restante_seg = calcular_tempo_restante_fila(playlist, devices_online)
-    tempo_planejado_seg = calcular_tempo_planejado_fila(playlist, devices_online)
+    dados, idade = painel.obter()
     
     return render_template('index.html', 
-                         config=config, 
-                         tempo_restante_seg=tempo_restante_seg,
-                         tempo_planejado_seg=tempo_planejado_seg,
-                         devices_online=devices_online)
+                         config=config_service.snapshot(), 
+                         tempo_restante_seg=dados['tempo_restante_seg'],
+                         tempo_planejado_seg=dados['tempo_planejado_seg'],
+                         devices_online=dados['devices_online'],
+                         status_ativos=STATUS_ATIVOS,
+                         pagina_limite=PAGINA_LIMITE_PADRAO)
 
 @app.route('/get_data')
 def get_data():
-    playlist = carregar_playlist()
-    devices_online = contar_dispositivos_ativos()
-    tempo_restante_seg = calcular_tempo_restante_fila(playlist, devices_online)
-    tempo_planejado_seg = calcular_tempo_planejado_fila(playlist, devices_online)
+    """
+    Estado do painel. Com limit/cursor/order/status/track_id/q a fila vem
+    paginada em `items` (status separados por vírgula); sem eles, inteira em `playlist`.
+    Contadores e tempos vêm do snapshot compartilhado, com a idade em `snapshot_idade_seg`.
+    """
+    dados, idade = painel.obter()
+    estado = {
+        'config': config_service.snapshot(), 
+        'tempo_restante_seg': dados['tempo_restante_seg'],
+        'tempo_planejado_seg': dados['tempo_planejado_seg'],
+        'devices_online': dados['devices_online'],
+        'snapshot_idade_seg': round(idade, 1)
+    }
+    cabecalhos = {'Age': str(int(idade))}
     
-    return jsonify({
-        'playlist': playlist, 
-        'config': config, 
-        'tempo_restante_seg': tempo_restante_seg,
-        'tempo_planejado_seg': tempo_planejado_seg,
-        'devices_online': devices_online
-    })
+    if pedido_paginado():
+        try:
+            limite, cursor, ordem, desc = parametros_pagina('playlist')
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
+        status = [st for st in request.args.get('status', '').split(',') if st]
+        track_id = request.args.get('track_id')
+        busca = request.args.get('q')
+        primeira_pagina_ativa = (
+            cursor is None and not desc and not track_id and not busca
+            and sorted(status) == sorted(STATUS_ATIVOS) and limite <= PAGINA_LIMITE_PADRAO
+        )
+        if primeira_pagina_ativa:
+            rows = dados['fila'][:limite + 1]
+        else:
+            rows = storage.listar_fila_pagina(limite + 1, cursor, desc, status, track_id, busca)
+        resposta = resposta_pagina(rows, limite, ordem, estado)
+        resposta.headers.update(cabecalhos)
+        return resposta
+    
+    return jsonify({'playlist': storage.carregar_playlist(), **estado}), 200, cabecalhos
 
 @app.route('/update_config', methods=['POST'])
 def update_config():
-    global config
-    quantidade = int(request.form['quantidade_aparelhos'])
-    config['quantidade_aparelhos'] = quantidade
-    salvar_config_db('quantidade_aparelhos', quantidade)
+    try:
+        config_service.atualizar({'quantidade_aparelhos': request.form['quantidade_aparelhos']})
+    except (KeyError, ValueError) as e:
+        return jsonify({"error": str(e)}), 400
     return redirect(url_for('index'))
 
 @app.route('/add', methods=['POST'])
+@altera_fila
 def add_music():
-    salvar_musica(
+    storage.salvar_musica(
         request.form['link_musica'],
         request.form['nome_musica'],
         int(request.form['plays_desejados']),
@@ -1008,94 +995,98 @@ def add_music():
     return redirect(url_for('index'))
 
 @app.route('/delete/<int:id>')
+@altera_fila
 def delete_music(id):
-    deletar_musica(id)
+    storage.deletar_musica(id)
     return redirect(url_for('index'))
 
 @app.route('/reset_all_plays')
+@altera_fila
 def reset_all_plays():
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("UPDATE playlist SET plays_atuais = 0, status = 'Pendente'")
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.resetar_fila()
     return redirect(url_for('index'))
 
 @app.route('/move_to_top/<int:id>')
+@altera_fila
 def move_to_top(id):
     """Move uma música para o topo da fila"""
-    conn = get_db_connection()
-    cur = conn.cursor()
-    
-    # Pega o menor ID atual
-    cur.execute('SELECT MIN(id) as min_id FROM playlist')
-    result = cur.fetchone()
-    min_id = result['min_id'] if result and result['min_id'] else 0
-    
-    # Atualiza o ID da música para ser menor que o mínimo
-    # (Isso é uma simplificação, em produção usaríamos uma coluna de ordem)
-    cur.execute('UPDATE playlist SET id = %s WHERE id = %s', (min_id - 1, id))
-    conn.commit()
-    cur.close()
-    conn.close()
+    storage.mover_para_topo(id)
     
     return redirect(url_for('index'))
+
+# --- OPERAÇÕES EM LOTE NA FILA ---
+# Corpo JSON {"ids": [...]}; cada operação é um comando só, numa transação
+
+def ids_do_lote():
+    """Lê e valida a lista de ids do corpo JSON (ValueError se inválida)"""
+    ids = (request.get_json(silent=True) or {}).get('ids')
+    if not isinstance(ids, list) or not ids:
+        raise ValueError("ids deve ser uma lista não vazia")
+    if len(ids) > LOTE_MAX_IDS:
+        raise ValueError(f"No máximo {LOTE_MAX_IDS} ids por requisição")
+    if not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+        raise ValueError("ids deve conter apenas inteiros")
+    return ids
+
+def operacao_lote(operacao, *args):
+    try:
+        ids = ids_do_lote()
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    try:
+        return jsonify({"success": True, "afetadas": operacao(ids, *args)})
+    except Exception as e:
+        log.error(f"Erro na operação em lote: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/queue/bulk_delete', methods=['POST'])
+@altera_fila
+def api_queue_bulk_delete():
+    return operacao_lote(storage.deletar_musicas)
+
+@app.route('/api/queue/bulk_reset', methods=['POST'])
+@altera_fila
+def api_queue_bulk_reset():
+    """Zera os plays e volta as músicas para Pendente"""
+    return operacao_lote(storage.resetar_musicas)
+
+@app.route('/api/queue/bulk_status', methods=['POST'])
+@altera_fila
+def api_queue_bulk_status():
+    status = (request.get_json(silent=True) or {}).get('status')
+    if status not in STATUS_FILA:
+        return jsonify({"error": f"status deve ser um de: {', '.join(STATUS_FILA)}"}), 400
+    return operacao_lote(storage.alterar_status, status)
+
+@app.route('/api/queue/bulk_move_to_top', methods=['POST'])
+@altera_fila
+def api_queue_bulk_move_to_top():
+    """Move as músicas para o topo, na ordem da lista (a primeira fica em primeiro)"""
+    return operacao_lote(storage.mover_para_topo_lote)
     
 @app.route('/debug/status')
+@leitura_replica
 def debug_status():
     """Retorna estado interno para debug"""
     try:
-        conn = get_db_connection()
-        cur = conn.cursor()
-        
-        # Devices
-        cur.execute(f"SELECT COUNT(*) as count FROM devices WHERE last_seen > NOW() - INTERVAL '{DEVICE_TIMEOUT_SECONDS} seconds'")
-        dev_count = cur.fetchone()['count']
-        
-        # Devices Raw
-        cur.execute("SELECT device_id, last_seen, NOW() as now, NOW() - last_seen as diff FROM devices ORDER BY last_seen DESC LIMIT 5")
-        rows = cur.fetchall()
-        dev_raw = []
-        for row in rows:
-            r = dict(row)
+        resumo = storage.resumo_debug(DEVICE_TIMEOUT_SECONDS)
+        for r in resumo['devices_raw']:
             r['last_seen'] = r['last_seen'].isoformat() if r['last_seen'] else None
             r['now'] = r['now'].isoformat() if r['now'] else None
             r['diff'] = str(r['diff']) # Converte timedelta para string
-            dev_raw.append(r)
-        
-        # Playlist Queue
-        cur.execute("SELECT id, nome_musica, status, plays_atuais, plays_desejados FROM playlist WHERE status != 'Concluído' ORDER BY id LIMIT 5")
-        queue = [dict(row) for row in cur.fetchall()]
-        
-        # Playlists Table (Collections)
-        cur.execute("SELECT id, nome, url FROM playlists")
-        cols = [dict(row) for row in cur.fetchall()]
-        
-        # Count tables
-        cur.execute("SELECT COUNT(*) as count FROM playlist")
-        total_songs = cur.fetchone()['count']
-        
-        cur.execute("SELECT COUNT(*) as count FROM playlist WHERE status = 'Em Execução'")
-        executing_songs = cur.fetchone()['count']
-        
-        cur.execute("SELECT COUNT(*) as count FROM musicas_controle")
-        tracked_songs = cur.fetchone()['count']
-        
-        cur.close()
-        conn.close()
         
         return jsonify({
-            "devices_online_count": dev_count,
-            "devices_raw": dev_raw,
-            "queue_pending_top_5": queue,
-            "playlists_collections_count": len(cols),
-            "playlists_collections": cols,
-            "total_songs_in_playlist_table": total_songs,
-            "executing_songs": executing_songs,
-            "tracked_songs_count": tracked_songs,
-            "current_link_data": current_link_data,  # Expõe a variável global
-            "config": config,
+            **resumo,
+            "replica": storage.estado_replica(),
+            "dispositivos": {
+                **saude_banco.estado(),
+                "em_andamento": admissao_dispositivos.em_uso,
+                "limite": admissao_dispositivos.limite,
+                "heartbeats_adiados": len(heartbeats_adiados)
+            },
+            "current_link_data": motor.link_atual,  # Link atual do motor deste worker
+            "motor_checkpoint": serialize_data(storage.ler_checkpoint_motor()),
+            "config": config_service.snapshot(),
             "server_time": datetime.datetime.now().isoformat(),
             "cwd": os.getcwd(),
             "playlists_txt_exists": os.path.exists('playlists.txt'),
@@ -1104,16 +1095,56 @@ def debug_status():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+@app.route('/debug/queries', methods=['GET', 'DELETE'])
+def debug_queries():
+    """Top-N comandos SQL deste worker por tempo total (DELETE zera as estatísticas)"""
+    if request.method == 'DELETE':
+        sql_profiler.estatisticas.limpar()
+        return jsonify({"status": "ok"})
+    
+    ordem = request.args.get('ordem', 'total_ms')
+    if ordem not in ('total_ms', 'media_ms', 'max_ms', 'chamadas', 'lentas'):
+        return jsonify({"error": "Ordem inválida"}), 400
+    n = min(max(request.args.get('n', 20, type=int), 1), 100)
+    
+    return jsonify({
+        "pid": os.getpid(),
+        "desde": datetime.datetime.fromtimestamp(sql_profiler.estatisticas.desde).isoformat(),
+        "limite_lento_ms": sql_profiler.SLOW_QUERY_MS,
+        "explain_ativo": sql_profiler.EXPLAIN_SLOW_QUERIES,
+        "comandos": sql_profiler.estatisticas.relatorio(n, ordem)
+    })
+
+@app.route('/debug/traces', methods=['GET', 'DELETE'])
+def debug_traces():
+    """Traces lentos recentes deste worker, do mais lento ao mais rápido (DELETE esvazia o buffer)"""
+    if request.method == 'DELETE':
+        tracing.registro.limpar()
+        return jsonify({"status": "ok"})
+    
+    n = min(max(request.args.get('n', 20, type=int), 1), tracing.TRACE_BUFFER)
+    min_ms = request.args.get('min_ms', 0.0, type=float)
+    
+    return jsonify({
+        "pid": os.getpid(),
+        "desde": datetime.datetime.fromtimestamp(tracing.registro.desde).isoformat(),
+        "limite_lento_ms": tracing.TRACE_LENTO_MS,
+        "taxa": tracing.TRACE_TAXA,
+        "taxa_dispositivos": tracing.TRACE_TAXA_DISPOSITIVOS,
+        "traces": tracing.registro.lentos(n, min_ms)
+    })
+
 # --- INICIALIZAÇÃO ---
 # Inicializa o banco de dados quando o módulo é carregado (funciona com Gunicorn)
-print("🚀 Inicializando aplicação...")
+log.info("🚀 Inicializando aplicação...")
 try:
-    init_db()
+    storage.inicializar(config_service.padroes())
+    log.info("✅ Banco de dados inicializado com sucesso!")
     
     # Migração de playlists.txt se a tabela estiver vazia
     try:
-        if not get_playlists_db():
-            print("📂 Migrando playlists.txt para o banco...")
+        if not storage.listar_playlists():
+            log.info("📂 Migrando playlists.txt para o banco...")
             if os.path.exists('playlists.txt'):
                 with open('playlists.txt', 'r', encoding='utf-8') as f:
                     for linha in f:
@@ -1124,31 +1155,28 @@ try:
                             if sp:
                                 try:
                                     pl_id = get_id_from_url(url)
-                                    pl_data = sp.playlist(pl_id, fields="name")
+                                    pl_data = spotify('playlist', pl_id, fields="name")
                                     nome = pl_data['name']
                                 except:
                                     pass
-                            adicionar_playlist_db(url, nome)
-            print("✅ Playlists migradas!")
+                            storage.adicionar_playlist(url, nome)
+            log.info("✅ Playlists migradas!")
     except Exception as e:
-        print(f"⚠️ Erro na migração de playlists: {e}")
+        log.warning(f"⚠️ Erro na migração de playlists: {e}")
         
-    carregar_config()
-    print("✅ Banco de dados pronto!")
+    config_service.invalidar()
+    log.info("✅ Banco de dados pronto!")
     
-    # Recupera a música em execução (caso o servidor tenha reiniciado)
-    playlist = carregar_playlist()
-    for m in playlist:
-        if m['status'] == 'Em Execução':
-            current_link_data['link'] = m['link_musica']
-            current_link_data['duracao_min'] = m['duracao_min']
-            current_link_data['nome'] = m['nome_musica']
-            current_link_data['timestamp'] = int(time.time())
-            print(f"🎵 Recuperada música em execução: {m['nome_musica']}")
-            break
+    # Esvazia da fila quente o que já foi concluído antes do deploy
+    try:
+        arquivadas = storage.arquivar_concluidas()
+        if arquivadas:
+            log.info(f"📦 {arquivadas} entradas concluídas movidas para o arquivo.")
+    except Exception as e:
+        log.warning(f"⚠️ Erro ao arquivar concluídas: {e}")
             
 except Exception as e:
-    print(f"⚠️ Erro ao inicializar banco: {e}")
+    log.warning(f"⚠️ Erro ao inicializar banco: {e}")
 
 # Inicia o motor de automação em uma thread separada
 # Inicia o motor de automação (apenas se for o main thread/process)
@@ -1156,6 +1184,12 @@ except Exception as e:
 if os.environ.get('WERKZEUG_RUN_MAIN') != 'true': # Evita duplicar no reload do flask dev
     motor_thread = threading.Thread(target=motor_automacao, daemon=True)
     motor_thread.start()
+    arquivamento_thread = threading.Thread(target=motor_arquivamento, daemon=True)
+    arquivamento_thread.start()
+    painel_thread = threading.Thread(target=painel.loop, daemon=True)
+    painel_thread.start()
+    heartbeats_thread = threading.Thread(target=motor_heartbeats_adiados, daemon=True)
+    heartbeats_thread.start()
 
 if __name__ == '__main__':
     # Inicia o servidor Flask (apenas para execução local)
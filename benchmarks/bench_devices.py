@@ -0,0 +1,359 @@
+"""
+Teste de carga dos dispositivos do LooP.
+
+Simula N dispositivos que fazem polling em /api/current_link e enviam
+POST /api/heartbeat em intervalos realistas (com jitter), enquanto o motor
+roda normalmente. Com --follow-hints cada dispositivo espera o `poll_apos`
+devolvido pelo servidor em vez do intervalo fixo. Ao final mostra throughput, latências p50/p95/p99, taxa de
+erros e conexões abertas no Postgres, e grava tudo em JSON para comparar
+execuções.
+
+Exemplos:
+    # Contra um servidor rodando (gunicorn local ou remoto)
+    python benchmarks/bench_devices.py --url http://localhost:5000 --devices 300 --duration 120
+
+    # Dentro do processo, via test client do Flask (o motor sobe junto com o app)
+    python benchmarks/bench_devices.py --in-process --devices 50 --duration 30
+
+    # Dispositivos que seguem a dica de polling do servidor
+    python benchmarks/bench_devices.py --in-process --devices 50 --duration 300 --follow-hints
+
+    # Compara com uma execução anterior
+    python benchmarks/bench_devices.py --url http://localhost:5000 --compare benchmarks/results/anterior.json
+"""
+import os
+import sys
+import json
+import time
+import heapq
+import random
+import argparse
+import datetime
+import threading
+import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASTA_RESULTADOS = os.path.join(RAIZ, 'benchmarks', 'results')
+
+
+def percentil(valores_ordenados, p):
+    """Percentil pelo método nearest-rank (lista já ordenada)"""
+    if not valores_ordenados:
+        return None
+    indice = max(0, min(len(valores_ordenados) - 1, int(round(p / 100 * len(valores_ordenados))) - 1))
+    return valores_ordenados[indice]
+
+
+class Coletor:
+    """Acumula latências e erros por endpoint (thread-safe)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencias = {}
+        self.erros = {}
+        self.status = {}
+        self.atrasos = []
+
+    def registrar(self, endpoint, latencia_ms, status):
+        with self._lock:
+            self.latencias.setdefault(endpoint, []).append(latencia_ms)
+            self.status.setdefault(endpoint, {})
+            self.status[endpoint][status] = self.status[endpoint].get(status, 0) + 1
+            if status == 'erro' or (isinstance(status, int) and status >= 500):
+                self.erros[endpoint] = self.erros.get(endpoint, 0) + 1
+
+    def registrar_atraso(self, atraso_ms):
+        with self._lock:
+            self.atrasos.append(atraso_ms)
+
+    def resumo(self, duracao_seg):
+        resultado = {}
+        with self._lock:
+            todos = []
+            for endpoint, lats in self.latencias.items():
+                ordenadas = sorted(lats)
+                todos.extend(lats)
+                erros = self.erros.get(endpoint, 0)
+                resultado[endpoint] = {
+                    "requisicoes": len(lats),
+                    "erros": erros,
+                    "taxa_erro": round(erros / len(lats), 4) if lats else 0,
+                    "throughput_rps": round(len(lats) / duracao_seg, 2),
+                    "p50_ms": _arred(percentil(ordenadas, 50)),
+                    "p95_ms": _arred(percentil(ordenadas, 95)),
+                    "p99_ms": _arred(percentil(ordenadas, 99)),
+                    "max_ms": _arred(ordenadas[-1] if ordenadas else None),
+                    "status": {str(k): v for k, v in self.status[endpoint].items()}
+                }
+            ordenadas = sorted(todos)
+            erros = sum(self.erros.values())
+            resultado['total'] = {
+                "requisicoes": len(todos),
+                "erros": erros,
+                "taxa_erro": round(erros / len(todos), 4) if todos else 0,
+                "throughput_rps": round(len(todos) / duracao_seg, 2),
+                "p50_ms": _arred(percentil(ordenadas, 50)),
+                "p95_ms": _arred(percentil(ordenadas, 95)),
+                "p99_ms": _arred(percentil(ordenadas, 99)),
+                "max_ms": _arred(ordenadas[-1] if ordenadas else None)
+            }
+            atrasos = sorted(self.atrasos)
+            resultado['atraso_agendamento'] = {
+                "p95_ms": _arred(percentil(atrasos, 95)),
+                "max_ms": _arred(atrasos[-1] if atrasos else None)
+            }
+        return resultado
+
+
+def _arred(valor):
+    return round(valor, 2) if valor is not None else None
+
+
+class AmostradorConexoes(threading.Thread):
+    """Lê pg_stat_activity a cada segundo para acompanhar conexões abertas"""
+
+    def __init__(self, database_url):
+        super().__init__(daemon=True)
+        self.database_url = database_url
+        self.amostras = []
+        self.erro = None
+        self._parar = threading.Event()
+
+    def run(self):
+        try:
+            import psycopg2
+            conn = psycopg2.connect(self.database_url)
+            conn.autocommit = True
+            cur = conn.cursor()
+        except Exception as e:
+            self.erro = str(e)
+            return
+        while not self._parar.is_set():
+            try:
+                cur.execute('''
+                    SELECT COALESCE(state, 'desconhecido'), COUNT(*) FROM pg_stat_activity
+                    WHERE datname = current_database() AND pid <> pg_backend_pid()
+                    GROUP BY 1
+                ''')
+                self.amostras.append(dict(cur.fetchall()))
+            except Exception as e:
+                self.erro = str(e)
+                break
+            self._parar.wait(1)
+        conn.close()
+
+    def parar(self):
+        self._parar.set()
+
+    def resumo(self):
+        if not self.amostras:
+            return {"erro": self.erro or "sem amostras"}
+        totais = [sum(a.values()) for a in self.amostras]
+        estados = sorted({estado for a in self.amostras for estado in a})
+        return {
+            "amostras": len(self.amostras),
+            "total_max": max(totais),
+            "total_medio": round(sum(totais) / len(totais), 2),
+            "por_estado_max": {e: max(a.get(e, 0) for a in self.amostras) for e in estados}
+        }
+
+
+def criar_cliente(args):
+    """Retorna uma função (metodo, caminho, json) -> (status, corpo JSON ou None), usando um cliente por thread"""
+    local = threading.local()
+
+    if args.in_process:
+        sys.path.insert(0, RAIZ)
+        import app as loop_app  # importar sobe o banco e o motor, como no gunicorn
+
+        def requisitar(metodo, caminho, corpo=None):
+            if not hasattr(local, 'cliente'):
+                local.cliente = loop_app.app.test_client()
+            resp = local.cliente.open(caminho, method=metodo, json=corpo)
+            return resp.status_code, resp.get_json(silent=True)
+    else:
+        import requests
+        base = args.url.rstrip('/')
+
+        def requisitar(metodo, caminho, corpo=None):
+            if not hasattr(local, 'sessao'):
+                local.sessao = requests.Session()
+            resp = local.sessao.request(metodo, base + caminho, json=corpo, timeout=args.timeout)
+            try:
+                return resp.status_code, resp.json()
+            except ValueError:
+                return resp.status_code, None
+
+    return requisitar
+
+
+def executar(args):
+    requisitar = criar_cliente(args)
+    coletor = Coletor()
+    amostrador = None
+    if args.database_url:
+        amostrador = AmostradorConexoes(args.database_url)
+        amostrador.start()
+
+    inicio = time.monotonic()
+    fim = inicio + args.duration
+    agenda = []
+    for n in range(args.devices):
+        device_id = f"bench-{n:05d}"
+        # Espalha a entrada dos dispositivos ao longo do ramp-up
+        chegada = inicio + (args.ramp_up * n / max(args.devices, 1))
+        heapq.heappush(agenda, (chegada, n, 'heartbeat', device_id))
+        heapq.heappush(agenda, (chegada + random.uniform(0, args.poll_interval), n, 'poll', device_id))
+
+    # Polls reagendados pelas threads (--follow-hints): o próximo depende da resposta
+    reagendados = deque()
+
+    def disparar(previsto, n, tipo, device_id):
+        coletor.registrar_atraso(max(0.0, time.monotonic() - previsto) * 1000)
+        t0 = time.perf_counter()
+        corpo = None
+        if tipo == 'poll':
+            endpoint = '/api/current_link'
+            try:
+                status, corpo = requisitar('GET', f'{endpoint}?device_id={device_id}')
+            except Exception:
+                status = 'erro'
+        else:
+            endpoint = '/api/heartbeat'
+            try:
+                status, _ = requisitar('POST', endpoint, {"device_id": device_id})
+            except Exception:
+                status = 'erro'
+        coletor.registrar(endpoint, (time.perf_counter() - t0) * 1000, status)
+        if tipo == 'poll' and args.follow_hints:
+            espera = (corpo or {}).get('poll_apos') or args.poll_interval
+            reagendados.append((time.monotonic() + espera, n, tipo, device_id))
+
+    print(f"▶️  {args.devices} dispositivos por {args.duration}s "
+          f"(poll {'pela dica do servidor' if args.follow_hints else f'{args.poll_interval}s'}, "
+          f"heartbeat {args.heartbeat_interval}s, {args.concurrency} threads)")
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        while agenda:
+            while reagendados:
+                heapq.heappush(agenda, reagendados.popleft())
+            previsto, n, tipo, device_id = agenda[0]
+            if previsto >= fim:
+                break
+            agora = time.monotonic()
+            if previsto > agora:
+                time.sleep(min(previsto - agora, 0.05))
+                continue
+            heapq.heappop(agenda)
+            executor.submit(disparar, previsto, n, tipo, device_id)
+            if tipo == 'poll' and args.follow_hints:
+                continue
+
+            # Reagenda o próximo evento do mesmo dispositivo (jitter de ±10%)
+            intervalo = args.poll_interval if tipo == 'poll' else args.heartbeat_interval
+            heapq.heappush(agenda, (previsto + intervalo * random.uniform(0.9, 1.1), n, tipo, device_id))
+
+    duracao = time.monotonic() - inicio
+    if amostrador:
+        amostrador.parar()
+        amostrador.join(timeout=5)
+
+    return {
+        "data": datetime.datetime.now().isoformat(),
+        "commit": _commit_atual(),
+        "parametros": {
+            "alvo": "in-process" if args.in_process else args.url,
+            "dispositivos": args.devices,
+            "duracao_seg": args.duration,
+            "poll_interval_seg": args.poll_interval,
+            "segue_dicas": args.follow_hints,
+            "heartbeat_interval_seg": args.heartbeat_interval,
+            "ramp_up_seg": args.ramp_up,
+            "concorrencia": args.concurrency
+        },
+        "duracao_real_seg": round(duracao, 2),
+        "resultados": coletor.resumo(duracao),
+        "db_conexoes": amostrador.resumo() if amostrador else None
+    }
+
+
+def _commit_atual():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def imprimir(relatorio, anterior=None):
+    print(f"\n{'endpoint':<22}{'req':>8}{'rps':>9}{'p50':>9}{'p95':>9}{'p99':>9}{'erros':>8}")
+    resultados = relatorio['resultados']
+    for endpoint, r in resultados.items():
+        if endpoint == 'atraso_agendamento':
+            continue
+        print(f"{endpoint:<22}{r['requisicoes']:>8}{r['throughput_rps']:>9}"
+              f"{_fmt(r['p50_ms']):>9}{_fmt(r['p95_ms']):>9}{_fmt(r['p99_ms']):>9}{r['taxa_erro']:>8.2%}")
+        if anterior and endpoint in anterior.get('resultados', {}):
+            a = anterior['resultados'][endpoint]
+            print(f"{'  Δ vs anterior':<22}{'':>8}{_delta(r['throughput_rps'], a['throughput_rps']):>9}"
+                  f"{_delta(r['p50_ms'], a['p50_ms']):>9}{_delta(r['p95_ms'], a['p95_ms']):>9}"
+                  f"{_delta(r['p99_ms'], a['p99_ms']):>9}")
+    atraso = resultados['atraso_agendamento']
+    print(f"\nAtraso de agendamento p95: {_fmt(atraso['p95_ms'])} ms "
+          f"(alto = o gerador de carga, e não o servidor, está saturado)")
+    if relatorio['db_conexoes']:
+        print(f"Conexões no Postgres: {relatorio['db_conexoes']}")
+
+
+def _fmt(valor):
+    return f"{valor:.1f}" if valor is not None else '-'
+
+
+def _delta(atual, anterior):
+    if atual is None or not anterior:
+        return '-'
+    return f"{(atual - anterior) / anterior:+.0%}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    alvo = parser.add_mutually_exclusive_group(required=True)
+    alvo.add_argument('--url', help='URL base do servidor (ex: http://localhost:5000)')
+    alvo.add_argument('--in-process', action='store_true', help='usa o test client do Flask no próprio processo')
+    parser.add_argument('--devices', type=int, default=100, help='número de dispositivos simulados')
+    parser.add_argument('--duration', type=float, default=60, help='duração do teste em segundos')
+    parser.add_argument('--poll-interval', type=float, default=5, help='intervalo entre polls de cada dispositivo')
+    parser.add_argument('--follow-hints', action='store_true',
+                        help='cada dispositivo espera o poll_apos da resposta (o intervalo fixo só sem dica)')
+    parser.add_argument('--heartbeat-interval', type=float, default=60, help='intervalo entre heartbeats')
+    parser.add_argument('--ramp-up', type=float, default=10, help='segundos para todos os dispositivos entrarem')
+    parser.add_argument('--concurrency', type=int, default=64, help='threads do gerador de carga')
+    parser.add_argument('--timeout', type=float, default=30, help='timeout de cada requisição HTTP')
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL'),
+                        help='Postgres para contar conexões (padrão: $DATABASE_URL)')
+    parser.add_argument('--output', help='arquivo JSON de saída (padrão: benchmarks/results/devices-<data>.json)')
+    parser.add_argument('--compare', help='JSON de uma execução anterior para comparar')
+    args = parser.parse_args()
+
+    relatorio = executar(args)
+
+    anterior = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            anterior = json.load(f)
+    imprimir(relatorio, anterior)
+
+    saida = args.output
+    if not saida:
+        os.makedirs(PASTA_RESULTADOS, exist_ok=True)
+        saida = os.path.join(PASTA_RESULTADOS, f"devices-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(saida, 'w', encoding='utf-8') as f:
+        json.dump(relatorio, f, indent=2, ensure_ascii=False)
+    print(f"\n💾 Resultado salvo em {saida}")
+
+
+if __name__ == '__main__':
+    main()
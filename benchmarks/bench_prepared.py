@@ -0,0 +1,157 @@
+"""
+Latência dos comandos quentes: SQL direto (parse + plano a cada chamada)
+contra o mesmo comando preparado (EXECUTE), como o PostgresStorage faz.
+
+Usa os textos de storage.PREPARADOS numa conexão própria. Cada execução
+roda na sua transação e é desfeita (rollback): o banco não é alterado.
+Mostra p50/p95/média de cada comando nos dois modos e o tempo de
+planejamento do servidor (EXPLAIN SUMMARY), e grava tudo em JSON para
+comparar execuções.
+
+Exemplos:
+    DATABASE_URL=postgresql://localhost/loop_playlist python benchmarks/bench_prepared.py
+    python benchmarks/bench_prepared.py --iterations 5000 --compare benchmarks/results/anterior.json
+"""
+import os
+import re
+import sys
+import json
+import time
+import argparse
+import datetime
+
+import psycopg2
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+
+from storage import PREPARADOS, textos_preparados  # noqa: E402
+from bench_devices import PASTA_RESULTADOS, percentil, _arred, _commit_atual, _fmt, _delta  # noqa: E402
+
+MODOS = ('direto', 'preparado')
+
+
+def parametros(cur):
+    """Valores de exemplo para cada comando, tirados da fila (ou fictícios se estiver vazia)"""
+    cur.execute("SELECT id, COALESCE(track_id, 'bench') FROM playlist ORDER BY id LIMIT 1")
+    row = cur.fetchone()
+    musica_id, track_id = row if row else (-1, 'bench')
+    return {
+        'heartbeat': ('bench-prepared',),
+        'contar_dispositivos': (60,),
+        'musica_em_execucao': None,
+        'atualizar_musica': (0, 0, 'Pendente', musica_id),
+        'somar_plays_fila': (1, 1, 1, None, musica_id),
+        'somar_plays_controle': (1, track_id),
+        'somar_plays_diarios': (track_id, 1, 1),
+    }
+
+
+def tempo_planejamento(cur, nome, params):
+    """Planning Time (ms) informado pelo servidor para o SQL direto"""
+    sql = PREPARADOS[nome][1]
+    cur.execute('EXPLAIN (SUMMARY) ' + sql, params)
+    texto = '\n'.join(row[0] for row in cur.fetchall())
+    achado = re.search(r'Planning Time: ([\d.]+) ms', texto)
+    return float(achado.group(1)) if achado else None
+
+
+def executar(args):
+    conn = psycopg2.connect(args.database_url)
+    cur = conn.cursor()
+    valores = parametros(cur)
+    conn.rollback()
+
+    textos = {nome: textos_preparados(nome) for nome in PREPARADOS}
+    for prepare, _, _ in textos.values():
+        cur.execute(prepare)
+    conn.commit()
+
+    resultados = {}
+    for nome in PREPARADOS:
+        params = valores.get(nome)
+        if nome not in valores:
+            print(f"⚠️ Sem parâmetros de exemplo para {nome}, pulando")
+            continue
+        _, execucao, direto = textos[nome]
+        sql = {'direto': direto, 'preparado': execucao}
+        latencias = {modo: [] for modo in MODOS}
+        for i in range(args.warmup + args.iterations):
+            # Alterna a ordem para nenhum modo ficar sempre com o cache mais quente
+            for modo in (MODOS if i % 2 == 0 else MODOS[::-1]):
+                t0 = time.perf_counter()
+                cur.execute(sql[modo], params)
+                if cur.description:
+                    cur.fetchall()
+                duracao_ms = (time.perf_counter() - t0) * 1000
+                conn.rollback()
+                if i >= args.warmup:
+                    latencias[modo].append(duracao_ms)
+
+        resultado = {}
+        for modo in MODOS:
+            ordenadas = sorted(latencias[modo])
+            resultado[modo] = {
+                "p50_ms": _arred(percentil(ordenadas, 50)),
+                "p95_ms": _arred(percentil(ordenadas, 95)),
+                "media_ms": _arred(sum(ordenadas) / len(ordenadas)) if ordenadas else None
+            }
+        resultado['planejamento_ms'] = tempo_planejamento(cur, nome, params)
+        conn.rollback()
+        resultados[nome] = resultado
+
+    conn.close()
+    return {
+        "data": datetime.datetime.now().isoformat(),
+        "commit": _commit_atual(),
+        "parametros": {"iteracoes": args.iterations, "aquecimento": args.warmup},
+        "resultados": resultados
+    }
+
+
+def imprimir(relatorio, anterior=None):
+    print(f"\n{'comando':<24}{'direto p50':>12}{'prep. p50':>12}{'direto p95':>12}{'prep. p95':>12}"
+          f"{'ganho p50':>11}{'plano':>9}")
+    for nome, r in relatorio['resultados'].items():
+        direto, preparado = r['direto'], r['preparado']
+        print(f"{nome:<24}{_fmt(direto['p50_ms']):>12}{_fmt(preparado['p50_ms']):>12}"
+              f"{_fmt(direto['p95_ms']):>12}{_fmt(preparado['p95_ms']):>12}"
+              f"{_delta(preparado['p50_ms'], direto['p50_ms']):>11}{_fmt(r['planejamento_ms']):>9}")
+        if anterior and nome in anterior.get('resultados', {}):
+            a = anterior['resultados'][nome]
+            print(f"{'  Δ vs anterior':<24}{_delta(direto['p50_ms'], a['direto']['p50_ms']):>12}"
+                  f"{_delta(preparado['p50_ms'], a['preparado']['p50_ms']):>12}"
+                  f"{_delta(direto['p95_ms'], a['direto']['p95_ms']):>12}"
+                  f"{_delta(preparado['p95_ms'], a['preparado']['p95_ms']):>12}")
+    print("\n(latências em ms por chamada, com ida e volta ao banco; 'plano' = Planning Time do SQL direto)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database-url', default=os.environ.get('DATABASE_URL', 'postgresql://localhost/loop_playlist'),
+                        help='Postgres com o esquema do LooP (padrão: $DATABASE_URL)')
+    parser.add_argument('--iterations', type=int, default=2000, help='execuções medidas de cada comando por modo')
+    parser.add_argument('--warmup', type=int, default=100, help='execuções iniciais descartadas')
+    parser.add_argument('--output', help='arquivo JSON de saída (padrão: benchmarks/results/prepared-<data>.json)')
+    parser.add_argument('--compare', help='JSON de uma execução anterior para comparar')
+    args = parser.parse_args()
+
+    relatorio = executar(args)
+
+    anterior = None
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            anterior = json.load(f)
+    imprimir(relatorio, anterior)
+
+    saida = args.output
+    if not saida:
+        os.makedirs(PASTA_RESULTADOS, exist_ok=True)
+        saida = os.path.join(PASTA_RESULTADOS, f"prepared-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(saida, 'w', encoding='utf-8') as f:
+        json.dump(relatorio, f, indent=2, ensure_ascii=False)
+    print(f"\n💾 Resultado salvo em {saida}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+"""
+Simulador do motor de automação com relógio virtual.
+
+Roda a mesma lógica de agendamento do servidor (motor.Motor) contra o
+MemoryStorage e um relógio virtual: um dia inteiro de fila, com a
+disponibilidade de dispositivos variando segundo um roteiro, leva segundos.
+Ao final mostra quando cada entrada da fila foi concluída e os totais do
+motor, e grava tudo em JSON para comparar execuções.
+
+Exemplos:
+    # Fila de exemplo com 150 dispositivos por 24h a partir das 08:00 (Brasília)
+    python benchmarks/simulate_motor.py --devices 150
+
+    # Cenário em arquivo (fila, roteiro de dispositivos, config)
+    python benchmarks/simulate_motor.py --scenario cenario.json
+
+    # Falha (código 1) se o resultado mudou em relação a uma execução anterior
+    python benchmarks/simulate_motor.py --scenario cenario.json --compare benchmarks/results/anterior.json
+
+Formato do cenário (todos os campos são opcionais):
+    {
+      "inicio": "2026-10-19T08:00",            # horário de Brasília
+      "duracao_horas": 24,
+      "config": {"quantidade_aparelhos": 150, "reset_automatico": 1},
+      "fila": [
+        {"nome": "Artista - Música", "plays_desejados": 600, "duracao_min": 3.2,
+         "track_id": "abc", "meta_mensal": 18000}
+      ],
+      "dispositivos": [[0, 150], [4.5, 90], [13, 0], [13.5, 150]],  # [horas desde o início, quantidade]
+      "heartbeat_intervalo_seg": 60
+    }
+"""
+import os
+import sys
+import json
+import heapq
+import argparse
+import datetime
+import subprocess
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASTA_RESULTADOS = os.path.join(RAIZ, 'benchmarks', 'results')
+sys.path.insert(0, RAIZ)
+
+from storage import MemoryStorage, STATUS_CONCLUIDO  # noqa: E402
+from config import ConfigService, CONFIG_SCHEMA  # noqa: E402
+from motor import Motor, FUSO_BRASILIA, DEVICE_TIMEOUT_SECONDS  # noqa: E402
+
+# Mesmos valores do app.py
+ARQUIVAMENTO_INTERVALO_SEG = 60
+ESPERA_APOS_ERRO_SEG = 15
+
+# Prioridade dos eventos que caem no mesmo instante
+EVENTO_DISPOSITIVOS, EVENTO_HEARTBEAT, EVENTO_MOTOR, EVENTO_ARQUIVAMENTO = range(4)
+
+FILA_EXEMPLO = [
+    {"nome": "Exemplo - Faixa 1", "plays_desejados": 900, "duracao_min": 3.0, "track_id": "faixa1", "meta_mensal": 27000},
+    {"nome": "Exemplo - Faixa 2", "plays_desejados": 600, "duracao_min": 2.5, "track_id": "faixa2", "meta_mensal": 18000},
+    {"nome": "Exemplo - Faixa 3", "plays_desejados": 450, "duracao_min": 4.0, "track_id": "faixa3", "meta_mensal": 13500},
+]
+
+
+class RelogioVirtual:
+    """Relógio UTC (sem fuso) que só avança quando o simulador manda"""
+
+    def __init__(self, inicio):
+        self.agora = inicio
+
+    def __call__(self):
+        return self.agora
+
+
+def carregar_cenario(args):
+    cenario = {}
+    if args.scenario:
+        with open(args.scenario, encoding='utf-8') as f:
+            cenario = json.load(f)
+    if args.start:
+        cenario['inicio'] = args.start
+    if args.hours is not None:
+        cenario['duracao_horas'] = args.hours
+    if args.devices is not None:
+        cenario['dispositivos'] = [[0, args.devices]]
+    cenario.setdefault('inicio', '2026-10-19T08:00')
+    cenario.setdefault('duracao_horas', 24)
+    cenario.setdefault('config', {})
+    cenario.setdefault('fila', FILA_EXEMPLO)
+    cenario.setdefault('dispositivos', [[0, 150]])
+    return cenario
+
+
+def popular_fila(storage, fila):
+    for item in fila:
+        if item.get('track_id'):
+            storage.salvar_validacao({
+                "musica": {
+                    "track_id": item['track_id'], "nome": item['nome'],
+                    "duracao": item['duracao_min'], "meta_mensal": item.get('meta_mensal', 0)
+                },
+                "entradas": [{
+                    "link_musica": item.get('link', f"https://open.spotify.com/track/{item['track_id']}"),
+                    "nome_musica": item['nome'],
+                    "plays_desejados": item['plays_desejados'],
+                    "duracao_min": item['duracao_min'],
+                    "track_id": item['track_id'],
+                    "playlist_id": item.get('playlist_id')
+                }],
+                "playlists_encontradas": []
+            })
+        else:
+            storage.salvar_musica(item.get('link', ''), item['nome'], item['plays_desejados'], item['duracao_min'])
+
+
+def simular(cenario, verbose=False):
+    inicio_brasilia = datetime.datetime.fromisoformat(cenario['inicio'])
+    relogio = RelogioVirtual(inicio_brasilia - FUSO_BRASILIA)
+    inicio = relogio.agora
+    fim = inicio + datetime.timedelta(hours=cenario['duracao_horas'])
+
+    storage = MemoryStorage(relogio)
+    config_service = ConfigService(storage, CONFIG_SCHEMA, 0)
+    storage.inicializar(config_service.padroes())
+    if cenario['config']:
+        config_service.atualizar(cenario['config'])
+    popular_fila(storage, cenario['fila'])
+
+    log = (lambda mensagem: print(mensagem)) if verbose else (lambda mensagem: None)
+    motor = Motor(storage, config_service, DEVICE_TIMEOUT_SECONDS, relogio=relogio, log=log)
+
+    agenda = []
+    sequencia = 0
+
+    def agendar(quando, prioridade, dados=None):
+        nonlocal sequencia
+        sequencia += 1
+        heapq.heappush(agenda, (quando, prioridade, sequencia, dados))
+
+    for horas, quantidade in cenario['dispositivos']:
+        agendar(inicio + datetime.timedelta(hours=horas), EVENTO_DISPOSITIVOS, quantidade)
+    # Como o app.motor_automacao: o primeiro ciclo vem depois do que faltar de um ciclo interrompido
+    agendar(inicio + datetime.timedelta(seconds=motor.retomar()), EVENTO_MOTOR)
+    agendar(inicio + datetime.timedelta(seconds=ARQUIVAMENTO_INTERVALO_SEG), EVENTO_ARQUIVAMENTO)
+
+    online = 0
+    heartbeat_agendado = False
+    erros_motor = 0
+    status_anterior = {}
+    conclusoes = []
+    intervalo_heartbeat = datetime.timedelta(seconds=cenario.get('heartbeat_intervalo_seg', 60))
+
+    while agenda and agenda[0][0] < fim:
+        quando, prioridade, _, dados = heapq.heappop(agenda)
+        relogio.agora = quando
+
+        if prioridade == EVENTO_DISPOSITIVOS:
+            # Dispositivos que saem param de mandar heartbeat e expiram pelo timeout
+            online = dados
+            if online and not heartbeat_agendado:
+                heartbeat_agendado = True
+                agendar(quando, EVENTO_HEARTBEAT)
+
+        elif prioridade == EVENTO_HEARTBEAT:
+            for n in range(online):
+                storage.registrar_heartbeat(f"sim-{n}")
+            heartbeat_agendado = bool(online)
+            if online:
+                agendar(quando + intervalo_heartbeat, EVENTO_HEARTBEAT)
+
+        elif prioridade == EVENTO_MOTOR:
+            try:
+                espera = motor.passo()
+            except Exception as e:
+                log(f"ERRO NO MOTOR: {e}")
+                erros_motor += 1
+                espera = ESPERA_APOS_ERRO_SEG
+            for m in storage.carregar_playlist():
+                if m['status'] == STATUS_CONCLUIDO and status_anterior.get(m['id']) != STATUS_CONCLUIDO:
+                    conclusoes.append({
+                        "id": m['id'],
+                        "nome": m['nome_musica'],
+                        "track_id": m['track_id'],
+                        "plays": m['plays_atuais'],
+                        "concluida_em": (quando + FUSO_BRASILIA).isoformat(),
+                        "horas_desde_inicio": round((quando - inicio).total_seconds() / 3600, 3)
+                    })
+                status_anterior[m['id']] = m['status']
+            agendar(quando + datetime.timedelta(seconds=espera), EVENTO_MOTOR)
+
+        else:
+            # As concluídas saem da fila; se o reset as reativar, voltam com o mesmo id
+            for id in [id for id, status in status_anterior.items() if status == STATUS_CONCLUIDO]:
+                del status_anterior[id]
+            storage.arquivar_concluidas()
+            agendar(quando + datetime.timedelta(seconds=ARQUIVAMENTO_INTERVALO_SEG), EVENTO_ARQUIVAMENTO)
+
+    relogio.agora = fim
+    pendentes = [
+        {"id": m['id'], "nome": m['nome_musica'], "status": m['status'],
+         "plays": m['plays_atuais'], "plays_desejados": m['plays_desejados']}
+        for m in storage.carregar_playlist() if m['status'] != STATUS_CONCLUIDO
+    ]
+
+    return {
+        "cenario": cenario,
+        "contadores": {**motor.contadores, "erros": erros_motor},
+        "conclusoes": conclusoes,
+        "pendentes_ao_final": pendentes,
+        "plays_hoje_por_track": storage.plays_hoje_por_track(),
+        "config_final": config_service.snapshot()
+    }
+
+
+def _commit_atual():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except Exception:
+        return None
+
+
+def comparar(resultado, anterior):
+    """Diferenças nos campos determinísticos (lista vazia = mesmo comportamento)"""
+    diferencas = []
+    for chave in ('contadores', 'conclusoes', 'pendentes_ao_final', 'plays_hoje_por_track'):
+        if resultado[chave] != anterior.get(chave):
+            diferencas.append(chave)
+    return diferencas
+
+
+def imprimir(resultado):
+    print(f"\n{'concluída em':<22}{'h':>8}{'plays':>8}  entrada")
+    for c in resultado['conclusoes']:
+        print(f"{c['concluida_em']:<22}{c['horas_desde_inicio']:>8.2f}{c['plays']:>8}  #{c['id']} {c['nome']}")
+    for p in resultado['pendentes_ao_final']:
+        print(f"{'(não concluída)':<22}{'':>8}{p['plays']:>8}  #{p['id']} {p['nome']} "
+              f"({p['plays']}/{p['plays_desejados']}, {p['status']})")
+    print("\nTotais do motor: " + ", ".join(f"{k}={v}" for k, v in resultado['contadores'].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scenario', help='arquivo JSON com fila, roteiro de dispositivos e config')
+    parser.add_argument('--devices', type=int, help='dispositivos constantes (substitui o roteiro do cenário)')
+    parser.add_argument('--start', help='início da simulação, horário de Brasília (ex: 2026-10-19T08:00)')
+    parser.add_argument('--hours', type=float, help='duração simulada em horas')
+    parser.add_argument('--verbose', action='store_true', help='mostra o log do motor (com o horário virtual)')
+    parser.add_argument('--output', help='arquivo JSON de saída (padrão: benchmarks/results/simulacao-<data>.json)')
+    parser.add_argument('--compare', help='JSON de uma simulação anterior; sai com código 1 se o resultado mudou')
+    args = parser.parse_args()
+
+    resultado = simular(carregar_cenario(args), verbose=args.verbose)
+    imprimir(resultado)
+
+    relatorio = {"data": datetime.datetime.now().isoformat(), "commit": _commit_atual(), **resultado}
+    saida = args.output
+    if not saida:
+        os.makedirs(PASTA_RESULTADOS, exist_ok=True)
+        saida = os.path.join(PASTA_RESULTADOS, f"simulacao-{datetime.datetime.now():%Y%m%d-%H%M%S}.json")
+    with open(saida, 'w', encoding='utf-8') as f:
+        json.dump(relatorio, f, indent=2, ensure_ascii=False)
+    print(f"\n💾 Resultado salvo em {saida}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            anterior = json.load(f)
+        diferencas = comparar(resultado, anterior)
+        if diferencas:
+            print(f"❌ Resultado diferente de {args.compare}: {', '.join(diferencas)}")
+            sys.exit(1)
+        print(f"✅ Mesmo resultado de {args.compare}")
+
+
+if __name__ == '__main__':
+    main()
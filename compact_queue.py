@@ -0,0 +1,16 @@
+"""
+Funde entradas duplicadas da fila (mesmo track_id e playlist_id).
+
+Roda sozinho na primeira inicialização depois da criação do índice único;
+use este script para rodar de novo manualmente:
+
+    DATABASE_URL=postgresql://... python compact_queue.py
+"""
+import os
+
+from storage import criar_storage
+
+if __name__ == '__main__':
+    storage = criar_storage(dsn=os.environ.get('DATABASE_URL', 'postgresql://localhost/loop_playlist'))
+    resultado = storage.compactar_duplicadas()
+    print(f"🧹 {resultado['removidas']} entradas duplicadas fundidas em {resultado['grupos']} grupos.")
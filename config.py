@@ -0,0 +1,114 @@
+"""
+Configuração do LooP: esquema das chaves da tabela config e o cache em
+memória usado pela aplicação e pelo simulador.
+"""
+import time
+import threading
+import logging
+
+logger = logging.getLogger('loop.config')
+
+# Esquema da config: chave -> (tipo, valor padrão, validador)
+CONFIG_SCHEMA = {
+    "quantidade_aparelhos": (int, 200, lambda v: v >= 1),
+    "reset_automatico": (int, 1, lambda v: v in (0, 1)), # 1 = Sim, 0 = Não
+    "last_reset_date": (str, "", None)
+}
+
+
+class ConfigService:
+    """
+    Cache em memória da tabela config.
+    Leituras não vão ao banco; a cada intervalo_verificacao segundos no máximo uma consulta
+    leve compara a versão do banco e só então recarrega todas as chaves.
+    """
+    
+    def __init__(self, storage, schema, intervalo_verificacao):
+        self._storage = storage
+        self._schema = schema
+        self._intervalo = intervalo_verificacao
+        self._lock = threading.Lock()
+        self._versao = None
+        self._verificado_em = 0.0
+        
+        # Os padrões são validados uma única vez, na criação do serviço
+        self._valores = {}
+        for chave, (tipo, padrao, validador) in schema.items():
+            self._valores[chave] = self.converter(chave, padrao)
+    
+    def converter(self, chave, valor):
+        """Converte e valida um valor segundo o esquema (ValueError se inválido)"""
+        if chave not in self._schema:
+            raise ValueError(f"Configuração desconhecida: {chave}")
+        tipo, padrao, validador = self._schema[chave]
+        try:
+            convertido = tipo(valor)
+        except (TypeError, ValueError):
+            raise ValueError(f"Valor inválido para {chave}: {valor!r}")
+        if validador and not validador(convertido):
+            raise ValueError(f"Valor fora do permitido para {chave}: {valor!r}")
+        return convertido
+    
+    def _recarregar(self):
+        """Compara a versão do banco e recarrega se mudou (chamado com o lock adquirido)"""
+        if self._storage.ler_versao_config() == self._versao:
+            return
+        
+        versao, brutos = self._storage.carregar_config()
+        valores = dict(self._valores)
+        for chave, valor in brutos.items():
+            if chave not in self._schema:
+                continue
+            try:
+                valores[chave] = self.converter(chave, valor)
+            except ValueError as e:
+                logger.warning(f"⚠️ Config ignorada no banco: {e}")
+        self._valores = valores
+        self._versao = versao
+    
+    def _verificar(self):
+        agora = time.monotonic()
+        if agora - self._verificado_em < self._intervalo:
+            return
+        with self._lock:
+            if agora - self._verificado_em < self._intervalo:
+                return
+            try:
+                self._recarregar()
+            except Exception as e:
+                # Mantém os últimos valores conhecidos se o banco estiver indisponível
+                logger.error(f"Erro ao verificar config: {e}")
+            self._verificado_em = time.monotonic()
+    
+    def get(self, chave):
+        self._verificar()
+        return self._valores[chave]
+    
+    def snapshot(self):
+        """Cópia de todas as configurações atuais"""
+        self._verificar()
+        return dict(self._valores)
+    
+    def invalidar(self):
+        """Força a verificação de versão na próxima leitura"""
+        self._verificado_em = 0.0
+    
+    def padroes(self):
+        """Valores padrão em texto, para semear a tabela config"""
+        return {chave: str(padrao) for chave, (tipo, padrao, validador) in self._schema.items()}
+    
+    def atualizar(self, valores):
+        """Grava várias chaves atomicamente e incrementa a versão"""
+        convertidos = {chave: self.converter(chave, valor) for chave, valor in valores.items()}
+        versao = self._storage.salvar_config(convertidos)
+        
+        with self._lock:
+            if self._versao is not None and versao == self._versao + 1:
+                # Nenhuma outra escrita no meio: aplica direto no cache
+                novos = dict(self._valores)
+                novos.update(convertidos)
+                self._valores = novos
+                self._versao = versao
+            else:
+                self._verificado_em = 0.0
+        return convertidos
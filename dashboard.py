@@ -0,0 +1,122 @@
+"""
+Snapshot compartilhado do painel.
+
+O estado do dashboard (dispositivos online, tempos da fila, primeira página
+da fila ativa e estatísticas por música) é calculado uma vez por intervalo
+para o cluster inteiro. O tempo é dividido em baldes de `intervalo` segundos;
+no início de cada balde todos os workers tentam reivindicá-lo no storage e só
+quem conseguir calcula e grava o snapshot. As requisições apenas leem o
+último snapshot gravado: no máximo uma consulta da versão a cada
+LEITURA_MIN_SEG por processo, e o texto só quando a versão muda. Depois de
+uma escrita na fila, invalidar() recalcula e grava por cima do snapshot do
+balde atual; a versão muda e todos os workers passam a servir o novo.
+"""
+import json
+import time
+import threading
+import logging
+
+from metrics import PAINEL_SNAPSHOTS, PAINEL_DURACAO
+
+logger = logging.getLogger('loop.painel')
+
+LEITURA_MIN_SEG = 0.5
+BALDES_TOLERADOS = 3  # snapshot mais velho que isso: ninguém está gerando, calcula na requisição
+
+
+class SnapshotPainel:
+    """
+    `calcular` devolve o estado do painel já serializável em JSON;
+    `relogio` devolve o tempo em segundos (epoch), igual em todos os workers.
+    """
+
+    def __init__(self, storage, calcular, intervalo, nome='painel', relogio=time.time):
+        self._storage = storage
+        self._calcular = calcular
+        self.intervalo = intervalo
+        self.nome = nome
+        self.relogio = relogio
+        self._lock = threading.Lock()
+        self._atual = None
+        self._lido_em = 0.0
+        self._versao = None  # versão do storage correspondente a _atual
+
+    def _balde(self):
+        return int(self.relogio() // self.intervalo)
+
+    def _guardar(self, snapshot):
+        if self._atual is None or snapshot['balde'] >= self._atual['balde']:
+            self._atual = snapshot
+
+    def atualizar(self):
+        """Calcula e grava o snapshot do balde atual se nenhum outro worker o reivindicou"""
+        balde = self._balde()
+        if not self._storage.reivindicar_snapshot(self.nome, balde):
+            return False
+        inicio = time.perf_counter()
+        snapshot = {"balde": balde, "gerado_em": self.relogio(), "dados": self._calcular()}
+        gravado = self._storage.salvar_snapshot(self.nome, balde, json.dumps(snapshot))
+        PAINEL_DURACAO.observe(time.perf_counter() - inicio)
+        PAINEL_SNAPSHOTS.inc()
+        with self._lock:
+            self._guardar(snapshot)
+            if not gravado:
+                # Uma escrita na fila já gravou este balde por cima: a próxima leitura traz aquele
+                self._versao = None
+        return True
+
+    def invalidar(self):
+        """
+        A fila mudou: recalcula agora e grava por cima do snapshot do balde
+        atual, para nenhum worker servir a fila anterior até o próximo balde
+        """
+        try:
+            balde = self._balde()
+            snapshot = {"balde": balde, "gerado_em": self.relogio(), "dados": self._calcular()}
+            self._storage.salvar_snapshot(self.nome, balde, json.dumps(snapshot), substituir=True)
+            PAINEL_SNAPSHOTS.inc()
+        except Exception as e:
+            logger.error(f"Erro ao recalcular snapshot do painel: {e}")
+            return
+        with self._lock:
+            self._guardar(snapshot)
+            self._versao = None
+
+    def _ler(self):
+        """Relê o storage quando a versão gravada muda (novo balde ou gravação por cima)"""
+        with self._lock:
+            if time.monotonic() - self._lido_em < LEITURA_MIN_SEG:
+                return
+            self._lido_em = time.monotonic()
+            try:
+                versao = self._storage.versao_snapshot(self.nome)
+                if versao is None or versao == self._versao:
+                    return
+                texto = self._storage.ler_snapshot(self.nome)
+            except Exception as e:
+                logger.error(f"Erro ao ler snapshot do painel: {e}")
+                return
+            self._versao = versao
+            if texto:
+                self._guardar(json.loads(texto))
+
+    def obter(self):
+        """(dados, idade em segundos) do snapshot mais recente"""
+        self._ler()
+        atual = self._atual
+        if atual is None or self._balde() - atual['balde'] >= BALDES_TOLERADOS:
+            # Gerador parado ou ainda iniciando: quem pediu calcula (uma vez por balde no cluster)
+            if not self.atualizar() and atual is None:
+                dados = self._calcular()
+                return dados, 0.0
+            atual = self._atual
+        return atual['dados'], max(0.0, self.relogio() - atual['gerado_em'])
+
+    def loop(self):
+        """Gera um snapshot no início de cada balde"""
+        while True:
+            try:
+                self.atualizar()
+            except Exception as e:
+                logger.error(f"Erro ao gerar snapshot do painel: {e}")
+            time.sleep(self.intervalo - self.relogio() % self.intervalo)
@@ -0,0 +1,84 @@
+"""
+Exportação em streaming dos conjuntos de storage.EXPORTACOES.
+
+O storage entrega as linhas em lotes (no Postgres, por um cursor nomeado);
+cada lote vira um pedaço de CSV ou um row group de Parquet e é enviado antes
+de buscar o próximo, então a memória usada não depende do tamanho da tabela.
+Parquet precisa do pyarrow.
+"""
+import io
+
+import pandas as pd
+
+FORMATOS = {
+    'csv': 'text/csv; charset=utf-8',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+# Tipos de storage.EXPORTACOES -> nome do tipo no pyarrow
+TIPOS_ARROW = {
+    'texto': 'string',
+    'inteiro': 'int64',
+    'real': 'float64',
+    'data': 'date32',
+    'timestamp': 'timestamp[us]',
+}
+
+
+def parquet_disponivel():
+    try:
+        import pyarrow  # noqa: F401
+        import pyarrow.parquet  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def gerar_csv(lotes, colunas):
+    nomes = [c for c, _ in colunas]
+    yield ','.join(nomes) + '\n'
+    for lote in lotes:
+        # dtype=object: inteiros com NULL no lote não viram float
+        yield pd.DataFrame(lote, columns=nomes, dtype=object).to_csv(index=False, header=False)
+
+
+class _Saida(io.RawIOBase):
+    """Arquivo só de escrita que acumula os bytes até o próximo esvaziar()"""
+
+    def __init__(self):
+        self._partes = []
+        self._posicao = 0
+
+    def writable(self):
+        return True
+
+    def write(self, dados):
+        self._partes.append(bytes(dados))
+        self._posicao += len(dados)
+        return len(dados)
+
+    def tell(self):
+        return self._posicao
+
+    def esvaziar(self):
+        dados = b''.join(self._partes)
+        self._partes = []
+        return dados
+
+
+def gerar_parquet(lotes, colunas):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(c, pa.type_for_alias(TIPOS_ARROW[tipo])) for c, tipo in colunas])
+    saida = _Saida()
+    with pq.ParquetWriter(saida, schema) as escritor:
+        for lote in lotes:
+            # Um row group por lote
+            escritor.write_table(pa.Table.from_pylist(lote, schema=schema))
+            yield saida.esvaziar()
+    yield saida.esvaziar()
+
+
+def gerar(formato, lotes, colunas):
+    return gerar_parquet(lotes, colunas) if formato == 'parquet' else gerar_csv(lotes, colunas)
@@ -0,0 +1,260 @@
+"""
+Gateway assíncrono dos dispositivos do LooP.
+
+Serve os endpoints de polling dos dispositivos (/api/current_link,
+/api/heartbeat, /api/devices_count) com asyncio + asyncpg, no mesmo banco e
+esquema do app Flask. Um processo segura milhares de conexões abertas:
+
+- o link atual e a contagem de dispositivos ficam em cache por LINK_CACHE_SEG,
+  e só uma consulta por vez vai ao banco quando o cache expira;
+- os heartbeats são acumulados e gravados em lote a cada HEARTBEAT_FLUSH_SEG,
+  num único INSERT ... ON CONFLICT.
+
+    uvicorn gateway:app --host 0.0.0.0 --port 8000 --workers 2
+
+O esquema é criado pelo app Flask (storage.inicializar); o gateway só lê e
+grava heartbeats.
+"""
+import os
+import time
+import uuid
+import logging
+import asyncio
+import contextlib
+
+import asyncpg
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, Response
+from starlette.routing import Route
+
+from storage import STATUS_EXECUCAO
+from motor import dica_polling, DEVICE_TIMEOUT_SECONDS
+from metrics import registrar_requisicao, gerar_metricas, HEARTBEATS
+import logs
+
+logs.configurar()
+logger = logging.getLogger('loop.gateway')
+log_dispositivos = logging.getLogger('loop.dispositivos')  # amostrado (logs.LOG_AMOSTRAGEM)
+
+DATABASE_URL = os.environ.get('DATABASE_URL', 'postgresql://localhost/loop_playlist')
+GATEWAY_POOL_MIN = int(os.environ.get('GATEWAY_POOL_MIN', 1))
+GATEWAY_POOL_MAX = int(os.environ.get('GATEWAY_POOL_MAX', 10))
+GATEWAY_COMMAND_TIMEOUT = float(os.environ.get('GATEWAY_COMMAND_TIMEOUT', 10))
+LINK_CACHE_SEG = float(os.environ.get('LINK_CACHE_SEG', 1))
+HEARTBEAT_FLUSH_SEG = float(os.environ.get('HEARTBEAT_FLUSH_SEG', 1))
+
+LINK_VAZIO = {"link": "", "duracao_min": 3.0, "nome": "", "timestamp": 0}
+
+
+class CacheCurto:
+    """
+    Valor em cache por `validade` segundos. Quando expira, só a primeira
+    corrotina consulta o banco; as demais aguardam e reutilizam o resultado.
+    """
+
+    def __init__(self, carregar, validade):
+        self._carregar = carregar
+        self._validade = validade
+        self._lock = asyncio.Lock()
+        self._valor = None
+        self._expira_em = 0.0
+
+    async def obter(self):
+        if time.monotonic() < self._expira_em:
+            return self._valor
+        async with self._lock:
+            if time.monotonic() < self._expira_em:
+                return self._valor
+            self._valor = await self._carregar()
+            self._expira_em = time.monotonic() + self._validade
+            return self._valor
+
+
+class Heartbeats:
+    """Acumula os device_id recebidos e grava todos de uma vez"""
+
+    def __init__(self):
+        self._pendentes = set()
+
+    def __len__(self):
+        return len(self._pendentes)
+
+    def registrar(self, device_id):
+        self._pendentes.add(device_id)
+        HEARTBEATS.inc()
+
+    async def gravar(self, pool):
+        if not self._pendentes:
+            return 0
+        lote, self._pendentes = self._pendentes, set()
+        try:
+            # Ordenado para que dois workers nunca travem as mesmas linhas em ordens diferentes
+            await pool.execute('''
+                INSERT INTO devices (device_id, last_seen)
+                SELECT unnest($1::text[]), CURRENT_TIMESTAMP
+                ON CONFLICT (device_id) DO UPDATE SET last_seen = CURRENT_TIMESTAMP
+            ''', sorted(lote))
+        except Exception:
+            # Devolve o lote para a próxima tentativa
+            self._pendentes |= lote
+            raise
+        return len(lote)
+
+    async def loop(self, pool):
+        while True:
+            await asyncio.sleep(HEARTBEAT_FLUSH_SEG)
+            try:
+                await self.gravar(pool)
+            except Exception as e:
+                logger.error(f"Erro ao gravar heartbeats: {e}")
+
+
+class Gateway:
+    def __init__(self):
+        self.pool = None
+        self.heartbeats = Heartbeats()
+        self.link = CacheCurto(self._ler_link, LINK_CACHE_SEG)
+        self.dispositivos = CacheCurto(self._contar_dispositivos, LINK_CACHE_SEG)
+        self._tarefa_heartbeats = None
+
+    async def iniciar(self):
+        self.pool = await asyncpg.create_pool(
+            DATABASE_URL, min_size=GATEWAY_POOL_MIN, max_size=GATEWAY_POOL_MAX,
+            command_timeout=GATEWAY_COMMAND_TIMEOUT
+        )
+        self._tarefa_heartbeats = asyncio.create_task(self.heartbeats.loop(self.pool))
+        logger.info(f"✅ Gateway pronto (pool {GATEWAY_POOL_MIN}-{GATEWAY_POOL_MAX})")
+
+    async def encerrar(self):
+        if self._tarefa_heartbeats:
+            self._tarefa_heartbeats.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._tarefa_heartbeats
+        if self.pool:
+            try:
+                await self.heartbeats.gravar(self.pool)
+            except Exception as e:
+                logger.warning(f"⚠️ Heartbeats perdidos no encerramento: {e}")
+            await self.pool.close()
+
+    async def _ler_link(self):
+        return await self.pool.fetchrow('''
+            SELECT link_musica, duracao_min, nome_musica, proxima_troca FROM playlist
+            WHERE status = $1 ORDER BY id LIMIT 1
+        ''', STATUS_EXECUCAO)
+
+    async def _contar_dispositivos(self):
+        return await self.pool.fetchval('''
+            SELECT COUNT(*) FROM devices
+            WHERE last_seen > NOW() - make_interval(secs => $1)
+        ''', float(DEVICE_TIMEOUT_SECONDS))
+
+
+gateway = Gateway()
+
+
+# --- ENDPOINTS ---
+async def api_current_link(request):
+    """Mesmo contrato do /api/current_link do app Flask"""
+    gateway.heartbeats.registrar(request.query_params.get('device_id', 'unknown'))
+    try:
+        m = await gateway.link.obter()
+        if m:
+            proxima_troca, poll_apos = dica_polling(m['proxima_troca'], time.time())
+            return JSONResponse({
+                "link": m['link_musica'],
+                "duracao_min": float(m['duracao_min']),
+                "nome": m['nome_musica'],
+                "timestamp": int(time.time()),
+                "proxima_troca": proxima_troca,
+                "poll_apos": poll_apos
+            })
+    except Exception as e:
+        logger.error(f"Erro ao buscar link: {e}")
+    return JSONResponse({**LINK_VAZIO, "proxima_troca": None, "poll_apos": dica_polling(None, time.time())[1]})
+
+
+async def api_heartbeat(request):
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    gateway.heartbeats.registrar((data or {}).get('device_id', 'unknown'))
+    return JSONResponse({"status": "ok"})
+
+
+async def api_devices_count(request):
+    try:
+        count = await gateway.dispositivos.obter()
+    except Exception as e:
+        return JSONResponse({"status": "error", "message": str(e)}, status_code=500)
+    return JSONResponse({"count": count})
+
+
+async def api_metrics(request):
+    corpo, content_type = gerar_metricas()
+    return Response(corpo, headers={'Content-Type': content_type})
+
+
+async def saude(request):
+    return JSONResponse({"status": "ok", "heartbeats_pendentes": len(gateway.heartbeats)})
+
+
+class MedirRequisicoes:
+    """Middleware ASGI: mesmas métricas HTTP, request id e log de acesso do app Flask"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        inicio = time.perf_counter()
+        status = 500
+        cabecalhos = dict(scope.get('headers') or [])
+        request_id = (cabecalhos.get(b'x-request-id', b'').decode('latin-1') or uuid.uuid4().hex)[:64]
+        token = logs.definir_request_id(request_id)
+
+        async def enviar(mensagem):
+            nonlocal status
+            if mensagem['type'] == 'http.response.start':
+                status = mensagem['status']
+                mensagem['headers'] = list(mensagem.get('headers', [])) + [(b'x-request-id', request_id.encode('latin-1'))]
+            await send(mensagem)
+
+        try:
+            await self.app(scope, receive, enviar)
+        finally:
+            rota = scope['path'] if scope['path'] in ROTAS else 'desconhecida'
+            duracao = time.perf_counter() - inicio
+            registrar_requisicao(rota, scope['method'], status, duracao)
+            log_dispositivos.info(
+                f"{scope['method']} {rota} {status}",
+                extra={'campos': {
+                    "metodo": scope['method'], "rota": rota, "status": status,
+                    "duracao_ms": round(duracao * 1000, 2)
+                }}
+            )
+            logs.limpar_request_id(token)
+
+
+routes = [
+    Route('/api/current_link', api_current_link),
+    Route('/api/heartbeat', api_heartbeat, methods=['POST']),
+    Route('/api/devices_count', api_devices_count),
+    Route('/metrics', api_metrics),
+    Route('/health', saude),
+]
+ROTAS = {r.path for r in routes}
+
+
+@contextlib.asynccontextmanager
+async def ciclo_de_vida(app):
+    await gateway.iniciar()
+    try:
+        yield
+    finally:
+        await gateway.encerrar()
+
+
+app = MedirRequisicoes(Starlette(routes=routes, lifespan=ciclo_de_vida))
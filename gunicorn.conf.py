@@ -0,0 +1,17 @@
+"""Hooks do gunicorn (lido automaticamente de ./gunicorn.conf.py)"""
+import os
+import shutil
+
+
+def on_starting(server):
+    # Limpa as amostras de execuções anteriores das métricas multiprocesso
+    pasta = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+    if pasta:
+        shutil.rmtree(pasta, ignore_errors=True)
+        os.makedirs(pasta, exist_ok=True)
+
+
+def child_exit(server, worker):
+    # Worker encerrado: descarta seus gauges 'live' do agregado do /metrics
+    import metrics
+    metrics.processo_encerrado(worker.pid)
@@ -0,0 +1,192 @@
+"""
+Logs estruturados do LooP.
+
+configurar() troca os handlers do logger raiz por um QueueHandler: quem loga
+(requisições, motor, jobs) só enfileira o registro, e uma thread
+(QueueListener) formata e escreve no stdout. Com a fila cheia o registro é
+descartado e contado em loop_log_records_dropped_total, sem bloquear.
+
+Cada registro sai como uma linha JSON (LOG_FORMATO=texto para ler no
+terminal) com o request_id da requisição atual e os campos passados em
+extra={'campos': {...}}. Mensagens frequentes são amostradas por logger:
+LOG_AMOSTRAGEM="loop.dispositivos=100,loop.motor.ciclo=10" mantém 1 de cada
+N registros abaixo de WARNING (vale também para os loggers filhos).
+"""
+import os
+import sys
+import copy
+import json
+import queue
+import atexit
+import logging
+import datetime
+import itertools
+import threading
+import contextvars
+import logging.handlers
+
+from metrics import LOGS_DESCARTADOS
+
+LOG_NIVEL = os.environ.get('LOG_NIVEL', 'INFO').upper()
+LOG_FORMATO = os.environ.get('LOG_FORMATO', 'json')
+LOG_FILA_MAX = int(os.environ.get('LOG_FILA_MAX', 10000))
+LOG_AMOSTRAGEM = os.environ.get('LOG_AMOSTRAGEM', 'loop.dispositivos=100,loop.motor.ciclo=10')
+
+_request_id = contextvars.ContextVar('request_id', default=None)
+
+# Atributos de todo LogRecord: o resto veio de extra= e não é repetido no JSON
+_ATRIBUTOS_PADRAO = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+def definir_request_id(request_id):
+    """Associa os logs seguintes deste contexto (thread/tarefa) à requisição; devolve o token para limpar"""
+    return _request_id.set(request_id)
+
+
+def limpar_request_id(token):
+    try:
+        _request_id.reset(token)
+    except ValueError:
+        # Token de outro contexto (ex: resposta em streaming terminada em outra thread)
+        _request_id.set(None)
+
+
+def request_id_atual():
+    return _request_id.get()
+
+
+def ler_amostragem(texto):
+    """'a=100,b.c=10' -> {'a': 100, 'b.c': 10}"""
+    regras = {}
+    for parte in texto.split(','):
+        if '=' not in parte:
+            continue
+        nome, n = parte.split('=', 1)
+        if int(n) > 1:
+            regras[nome.strip()] = int(n)
+    return regras
+
+
+class FiltroContexto(logging.Filter):
+    """Anota o request_id no registro (roda na thread de quem loga, antes de enfileirar)"""
+
+    def filter(self, record):
+        record.request_id = _request_id.get()
+        return True
+
+
+class FiltroAmostragem(logging.Filter):
+    """Mantém 1 de cada N registros abaixo de WARNING dos loggers configurados"""
+
+    def __init__(self, regras):
+        super().__init__()
+        # Regra mais específica primeiro ('loop.motor.ciclo' antes de 'loop.motor')
+        self._regras = sorted(regras.items(), key=lambda r: -len(r[0]))
+        self._contadores = {nome: itertools.count() for nome in regras}
+
+    def _regra(self, nome):
+        for prefixo, n in self._regras:
+            if nome == prefixo or nome.startswith(prefixo + '.'):
+                return prefixo, n
+        return None, 1
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        prefixo, n = self._regra(record.name)
+        if n == 1:
+            return True
+        if next(self._contadores[prefixo]) % n:
+            return False
+        record.amostragem = n
+        return True
+
+
+class FormatadorJSON(logging.Formatter):
+
+    def format(self, record):
+        dados = {
+            "ts": datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(timespec='milliseconds'),
+            "nivel": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if getattr(record, 'request_id', None):
+            dados['request_id'] = record.request_id
+        if getattr(record, 'amostragem', None):
+            dados['amostragem'] = record.amostragem
+        dados.update(getattr(record, 'campos', None) or {})
+        for chave, valor in vars(record).items():
+            if chave not in _ATRIBUTOS_PADRAO and chave not in ('request_id', 'amostragem', 'campos'):
+                dados[chave] = valor
+        if record.exc_info:
+            dados['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            dados['exc'] = record.exc_text
+        return json.dumps(dados, ensure_ascii=False, default=str)
+
+
+class FormatadorTexto(logging.Formatter):
+
+    def __init__(self):
+        super().__init__("%(asctime)s - %(levelname)s - %(name)s - %(message)s")
+
+    def format(self, record):
+        texto = super().format(record)
+        extras = dict(getattr(record, 'campos', None) or {})
+        if getattr(record, 'request_id', None):
+            extras['request_id'] = record.request_id
+        if extras:
+            texto += ' ' + ' '.join(f'{k}={v}' for k, v in extras.items())
+        return texto
+
+
+class HandlerFila(logging.handlers.QueueHandler):
+    """QueueHandler que descarta (e conta) em vez de bloquear ou imprimir erro com a fila cheia"""
+
+    def prepare(self, record):
+        # Como o QueueHandler, resolve a mensagem aqui (os args podem mudar depois), mas
+        # guarda o traceback em exc_text em vez de colá-lo na mensagem
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOGS_DESCARTADOS.inc()
+
+
+_listener = None
+_lock = threading.Lock()
+
+
+def configurar(nivel=LOG_NIVEL, formato=LOG_FORMATO, amostragem=LOG_AMOSTRAGEM, saida=None):
+    """Liga o logger raiz à fila e inicia a thread escritora (uma vez por processo)"""
+    global _listener
+    with _lock:
+        if _listener is not None:
+            return
+        escritor = logging.StreamHandler(saida or sys.stdout)
+        escritor.setFormatter(FormatadorJSON() if formato == 'json' else FormatadorTexto())
+
+        fila = HandlerFila(queue.Queue(LOG_FILA_MAX))
+        fila.addFilter(FiltroAmostragem(ler_amostragem(amostragem)))
+        fila.addFilter(FiltroContexto())
+
+        raiz = logging.getLogger()
+        for handler in list(raiz.handlers):
+            raiz.removeHandler(handler)
+        raiz.addHandler(fila)
+        raiz.setLevel(nivel)
+
+        _listener = logging.handlers.QueueListener(fila.queue, escritor)
+        _listener.start()
+        # Escreve o que ainda estiver na fila ao sair
+        atexit.register(_listener.stop)
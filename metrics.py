@@ -0,0 +1,201 @@
+"""
+Métricas Prometheus do LooP.
+
+Com gunicorn (vários workers) defina PROMETHEUS_MULTIPROC_DIR: cada processo
+grava suas amostras em arquivos mmap nesse diretório e o /metrics agrega todos.
+"""
+import os
+import time
+import inspect
+import functools
+
+import tracing
+from prometheus_client import (
+    CollectorRegistry, Counter, Gauge, Histogram, REGISTRY,
+    CONTENT_TYPE_LATEST, generate_latest, multiprocess
+)
+
+MULTIPROCESSO = bool(os.environ.get('PROMETHEUS_MULTIPROC_DIR'))
+
+# Buckets em segundos: de consultas rápidas no banco até chamadas lentas ao Spotify
+BUCKETS_LATENCIA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# --- HTTP ---
+HTTP_REQUISICOES = Counter(
+    'loop_http_requests_total', 'Requisições HTTP atendidas',
+    ['rota', 'metodo', 'status']
+)
+HTTP_LATENCIA = Histogram(
+    'loop_http_request_duration_seconds', 'Latência das requisições HTTP',
+    ['rota', 'metodo'], buckets=BUCKETS_LATENCIA
+)
+
+# --- BANCO DE DADOS ---
+DB_LATENCIA = Histogram(
+    'loop_db_call_duration_seconds', 'Latência das funções de acesso ao banco',
+    ['funcao'], buckets=BUCKETS_LATENCIA
+)
+DB_ERROS = Counter(
+    'loop_db_call_errors_total', 'Erros nas funções de acesso ao banco',
+    ['funcao']
+)
+
+REPLICA_LAG = Gauge(
+    'loop_db_replica_lag_seconds', 'Atraso da réplica de leitura na última verificação',
+    multiprocess_mode='livemax'
+)
+CONSULTAS_LEITURA = Counter(
+    'loop_db_routed_reads_total', 'Leituras roteáveis para a réplica, por destino',
+    ['destino']
+)
+
+# --- SPOTIFY ---
+SPOTIFY_LATENCIA = Histogram(
+    'loop_spotify_call_duration_seconds', 'Latência das chamadas ao spotipy',
+    ['metodo'], buckets=BUCKETS_LATENCIA
+)
+SPOTIFY_ERROS = Counter(
+    'loop_spotify_call_errors_total', 'Erros nas chamadas ao spotipy',
+    ['metodo', 'status']
+)
+SPOTIFY_FILA = Gauge(
+    'loop_spotify_queued_calls', 'Chamadas aguardando o limite de taxa do Spotify',
+    multiprocess_mode='livesum'
+)
+SPOTIFY_LIMITADAS = Counter('loop_spotify_throttled_total', 'Respostas 429 recebidas do Spotify')
+SPOTIFY_RETENTATIVAS = Counter(
+    'loop_spotify_retries_total', 'Chamadas ao Spotify repetidas',
+    ['motivo']
+)
+SPOTIFY_AGRUPADAS = Counter(
+    'loop_spotify_coalesced_total', 'Chamadas idênticas atendidas por outra já em andamento',
+    ['metodo']
+)
+
+# --- MOTOR DE AUTOMAÇÃO ---
+MOTOR_CICLO = Histogram(
+    'loop_motor_cycle_duration_seconds', 'Tempo de trabalho de um ciclo do motor (sem a espera)',
+    buckets=BUCKETS_LATENCIA
+)
+MOTOR_ATRASO = Histogram(
+    'loop_motor_cycle_lag_seconds', 'Atraso entre o início previsto e o início real do ciclo',
+    buckets=BUCKETS_LATENCIA
+)
+MOTOR_ERROS = Counter('loop_motor_errors_total', 'Exceções no loop do motor')
+FILA_PROFUNDIDADE = Gauge(
+    'loop_queue_depth', 'Entradas pendentes ou em execução na fila',
+    multiprocess_mode='livemax'
+)
+DISPOSITIVOS_ONLINE = Gauge(
+    'loop_devices_online', 'Dispositivos com heartbeat recente (visto pelo motor)',
+    multiprocess_mode='livemax'
+)
+HEARTBEATS = Counter('loop_heartbeats_total', 'Heartbeats registrados pelos dispositivos')
+POLL_SUGERIDO = Histogram(
+    'loop_device_poll_hint_seconds', 'Espera até o próximo poll sugerida aos dispositivos em /api/current_link',
+    buckets=(1, 2, 5, 10, 20, 30, 60, 120, 180, 240, 300)
+)
+POLLS_ECONOMIZADOS = Counter(
+    'loop_device_polls_saved_total',
+    'Polls evitados se os dispositivos seguirem a dica (espera sugerida / POLL_PADRAO_SEG - 1)'
+)
+DISPOSITIVOS_REJEITADAS = Counter(
+    'loop_device_requests_shed_total', 'Requisições dos dispositivos recusadas com 503 (worker saturado)', ['rota']
+)
+DISPOSITIVOS_DEGRADADAS = Counter(
+    'loop_device_requests_degraded_total', 'Requisições dos dispositivos respondidas da memória (banco indisponível)',
+    ['rota']
+)
+BANCO_DEGRADADO = Gauge(
+    'loop_db_degraded', '1 enquanto as rotas dos dispositivos estão em modo degradado',
+    multiprocess_mode='livemax'
+)
+HEARTBEATS_ADIADOS = Gauge(
+    'loop_heartbeats_deferred', 'Heartbeats aguardando o banco voltar para serem gravados',
+    multiprocess_mode='livesum'
+)
+HEARTBEATS_PERDIDOS = Counter(
+    'loop_heartbeats_deferred_dropped_total', 'Heartbeats adiados descartados (buffer cheio)'
+)
+
+# --- LOGS ---
+LOGS_DESCARTADOS = Counter('loop_log_records_dropped_total', 'Registros de log descartados com a fila de escrita cheia')
+
+# --- PAINEL ---
+PAINEL_SNAPSHOTS = Counter('loop_dashboard_snapshots_total', 'Snapshots do painel calculados por este processo')
+PAINEL_DURACAO = Histogram(
+    'loop_dashboard_snapshot_duration_seconds', 'Tempo para calcular um snapshot do painel',
+    buckets=BUCKETS_LATENCIA
+)
+
+
+def medir_db(func=None, *, nome=None):
+    """Decorator: registra latência e erros de uma função de banco (e um span 'db' no trace)"""
+    if func is None:
+        return lambda f: medir_db(f, nome=nome)
+    rotulo = nome or func.__name__
+    latencia = DB_LATENCIA.labels(rotulo)
+    erros = DB_ERROS.labels(rotulo)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        inicio = time.perf_counter()
+        try:
+            with tracing.span(rotulo, 'db'):
+                return func(*args, **kwargs)
+        except Exception:
+            erros.inc()
+            raise
+        finally:
+            latencia.observe(time.perf_counter() - inicio)
+    return wrapper
+
+
+# Métodos públicos do storage que não são consultas: medi-los criaria séries
+# loop_db_* e spans 'db' falsos (replica() é só um context manager). exportar
+# é um gerador: só a criação seria medida; ele mede cada lote por conta própria
+NAO_INSTRUMENTADOS = frozenset({'replica', 'estado_replica', 'conectar', 'exportar'})
+
+
+def instrumentar(obj, ignorar=NAO_INSTRUMENTADOS):
+    """Envolve os métodos públicos de obj (ex: o storage) com medir_db, menos os de `ignorar`"""
+    for nome in dir(obj):
+        if nome.startswith('_') or nome in ignorar:
+            continue
+        metodo = getattr(obj, nome)
+        if inspect.ismethod(metodo):
+            setattr(obj, nome, medir_db(metodo, nome=nome))
+    return obj
+
+
+def medir_spotify(metodo, func, *args, **kwargs):
+    """Executa uma chamada ao spotipy registrando latência e erros"""
+    inicio = time.perf_counter()
+    try:
+        return func(*args, **kwargs)
+    except Exception as e:
+        SPOTIFY_ERROS.labels(metodo, str(getattr(e, 'http_status', '') or 'erro')).inc()
+        raise
+    finally:
+        SPOTIFY_LATENCIA.labels(metodo).observe(time.perf_counter() - inicio)
+
+
+def registrar_requisicao(rota, metodo, status, duracao):
+    HTTP_REQUISICOES.labels(rota, metodo, str(status)).inc()
+    HTTP_LATENCIA.labels(rota, metodo).observe(duracao)
+
+
+def gerar_metricas():
+    """Retorna (corpo, content-type) no formato texto do Prometheus"""
+    if MULTIPROCESSO:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
+
+
+def processo_encerrado(pid):
+    """Remove as amostras 'live' de um worker que terminou (hook do gunicorn)"""
+    if MULTIPROCESSO:
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,284 @@
+"""
+Motor de automação do LooP.
+
+Motor.passo() executa um ciclo e devolve quantos segundos esperar até o
+próximo; ele não dorme e só lê o tempo pelo `relogio` recebido. O loop real
+(app.motor_automacao) espera com time.sleep, o simulador avança um relógio
+virtual.
+
+Cada ciclo que envia uma música grava um checkpoint (música, início, fim
+previsto, plays somados) na mesma transação dos plays. Um motor que sobe, ou
+o de outro worker, encontra o ciclo em andamento e só espera o que falta
+dele: os plays de cada ciclo são contados uma vez só.
+"""
+import os
+import random
+import logging
+import datetime
+
+from storage import STATUS_PENDENTE, STATUS_EXECUCAO, STATUS_CONCLUIDO
+from metrics import FILA_PROFUNDIDADE, DISPOSITIVOS_ONLINE, POLL_SUGERIDO, POLLS_ECONOMIZADOS
+
+# Horário de Brasília = UTC-3 (sem horário de verão)
+FUSO_BRASILIA = datetime.timedelta(hours=-3)
+HORA_RESET = 21
+
+# Esperas do motor, em segundos
+ESPERA_SEM_DISPOSITIVOS = 30
+ESPERA_FILA_VAZIA = 30
+ESPERA_APOS_CONCLUIR = 1
+FOLGA_CICLO_SEG = 10  # somada à duração da música em cada ciclo
+
+# Sem heartbeat há mais que isso, o dispositivo deixa de contar como online
+# (app, gateway e simulador usam este valor)
+DEVICE_TIMEOUT_SECONDS = 300  # 5 minutos
+
+# Dica de polling para os dispositivos (/api/current_link): o link só muda no
+# próximo ciclo do motor, então o dispositivo pode esperar até lá (mais um
+# jitter, para a frota não chegar toda no mesmo segundo)
+POLL_PADRAO_SEG = float(os.environ.get('POLL_PADRAO_SEG', 5))  # intervalo fixo dos dispositivos sem a dica
+POLL_MIN_SEG = float(os.environ.get('POLL_MIN_SEG', 2))
+POLL_MAX_SEG = float(os.environ.get('POLL_MAX_SEG', 240))  # abaixo do DEVICE_TIMEOUT_SECONDS
+POLL_JITTER_SEG = float(os.environ.get('POLL_JITTER_SEG', 3))
+
+logger = logging.getLogger('loop.motor')
+logger_ciclo = logging.getLogger('loop.motor.ciclo')  # uma linha por ciclo: amostrado (logs.LOG_AMOSTRAGEM)
+
+LINK_VAZIO = {
+    "link": "",
+    "duracao_min": 3.0,
+    "nome": "",
+    "timestamp": 0
+}
+
+
+def utc_agora():
+    """Relógio padrão: datetime UTC sem fuso"""
+    return datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+
+
+def epoch(momento):
+    """datetime UTC sem fuso (como o do relógio do motor) -> segundos desde a época"""
+    return momento.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+def dica_polling(proxima_troca, agora):
+    """
+    (proxima_troca, poll_apos) para a resposta do /api/current_link.
+    `proxima_troca` é o próximo ciclo do motor gravado na música em execução
+    (datetime UTC ou None) e `agora` o epoch atual. Sem previsão (fila vazia,
+    ciclo atrasado) sugere POLL_PADRAO_SEG.
+    """
+    prazo = epoch(proxima_troca) if proxima_troca else None
+    espera = prazo - agora if prazo and prazo > agora else POLL_PADRAO_SEG
+    poll_apos = min(max(espera + random.uniform(0, POLL_JITTER_SEG), POLL_MIN_SEG), POLL_MAX_SEG)
+    POLL_SUGERIDO.observe(poll_apos)
+    POLLS_ECONOMIZADOS.inc(max(0.0, poll_apos / POLL_PADRAO_SEG - 1))
+    return (int(prazo) if prazo else None), round(poll_apos, 1)
+
+
+class Motor:
+    """
+    Lógica de agendamento da fila. `relogio` devolve o datetime UTC atual
+    (sem fuso). As mensagens vão para os loggers loop.motor e
+    loop.motor.ciclo; se `log` for passado (ex: simulador), ele recebe todas
+    em texto.
+    """
+
+    def __init__(self, storage, config_service, device_timeout_seg, relogio=None, log=None):
+        self._storage = storage
+        self._config = config_service
+        self._device_timeout = device_timeout_seg
+        self.relogio = relogio or utc_agora
+        self._log = log or logger.info
+        self._log_ciclo = log or logger_ciclo.info
+        self._log_erro = log or logger.error
+
+        # Link atual para os dispositivos
+        self.link_atual = dict(LINK_VAZIO)
+
+        # Totais acumulados desde a criação do motor
+        self.contadores = {
+            "ciclos": 0,
+            "ciclos_sem_dispositivos": 0,
+            "ciclos_fila_vazia": 0,
+            "ciclos_enviando": 0,
+            "plays_enviados": 0,
+            "conclusoes": 0,
+            "resets": 0,
+            "ciclos_retomados": 0
+        }
+
+    def agora_brasilia(self):
+        return self.relogio() + FUSO_BRASILIA
+
+    def _registrar(self, mensagem, ciclo=False):
+        (self._log_ciclo if ciclo else self._log)(f"[{self.agora_brasilia().strftime('%H:%M:%S')}] {mensagem}")
+
+    def _timestamp(self):
+        return int(epoch(self.relogio()))
+
+    def executar_reset_diario(self, hoje_str):
+        """Executa o reset diário dos plays"""
+        self._registrar("🔄 Executando reset diário...")
+        # Grava a data do último reset na mesma transação do reset
+        reativadas = self._storage.executar_reset_diario({'last_reset_date': hoje_str})
+        self._config.invalidar()
+        self.contadores['resets'] += 1
+        self._log(f"✅ Reset concluído! {reativadas} músicas reativadas para o novo dia.")
+
+    def _ciclo_em_andamento(self):
+        """
+        Se o último ciclo gravado (registrar_ciclo) ainda não terminou, assume o
+        link dele e devolve os segundos que faltam; senão None. Os plays desse
+        ciclo já foram contados por quem o começou.
+        """
+        checkpoint = self._storage.ler_checkpoint_motor()
+        if not checkpoint:
+            return None
+        restante = (checkpoint['fim_previsto'] - self.relogio()).total_seconds()
+        if restante <= 0:
+            return None
+        self.link_atual = {
+            "link": checkpoint['link_musica'],
+            "duracao_min": checkpoint['duracao_min'],
+            "nome": checkpoint['nome_musica'],
+            "timestamp": self._timestamp()
+        }
+        self.contadores['ciclos_retomados'] += 1
+        return restante
+
+    def retomar(self):
+        """
+        Na subida do processo: segundos até o primeiro ciclo. Se o servidor
+        reiniciou no meio de um ciclo, espera só o que falta dele; senão 0.
+        """
+        restante = self._ciclo_em_andamento()
+        if restante is not None:
+            self._registrar(f"⏯️ Retomando '{self.link_atual['nome']}': faltam {restante:.0f}s do ciclo")
+            return restante
+        recuperada = self.recuperar_link()
+        if recuperada:
+            self._registrar(f"🎵 Recuperada música em execução: {recuperada['nome_musica']}")
+        return 0
+
+    def recuperar_link(self):
+        """Recupera a música em execução (caso o servidor tenha reiniciado)"""
+        m = self._storage.musica_em_execucao()
+        if m:
+            self.link_atual = {
+                "link": m['link_musica'],
+                "duracao_min": m['duracao_min'],
+                "nome": m['nome_musica'],
+                "timestamp": self._timestamp()
+            }
+        return m
+
+    def passo(self):
+        """Executa um ciclo do motor e retorna quantos segundos aguardar até o próximo"""
+        self.contadores['ciclos'] += 1
+        config = self._config.snapshot()
+
+        # 0. CICLO EM ANDAMENTO (de outro worker, ou deste antes de reiniciar): só acompanha
+        restante = self._ciclo_em_andamento()
+        if restante is not None:
+            # Quem só acompanha não mede a fila: zera para o máximo entre os workers ser o de quem mediu
+            FILA_PROFUNDIDADE.set(0)
+            DISPOSITIVOS_ONLINE.set(0)
+            return restante
+
+        # 1. VERIFICAÇÃO DE DISPOSITIVOS ONLINE
+        dispositivos_online = self._storage.contar_dispositivos_ativos(self._device_timeout)
+        DISPOSITIVOS_ONLINE.set(dispositivos_online)
+
+        # Se não há dispositivos, pausa o sistema
+        if dispositivos_online == 0:
+            self._registrar("💤 Sem dispositivos online. Aguardando...", ciclo=True)
+            self.link_atual = dict(LINK_VAZIO)
+            self.contadores['ciclos_sem_dispositivos'] += 1
+            return ESPERA_SEM_DISPOSITIVOS
+
+        # 2. PROCESSO DE RESET DIÁRIO (21h)
+        try:
+            agora = self.agora_brasilia()
+            hoje_str = agora.strftime('%Y-%m-%d')
+
+            # Verifica se já resetou hoje
+            last_reset = config.get('last_reset_date', '')
+
+            # Reseta se for >= 21h e ainda não tiver resetado hoje
+            if agora.hour >= HORA_RESET and last_reset != hoje_str and config.get('reset_automatico', 1) == 1:
+                self.executar_reset_diario(hoje_str)
+        except Exception as e:
+            self._log_erro(f"Erro no reset diário: {e}")
+
+        # 3. PROCESSAMENTO DA FILA
+        playlist = self._storage.carregar_playlist()
+        ativas = [m for m in playlist if m['status'] in (STATUS_EXECUCAO, STATUS_PENDENTE)]
+        FILA_PROFUNDIDADE.set(len(ativas))
+
+        if not ativas:
+            # Não há músicas na fila
+            self.contadores['ciclos_fila_vazia'] += 1
+            return ESPERA_FILA_VAZIA
+
+        # A primeira música pendente ou em execução
+        musica_atual = ativas[0]
+        musica_id = musica_atual['id']
+
+        # Se está Pendente, marca como Em Execução
+        if musica_atual['status'] == STATUS_PENDENTE:
+            self._storage.atualizar_musica(
+                musica_id,
+                musica_atual['plays_atuais'],
+                musica_atual['plays_mensais'],
+                STATUS_EXECUCAO
+            )
+
+        # Verifica se ainda precisa tocar mais vezes
+        if musica_atual['plays_atuais'] >= musica_atual['plays_desejados']:
+            # Concluiu todos os plays DO DIA/LOTE
+            self._storage.atualizar_musica(
+                musica_id,
+                musica_atual['plays_atuais'],
+                musica_atual['plays_mensais'],
+                STATUS_CONCLUIDO
+            )
+            self.contadores['conclusoes'] += 1
+            return ESPERA_APOS_CONCLUIR
+
+        duracao = musica_atual['duracao_min']
+
+        # Calcula plays a somar baseado em dispositivos online
+        plays_a_somar = min(
+            dispositivos_online,
+            musica_atual['plays_desejados'] - musica_atual['plays_atuais']
+        )
+
+        # Aguarda o tempo do ciclo; o link não muda antes do próximo (vai para os dispositivos como dica)
+        espera = (duracao * 60) + FOLGA_CICLO_SEG
+        inicio = self.relogio()
+        fim_previsto = inicio + datetime.timedelta(seconds=espera)
+
+        # Grava o checkpoint do ciclo e os plays (Plays Atuais, Plays Mensais, Plays Hoje, Meta Mensal)
+        # na mesma transação. Se outro ciclo começou nesse meio tempo, só acompanha aquele.
+        if not self._storage.registrar_ciclo(musica_atual, plays_a_somar, inicio, fim_previsto):
+            return self._ciclo_em_andamento() or ESPERA_APOS_CONCLUIR
+
+        # Atualiza o link atual para os dispositivos
+        self.link_atual = {
+            "link": musica_atual['link_musica'],
+            "duracao_min": duracao,
+            "nome": musica_atual['nome_musica'],
+            "timestamp": self._timestamp() + musica_atual['plays_atuais']  # Garante timestamp único por play
+        }
+
+        self._registrar(f"Enviando '{musica_atual['nome_musica']}' | "
+                        f"Dispositivos: {dispositivos_online} | "
+                        f"Progresso: {musica_atual['plays_atuais'] + dispositivos_online}/{musica_atual['plays_desejados']}",
+                        ciclo=True)
+
+        self.contadores['ciclos_enviando'] += 1
+        self.contadores['plays_enviados'] += plays_a_somar
+
+        return espera
@@ -0,0 +1,203 @@
+"""
+Acesso controlado à API do Spotify.
+
+Todas as chamadas do spotipy passam pelo AgendadorSpotify:
+- balde de fichas (SPOTIFY_TAXA chamadas/s por processo, rajada de SPOTIFY_RAJADA);
+- 429 pausa o processo inteiro pelo Retry-After; 5xx e falhas de rede são
+  repetidos com backoff exponencial;
+- chamadas idênticas em andamento são agrupadas numa só;
+- o token client-credentials fica num arquivo compartilhado pelos workers.
+"""
+import os
+import json
+import time
+import logging
+import random
+import tempfile
+import threading
+
+import requests
+import spotipy
+from spotipy.cache_handler import CacheHandler
+from spotipy.exceptions import SpotifyException
+
+import tracing
+from metrics import medir_spotify, SPOTIFY_FILA, SPOTIFY_LIMITADAS, SPOTIFY_RETENTATIVAS, SPOTIFY_AGRUPADAS
+
+logger = logging.getLogger('loop.spotify')
+
+SPOTIFY_TAXA = float(os.environ.get('SPOTIFY_TAXA', 5))
+SPOTIFY_RAJADA = int(os.environ.get('SPOTIFY_RAJADA', 10))
+SPOTIFY_TENTATIVAS = int(os.environ.get('SPOTIFY_TENTATIVAS', 4))
+SPOTIFY_ESPERA_MAX = float(os.environ.get('SPOTIFY_ESPERA_MAX', 30))
+SPOTIFY_SEM_REDE_SEG = 30  # janela de uma tentativa só depois de esgotar as retentativas de rede
+SPOTIFY_TOKEN_CACHE = os.environ.get('SPOTIFY_TOKEN_CACHE', os.path.join(tempfile.gettempdir(), 'loop-spotify-token.json'))
+
+
+class SpotifyLimitado(Exception):
+    """429 que não deu para esperar (Retry-After acima de SPOTIFY_ESPERA_MAX ou tentativas esgotadas)"""
+
+    def __init__(self, espera):
+        super().__init__(f"Spotify limitou as requisições; tente novamente em {int(espera) + 1}s")
+        self.espera = espera
+
+
+class CacheTokenArquivo(CacheHandler):
+    """Token do client-credentials num arquivo, gravado de forma atômica"""
+
+    def __init__(self, caminho):
+        self.caminho = caminho
+
+    def get_cached_token(self):
+        try:
+            with open(self.caminho, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save_token_to_cache(self, token_info):
+        pasta = os.path.dirname(self.caminho) or '.'
+        try:
+            fd, temporario = tempfile.mkstemp(dir=pasta, prefix='.spotify-token-')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(token_info, f)
+            os.replace(temporario, self.caminho)
+        except OSError as e:
+            logger.warning(f"⚠️ Não foi possível salvar o token do Spotify: {e}")
+
+
+def criar_cliente(auth_manager, sessao=None):
+    """
+    Cliente spotipy sem retentativas próprias. A sessão precisa ser passada
+    pronta: se o spotipy montar a dele, o Retry do urllib3 transforma 429 e
+    5xx em SpotifyException(429) sem headers e o Retry-After se perde.
+    """
+    return spotipy.Spotify(auth_manager=auth_manager, requests_session=sessao or requests.Session(),
+                           retries=0, status_retries=0)
+
+
+class _EmAndamento:
+    def __init__(self):
+        self.pronto = threading.Event()
+        self.resultado = None
+        self.erro = None
+
+
+class AgendadorSpotify:
+    """Fila única (por processo) das chamadas ao cliente spotipy"""
+
+    def __init__(self, cliente, taxa=SPOTIFY_TAXA, rajada=SPOTIFY_RAJADA,
+                 tentativas=SPOTIFY_TENTATIVAS, espera_max=SPOTIFY_ESPERA_MAX):
+        self.cliente = cliente
+        self._taxa = taxa
+        self._rajada = rajada
+        self._tentativas = tentativas
+        self._espera_max = espera_max
+        self._lock = threading.Lock()
+        self._fichas = float(rajada)
+        self._abastecido_em = time.monotonic()
+        self._pausado_ate = 0.0
+        self._sem_rede_ate = 0.0
+        self._em_andamento = {}
+
+    def chamar(self, metodo, *args, **kwargs):
+        # Um span por chamada, incluindo a espera por ficha, retentativas e chamadas agrupadas
+        with tracing.span(metodo, 'spotify'):
+            return self._chamar(metodo, args, kwargs)
+
+    def _chamar(self, metodo, args, kwargs):
+        try:
+            chave = (metodo, args, tuple(sorted(kwargs.items())))
+            hash(chave)
+        except TypeError:
+            return self._executar(metodo, args, kwargs)
+
+        with self._lock:
+            chamada = self._em_andamento.get(chave)
+            dono = chamada is None
+            if dono:
+                chamada = self._em_andamento[chave] = _EmAndamento()
+
+        if not dono:
+            # Mesma chamada já em andamento em outra thread: espera o resultado dela
+            SPOTIFY_AGRUPADAS.labels(metodo).inc()
+            chamada.pronto.wait()
+            if chamada.erro:
+                raise chamada.erro
+            return chamada.resultado
+
+        try:
+            chamada.resultado = self._executar(metodo, args, kwargs)
+            return chamada.resultado
+        except Exception as e:
+            chamada.erro = e
+            raise
+        finally:
+            with self._lock:
+                del self._em_andamento[chave]
+            chamada.pronto.set()
+
+    def _executar(self, metodo, args, kwargs):
+        func = getattr(self.cliente, metodo)
+        # Logo após esgotar as tentativas por falha de rede, não insiste: falha rápido
+        tentativas = 1 if time.monotonic() < self._sem_rede_ate else self._tentativas
+        for tentativa in range(1, tentativas + 1):
+            self._aguardar_ficha()
+            try:
+                return medir_spotify(metodo, func, *args, **kwargs)
+            except SpotifyException as e:
+                if e.http_status == 429:
+                    SPOTIFY_LIMITADAS.inc()
+                    espera = _retry_after(e)
+                    self._pausar(espera)
+                    if espera > self._espera_max or tentativa == tentativas:
+                        raise SpotifyLimitado(espera) from e
+                    motivo = '429'
+                elif e.http_status and e.http_status >= 500:
+                    motivo = '5xx'
+                else:
+                    raise
+                if tentativa == tentativas:
+                    raise
+            except requests.exceptions.RequestException:
+                motivo = 'rede'
+                if tentativa == tentativas:
+                    self._sem_rede_ate = time.monotonic() + SPOTIFY_SEM_REDE_SEG
+                    raise
+            SPOTIFY_RETENTATIVAS.labels(motivo).inc()
+            if motivo != '429':
+                # Backoff exponencial com jitter: ~0.5s, 1s, 2s...
+                time.sleep(min(self._espera_max, 0.5 * 2 ** (tentativa - 1)) * random.uniform(0.5, 1.0))
+
+    def _pausar(self, segundos):
+        with self._lock:
+            self._pausado_ate = max(self._pausado_ate, time.monotonic() + segundos)
+
+    def _aguardar_ficha(self):
+        """Bloqueia até haver ficha no balde e nenhuma pausa de 429 ativa"""
+        SPOTIFY_FILA.inc()
+        try:
+            while True:
+                with self._lock:
+                    agora = time.monotonic()
+                    self._fichas = min(self._rajada, self._fichas + (agora - self._abastecido_em) * self._taxa)
+                    self._abastecido_em = agora
+                    if agora < self._pausado_ate:
+                        espera = self._pausado_ate - agora
+                        if espera > self._espera_max:
+                            raise SpotifyLimitado(espera)
+                    elif self._fichas >= 1:
+                        self._fichas -= 1
+                        return
+                    else:
+                        espera = (1 - self._fichas) / self._taxa
+                time.sleep(espera)
+        finally:
+            SPOTIFY_FILA.dec()
+
+
+def _retry_after(erro):
+    try:
+        return max(1.0, float((erro.headers or {}).get('Retry-After', 1)))
+    except (TypeError, ValueError):
+        return 1.0
@@ -0,0 +1,97 @@
+"""
+Verificação do caminho de erros do Spotify (AgendadorSpotify + cliente spotipy).
+
+Monta o cliente como o app (spotify_client.criar_cliente) sobre um transporte
+falso, sem rede, e confere que 429 chega ao agendador com o Retry-After e que
+5xx é repetido por ele, não pelo urllib3.
+
+    python spotify_contract.py
+"""
+import sys
+import time
+
+import requests
+
+from spotify_client import AgendadorSpotify, SpotifyLimitado, criar_cliente
+
+
+class TransporteFalso(requests.adapters.BaseAdapter):
+    """Devolve as respostas (status, headers) na ordem; a última se repete"""
+
+    def __init__(self, respostas):
+        super().__init__()
+        self.respostas = list(respostas)
+        self.chamadas = 0
+
+    def send(self, request, **kwargs):
+        status, headers = self.respostas[min(self.chamadas, len(self.respostas) - 1)]
+        self.chamadas += 1
+        resposta = requests.Response()
+        resposta.status_code = status
+        resposta.headers.update(headers)
+        resposta._content = b'{"id": "t1"}' if status == 200 else b'{}'
+        resposta.url = request.url
+        resposta.request = request
+        return resposta
+
+    def close(self):
+        pass
+
+
+def agendador(respostas, **kwargs):
+    transporte = TransporteFalso(respostas)
+    sessao = requests.Session()
+    sessao.mount('https://', transporte)
+    return AgendadorSpotify(criar_cliente(None, sessao), **kwargs), transporte
+
+
+def verificar_retry_after_longo():
+    ag, transporte = agendador([(429, {'Retry-After': '120'})], espera_max=30)
+    try:
+        ag.chamar('track', 't1')
+        raise AssertionError("429 não virou SpotifyLimitado")
+    except SpotifyLimitado as e:
+        assert e.espera == 120, e.espera
+    assert transporte.chamadas == 1
+
+    # A pausa vale para as próximas chamadas do processo, sem ir ao Spotify
+    try:
+        ag.chamar('track', 't2')
+        raise AssertionError("chamada feita durante a pausa")
+    except SpotifyLimitado:
+        pass
+    assert transporte.chamadas == 1
+
+
+def verificar_retry_after_curto():
+    ag, transporte = agendador([(429, {'Retry-After': '1'}), (200, {})])
+    inicio = time.monotonic()
+    assert ag.chamar('track', 't1') == {"id": "t1"}
+    assert time.monotonic() - inicio >= 1
+    assert transporte.chamadas == 2
+
+
+def verificar_5xx():
+    ag, transporte = agendador([(503, {}), (200, {})])
+    assert ag.chamar('track', 't1') == {"id": "t1"}
+    assert transporte.chamadas == 2
+
+
+VERIFICACOES = [verificar_retry_after_longo, verificar_retry_after_curto, verificar_5xx]
+
+
+def main():
+    falhas = 0
+    for verificacao in VERIFICACOES:
+        try:
+            verificacao()
+            print(f"✅ {verificacao.__name__}")
+        except Exception as e:
+            falhas += 1
+            print(f"❌ {verificacao.__name__}: {type(e).__name__} {e}")
+    print(f"\n{len(VERIFICACOES) - falhas}/{len(VERIFICACOES)} verificações OK")
+    sys.exit(1 if falhas else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+Perfil das consultas SQL do LooP.
+
+Todo cursor criado por get_db_connection() é um CursorInstrumentado: cada
+comando tem a latência somada por texto de SQL, comandos acima de
+SLOW_QUERY_MS são logados (sem os valores dos parâmetros) e, com
+EXPLAIN_SLOW_QUERIES=1, o plano dos comandos mais lentos é capturado em
+segundo plano: (ANALYZE, BUFFERS) só para leituras; escritas recebem EXPLAIN
+simples (nada é executado de novo) e LOCK/TRUNCATE são ignorados. O plano é
+o genérico, com $1, $2... no lugar dos valores.
+"""
+import os
+import re
+import time
+import logging
+import threading
+
+from psycopg2.extras import RealDictCursor
+from psycopg2 import sql as pgsql
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+EXPLAIN_SLOW_QUERIES = os.environ.get('EXPLAIN_SLOW_QUERIES', '0') == '1'
+EXPLAIN_MAX = int(os.environ.get('EXPLAIN_MAX', 10))
+EXPLAIN_TIMEOUT_MS = int(os.environ.get('EXPLAIN_TIMEOUT_MS', 10000))
+MAX_COMANDOS = 500  # limite de SQLs distintos acompanhados (evita crescer sem fim)
+
+logger = logging.getLogger('loop.sql')
+
+_ESPACOS = re.compile(r'\s+')
+# Prefixo que o storage põe nos comandos preparados (timeout próprio, mesma ida ao banco)
+_TIMEOUT_LOCAL = re.compile(r'^\s*SET\s+LOCAL\s+statement_timeout\s*=\s*\d+\s*;\s*', re.IGNORECASE)
+_EXECUTE = re.compile(r'^EXECUTE\s+(\w+)', re.IGNORECASE)
+_LEITURA = re.compile(r'^\s*(SELECT|WITH|VALUES|TABLE)\b', re.IGNORECASE)
+# Escreve, trava ou consome sequência: ANALYZE executaria isso uma segunda vez
+_ESCRITA = re.compile(r'\b(INSERT|UPDATE|DELETE|MERGE|NEXTVAL|SETVAL|PG_ADVISORY_\w+|FOR\s+(KEY\s+)?SHARE)\b',
+                      re.IGNORECASE)
+_MARCADOR = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+def normalizar(query, cursor=None):
+    """Texto do comando em uma linha, usado como chave das estatísticas"""
+    if isinstance(query, pgsql.Composable) and cursor is not None:
+        query = query.as_string(cursor)
+    elif isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    return _ESPACOS.sub(' ', str(query)).strip()
+
+
+def redigir(params):
+    """Descreve os parâmetros sem expor os valores (ex: '<2 params: str, int>')"""
+    if not params:
+        return '<sem params>'
+    valores = params.values() if isinstance(params, dict) else params
+    tipos = ', '.join(type(v).__name__ for v in valores)
+    return f'<{len(params)} params: {tipos}>'
+
+
+class EstatisticasSQL:
+    """Agregado em memória (por processo) da latência de cada comando"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._comandos = {}
+        self._planos = {}
+        self._explicando = set()
+        self.desde = time.time()
+
+    def registrar(self, comando, duracao_ms):
+        with self._lock:
+            est = self._comandos.get(comando)
+            if est is None:
+                if len(self._comandos) >= MAX_COMANDOS:
+                    return
+                est = self._comandos[comando] = {
+                    'chamadas': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'lentas': 0
+                }
+            est['chamadas'] += 1
+            est['total_ms'] += duracao_ms
+            if duracao_ms > est['max_ms']:
+                est['max_ms'] = duracao_ms
+            if duracao_ms >= SLOW_QUERY_MS:
+                est['lentas'] += 1
+
+    def relatorio(self, n=20, ordem='total_ms'):
+        with self._lock:
+            linhas = []
+            for comando, est in self._comandos.items():
+                linha = dict(est)
+                linha['sql'] = comando
+                linha['total_ms'] = round(est['total_ms'], 2)
+                linha['max_ms'] = round(est['max_ms'], 2)
+                linha['media_ms'] = round(est['total_ms'] / est['chamadas'], 2)
+                plano = self._planos.get(comando)
+                if plano:
+                    linha['explain'] = plano
+                linhas.append(linha)
+        linhas.sort(key=lambda l: l.get(ordem, 0), reverse=True)
+        return linhas[:n]
+
+    def limpar(self):
+        with self._lock:
+            self._comandos.clear()
+            self._planos.clear()
+            self.desde = time.time()
+
+    def reservar_explain(self, comando, duracao_ms):
+        """
+        Decide se vale capturar o plano deste comando: mantém no máximo
+        EXPLAIN_MAX planos, substituindo o mais rápido quando chega um mais lento.
+        """
+        with self._lock:
+            if comando in self._planos or comando in self._explicando:
+                return False
+            if len(self._planos) + len(self._explicando) >= EXPLAIN_MAX:
+                capturados = [c for c in self._planos if c in self._comandos]
+                if not capturados:
+                    return False
+                mais_rapido = min(capturados, key=lambda c: self._comandos[c]['max_ms'])
+                if self._comandos[mais_rapido]['max_ms'] >= duracao_ms:
+                    return False
+                del self._planos[mais_rapido]
+            self._explicando.add(comando)
+            return True
+
+    def salvar_explain(self, comando, plano):
+        with self._lock:
+            self._explicando.discard(comando)
+            if plano is not None:
+                self._planos[comando] = plano
+
+
+estatisticas = EstatisticasSQL()
+
+# Função que abre uma conexão comum (cursor de tuplas, sem instrumentação)
+_conectar_explain = None
+# SQL dos comandos preparados (nome -> texto com %s): o PREPARE não existe na conexão do EXPLAIN
+_preparados = {}
+
+
+def configurar(conectar, preparados=None):
+    """Define como abrir as conexões usadas para capturar o EXPLAIN (e o SQL de cada comando preparado)"""
+    global _conectar_explain
+    _conectar_explain = conectar
+    _preparados.update(preparados or {})
+
+
+def somente_leitura(query):
+    """True se rodar o comando de novo (EXPLAIN ANALYZE) não escreve nem trava nada"""
+    return bool(_LEITURA.match(query)) and not _ESCRITA.search(query)
+
+
+def _posicional(query, params):
+    """(SQL com $1, $2..., valores na ordem) a partir dos marcadores do psycopg2"""
+    valores = []
+    nomeados = {}
+
+    def trocar(marcador):
+        if marcador.group(0) == '%%':
+            return '%'
+        nome = marcador.group(1)
+        if nome is None:
+            valores.append(params[len(valores)])
+            return f'${len(valores)}'
+        if nome not in nomeados:
+            valores.append(params[nome])
+            nomeados[nome] = len(valores)
+        return f'${nomeados[nome]}'
+
+    return _MARCADOR.sub(trocar, query), valores
+
+
+def _capturar_explain(comando, query, params):
+    """
+    Captura o plano genérico (os valores dos parâmetros não aparecem) numa
+    transação desfeita ao final; ANALYZE só quando o comando é só leitura.
+    """
+    plano = None
+    execucao = _EXECUTE.match(query)
+    if execucao and execucao.group(1) in _preparados:
+        query = _preparados[execucao.group(1)]
+    opcoes = ' (ANALYZE, BUFFERS)' if somente_leitura(query) else ''
+    try:
+        # Sem parâmetros o psycopg2 não interpreta marcadores (nem %%): o SQL vai como está
+        sql, valores = (query, []) if params is None else _posicional(query, params)
+        conn = _conectar_explain()
+        try:
+            cur = conn.cursor()
+            cur.execute('SET LOCAL statement_timeout = %s', (EXPLAIN_TIMEOUT_MS,))
+            cur.execute('SET LOCAL plan_cache_mode = force_generic_plan')
+            cur.execute(f'PREPARE loop_explain AS {sql}')
+            argumentos = f" ({', '.join(['%s'] * len(valores))})" if valores else ''
+            cur.execute(f'EXPLAIN{opcoes} EXECUTE loop_explain{argumentos}', valores)
+            plano = '\n'.join(row[0] for row in cur.fetchall())
+        finally:
+            # Nunca confirmar: nada do EXPLAIN deve ficar no banco
+            conn.rollback()
+            conn.close()
+    except Exception as e:
+        logger.warning(f"Falha ao capturar EXPLAIN: {e}")
+    estatisticas.salvar_explain(comando, plano)
+
+
+class CursorInstrumentado(RealDictCursor):
+    """RealDictCursor que mede cada execute() e alimenta as estatísticas"""
+
+    def execute(self, query, vars=None):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._medir(query, vars, (time.perf_counter() - inicio) * 1000)
+
+    def executemany(self, query, vars_list):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._medir(query, None, (time.perf_counter() - inicio) * 1000)
+
+    def _medir(self, query, params, duracao_ms):
+        texto = query.as_string(self) if isinstance(query, pgsql.Composable) else query
+        if isinstance(texto, bytes):
+            texto = texto.decode('utf-8', 'replace')
+        # Sem o SET LOCAL do timeout, o comando é agrupado e explicado pelo que de fato roda
+        texto = _TIMEOUT_LOCAL.sub('', texto, count=1)
+        comando = normalizar(texto)
+        estatisticas.registrar(comando, duracao_ms)
+        if duracao_ms < SLOW_QUERY_MS:
+            return
+
+        logger.warning(f"🐢 SQL lento ({duracao_ms:.1f} ms) {redigir(params)}: {comando[:500]}")
+        if (EXPLAIN_SLOW_QUERIES and _conectar_explain is not None
+                and not comando.upper().startswith(('EXPLAIN', 'CREATE', 'ALTER', 'DROP', 'SET', 'LOCK', 'TRUNCATE'))
+                and estatisticas.reservar_explain(comando, duracao_ms)):
+            threading.Thread(
+                target=_capturar_explain, args=(comando, texto, params), daemon=True
+            ).start()
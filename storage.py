@@ -0,0 +1,2031 @@
+"""
+Camada de persistência do LooP.
+
+PostgresStorage é a implementação de produção (todo o SQL do app mora aqui).
+MemoryStorage guarda tudo em dicionários, com a mesma semântica, para
+benchmarks, simulações e verificações rápidas sem um Postgres rodando
+(veja storage_contract.py). Escolha com STORAGE_BACKEND=postgres|memory.
+"""
+import os
+import math
+import time
+import logging
+import datetime
+import threading
+from contextlib import contextmanager
+
+import psycopg2
+import psycopg2.pool
+import psycopg2.extensions
+
+import sql_profiler
+from sql_profiler import CursorInstrumentado
+from metrics import REPLICA_LAG, CONSULTAS_LEITURA, medir_db
+
+logger = logging.getLogger('loop.storage')
+
+STATUS_PENDENTE = 'Pendente'
+STATUS_EXECUCAO = 'Em Execução'
+STATUS_CONCLUIDO = 'Concluído'
+STATUS_FILA = (STATUS_PENDENTE, STATUS_EXECUCAO, STATUS_CONCLUIDO)
+
+# Pool de conexões do PostgresStorage (por processo)
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 12))  # 8 threads do gunicorn + motor e jobs
+DB_POOL_ESPERA_SEG = float(os.environ.get('DB_POOL_ESPERA_SEG', 10))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 30000))  # padrão da sessão
+
+# Réplica de leitura (DATABASE_READ_URL): com atraso acima do máximo as leituras voltam ao primário
+DB_REPLICA_LAG_MAX_SEG = float(os.environ.get('DB_REPLICA_LAG_MAX_SEG', 10))
+DB_REPLICA_VERIFICACAO_SEG = float(os.environ.get('DB_REPLICA_VERIFICACAO_SEG', 5))
+DB_REPLICA_CONNECT_TIMEOUT_SEG = int(os.environ.get('DB_REPLICA_CONNECT_TIMEOUT_SEG', 2))
+
+# Colunas copiadas entre a fila (playlist) e o arquivo (playlist_arquivo)
+COLUNAS_FILA = ("id, link_musica, nome_musica, plays_desejados, plays_atuais, plays_mensais, "
+                "status, duracao_min, data_adicao, track_id, playlist_id, plays_hoje, data_ultimo_play")
+
+# Conjuntos exportáveis (exportar): tabela, ordenação e colunas (nome, tipo)
+_COLUNAS_TIPADAS_FILA = [
+    ('id', 'inteiro'), ('link_musica', 'texto'), ('nome_musica', 'texto'), ('plays_desejados', 'inteiro'),
+    ('plays_atuais', 'inteiro'), ('plays_mensais', 'inteiro'), ('status', 'texto'), ('duracao_min', 'real'),
+    ('data_adicao', 'timestamp'), ('track_id', 'texto'), ('playlist_id', 'texto'), ('plays_hoje', 'inteiro'),
+    ('data_ultimo_play', 'data')
+]
+EXPORTACOES = {
+    'plays_diarios': ('plays_diarios', 'track_id, data', [('track_id', 'texto'), ('data', 'data'), ('plays', 'inteiro')]),
+    'musicas_controle': ('musicas_controle', 'id', [
+        ('id', 'inteiro'), ('track_id', 'texto'), ('nome', 'texto'), ('meta_mensal', 'inteiro'),
+        ('plays_diarios', 'inteiro'), ('mes_atual', 'texto'), ('plays_mes_atual', 'inteiro')
+    ]),
+    'fila': ('playlist', 'id', _COLUNAS_TIPADAS_FILA),
+    'arquivo': ('playlist_arquivo', 'arquivo_id',
+                [('arquivo_id', 'inteiro')] + _COLUNAS_TIPADAS_FILA + [('data_arquivamento', 'timestamp')]),
+}
+
+# Colunas indexadas aceitas como ordenação nas listagens paginadas (o id desempata).
+# playlist.track_id pode ser NULL e por isso não entra: o keyset não funciona com NULL.
+ORDENACOES = {
+    'playlist': ('id',),
+    'musicas_controle': ('id', 'track_id'),
+    'playlists': ('id',),
+}
+
+
+# Comandos quentes: preparados (PREPARE) uma vez em cada conexão do pool e
+# executados com EXECUTE, sem novo parse/plano a cada chamada.
+# nome -> (statement_timeout em ms, SQL com %s)
+PREPARADOS = {
+    'heartbeat': (500, '''
+        INSERT INTO devices (device_id, last_seen) VALUES (%s, CURRENT_TIMESTAMP)
+        ON CONFLICT (device_id) DO UPDATE SET last_seen = CURRENT_TIMESTAMP
+    '''),
+    'contar_dispositivos': (1000, '''
+        SELECT COUNT(*) as count FROM devices
+        WHERE last_seen > NOW() - make_interval(secs => %s)
+    '''),
+    'musica_em_execucao': (1000, f'''
+        SELECT {COLUNAS_FILA}, proxima_troca FROM playlist WHERE status = 'Em Execução' ORDER BY id LIMIT 1
+    '''),
+    'atualizar_musica': (2000, '''
+        UPDATE playlist SET plays_atuais = %s, plays_mensais = %s, status = %s
+        WHERE id = %s
+    '''),
+    'somar_plays_fila': (2000, '''
+        UPDATE playlist SET
+            plays_atuais = plays_atuais + %s,
+            plays_mensais = plays_mensais + %s,
+            plays_hoje = plays_hoje + %s,
+            data_ultimo_play = CURRENT_DATE,
+            status = 'Em Execução',
+            proxima_troca = %s
+        WHERE id = %s
+    '''),
+    'somar_plays_controle': (2000, '''
+        UPDATE musicas_controle SET plays_mes_atual = plays_mes_atual + %s
+        WHERE track_id = %s
+    '''),
+    'somar_plays_diarios': (2000, '''
+        INSERT INTO plays_diarios (track_id, data, plays)
+        VALUES (%s, CURRENT_DATE, %s)
+        ON CONFLICT (track_id, data)
+        DO UPDATE SET plays = plays_diarios.plays + %s
+    '''),
+}
+
+
+def textos_preparados(nome):
+    """(PREPARE, EXECUTE, SQL direto) do comando; os dois últimos já com o SET LOCAL do timeout"""
+    timeout_ms, sql = PREPARADOS[nome]
+    partes = sql.strip().split('%s')
+    posicional = partes[0] + ''.join(f'${i}{parte}' for i, parte in enumerate(partes[1:], 1))
+    n = len(partes) - 1
+    argumentos = f" ({', '.join(['%s'] * n)})" if n else ''
+    timeout = f'SET LOCAL statement_timeout = {int(timeout_ms)}; '
+    return f'PREPARE {nome} AS {posicional}', f'{timeout}EXECUTE {nome}{argumentos}', timeout + sql.strip()
+
+
+_TEXTOS_PREPARADOS = {nome: textos_preparados(nome) for nome in PREPARADOS}
+
+
+def chave_pagina(linha, ordem):
+    """Cursor keyset da linha: (id,) ou (valor da coluna de ordenação, id)"""
+    return (linha['id'],) if ordem == 'id' else (linha[ordem], linha['id'])
+
+
+def _validar_ordem(tabela, ordem, cursor):
+    if ordem not in ORDENACOES[tabela]:
+        raise ValueError(f"Ordenação não permitida: {ordem}")
+    if cursor is not None and len(cursor) != (1 if ordem == 'id' else 2):
+        raise ValueError("Cursor inválido")
+
+
+def _validar_status(status):
+    if status not in STATUS_FILA:
+        raise ValueError(f"Status inválido: {status}")
+
+
+def mesclar_duplicadas(linhas):
+    """
+    Funde entradas do mesmo (track_id, playlist_id), cada uma com 'origem'
+    ('fila' ou 'arquivo'). Sobrevive a mais antiga da fila quente (ou do
+    arquivo, se não houver na fila); os contadores são somados.
+    Retorna (sobrevivente, removidas).
+    """
+    ordenadas = sorted(linhas, key=lambda l: (l['origem'] != 'fila', l['id'], l.get('arquivo_id') or 0))
+    base = dict(ordenadas[0])
+    for campo in ('plays_atuais', 'plays_mensais', 'plays_hoje'):
+        base[campo] = sum(l[campo] or 0 for l in linhas)
+    base['plays_desejados'] = max(l['plays_desejados'] or 0 for l in linhas)
+    datas = [l['data_ultimo_play'] for l in linhas if l['data_ultimo_play']]
+    base['data_ultimo_play'] = max(datas) if datas else None
+    adicoes = [l['data_adicao'] for l in linhas if l['data_adicao']]
+    base['data_adicao'] = min(adicoes) if adicoes else None
+
+    if base['origem'] == 'arquivo':
+        base['status'] = STATUS_CONCLUIDO
+    elif any(l['origem'] == 'fila' and l['status'] == STATUS_EXECUCAO for l in linhas):
+        base['status'] = STATUS_EXECUCAO
+    elif base['plays_atuais'] >= base['plays_desejados']:
+        base['status'] = STATUS_CONCLUIDO
+    else:
+        base['status'] = STATUS_PENDENTE
+    return base, ordenadas[1:]
+
+
+class Storage:
+    """
+    Contrato comum dos backends. Linhas são devolvidas como dicts com os
+    mesmos nomes de colunas das tabelas do Postgres.
+    """
+
+    # --- ESQUEMA ---
+    def inicializar(self, config_padrao):
+        raise NotImplementedError
+
+    # --- FILA (playlist / playlist_arquivo) ---
+    def carregar_playlist(self):
+        raise NotImplementedError
+
+    def musica_em_execucao(self):
+        """Primeira entrada da fila com status Em Execução, ou None"""
+        raise NotImplementedError
+
+    def salvar_musica(self, link, nome, plays_desejados, duracao_min):
+        raise NotImplementedError
+
+    def atualizar_musica(self, id, plays_atuais, plays_mensais, status):
+        raise NotImplementedError
+
+    def deletar_musica(self, id):
+        raise NotImplementedError
+
+    def mover_para_topo(self, id):
+        raise NotImplementedError
+
+    def resetar_fila(self):
+        raise NotImplementedError
+
+    # Operações em lote: uma transação, SQL por conjunto; retornam quantas linhas foram afetadas
+    def deletar_musicas(self, ids):
+        raise NotImplementedError
+
+    def resetar_musicas(self, ids):
+        """Zera plays_atuais e volta para Pendente"""
+        raise NotImplementedError
+
+    def alterar_status(self, ids, status):
+        raise NotImplementedError
+
+    def mover_para_topo_lote(self, ids):
+        """Move para o topo da fila mantendo a ordem recebida (ids[0] fica em primeiro)"""
+        raise NotImplementedError
+
+    def registrar_plays(self, musica_id, track_id, plays_a_somar, proxima_troca=None):
+        """`proxima_troca`: quando o motor roda o próximo ciclo (datetime UTC), lido por musica_em_execucao"""
+        raise NotImplementedError
+
+    def arquivar_concluidas(self):
+        raise NotImplementedError
+
+    def listar_arquivo(self, limite, antes_de=None, track_id=None):
+        raise NotImplementedError
+
+    def listar_fila_pagina(self, limite, cursor=None, desc=False, status=None, track_id=None, busca=None):
+        """
+        Página da fila ordenada por id. `cursor` é a chave_pagina da última linha
+        da página anterior; `status` é uma lista; `busca` filtra nome_musica
+        (sem diferenciar maiúsculas).
+        """
+        raise NotImplementedError
+
+    def tempos_fila(self, dispositivos, folga_seg):
+        """
+        (restante, planejado) em segundos para tocar as entradas não concluídas
+        com `dispositivos` aparelhos, somando `folga_seg` a cada ciclo
+        """
+        raise NotImplementedError
+
+    def executar_reset_diario(self, valores_config):
+        raise NotImplementedError
+
+    def salvar_validacao(self, resultado):
+        """Upsert por (track_id, playlist_id): repetir a mesma validação não duplica a fila"""
+        raise NotImplementedError
+
+    def compactar_duplicadas(self):
+        """Funde entradas repetidas de (track_id, playlist_id) na fila e no arquivo; retorna {grupos, removidas}"""
+        raise NotImplementedError
+
+    # --- MOTOR ---
+    def ler_checkpoint_motor(self):
+        """
+        Último ciclo do motor gravado por registrar_ciclo: ciclo, musica_id,
+        track_id, link_musica, nome_musica, duracao_min, inicio, fim_previsto e
+        plays_aplicados (None se nenhum ciclo rodou ainda)
+        """
+        raise NotImplementedError
+
+    def registrar_ciclo(self, musica, plays_a_somar, inicio, fim_previsto):
+        """
+        Reivindica o ciclo e soma os plays (registrar_plays) na mesma transação.
+        Só passa se o ciclo anterior já terminou (fim_previsto <= inicio); senão
+        nada é gravado e devolve False: o ciclo em andamento é de outro worker
+        ou deste processo antes de reiniciar, e os plays dele já foram contados.
+        """
+        raise NotImplementedError
+
+    # --- IDEMPOTÊNCIA ---
+    def reservar_idempotencia(self, chave, validade_seg):
+        """
+        Reserva a chave. Retorna None se a reserva é nova; senão {"resposta": texto
+        ou None enquanto a primeira requisição ainda está em andamento}.
+        """
+        raise NotImplementedError
+
+    def concluir_idempotencia(self, chave, resposta):
+        raise NotImplementedError
+
+    def liberar_idempotencia(self, chave):
+        raise NotImplementedError
+
+    # --- SNAPSHOTS ---
+    def reivindicar_snapshot(self, nome, balde):
+        """True se quem chamou ficou com o cálculo do balde (só um por balde, mesmo entre processos)"""
+        raise NotImplementedError
+
+    def salvar_snapshot(self, nome, balde, dados, substituir=False):
+        """
+        Grava o texto do snapshot, a menos que já exista um do mesmo balde ou
+        mais novo (com `substituir`, só se for mais novo). True se gravou.
+        """
+        raise NotImplementedError
+
+    def ler_snapshot(self, nome):
+        """Texto do último snapshot gravado, ou None"""
+        raise NotImplementedError
+
+    def versao_snapshot(self, nome):
+        """Número que muda a cada gravação do snapshot (consulta leve), ou None"""
+        raise NotImplementedError
+
+    # --- DISPOSITIVOS ---
+    def registrar_heartbeat(self, device_id):
+        raise NotImplementedError
+
+    def registrar_heartbeats(self, device_ids):
+        """Heartbeat de vários dispositivos num comando só"""
+        raise NotImplementedError
+
+    def contar_dispositivos_ativos(self, timeout_seg):
+        raise NotImplementedError
+
+    # --- CONFIG ---
+    def carregar_config(self):
+        """Retorna (versao, {chave: valor em texto})"""
+        raise NotImplementedError
+
+    def ler_versao_config(self):
+        raise NotImplementedError
+
+    def salvar_config(self, valores):
+        """Grava as chaves e incrementa a versão numa única transação; retorna a nova versão"""
+        raise NotImplementedError
+
+    # --- PLAYLISTS CADASTRADAS ---
+    def listar_playlists(self):
+        raise NotImplementedError
+
+    def listar_playlists_pagina(self, limite, cursor=None, desc=False, busca=None):
+        raise NotImplementedError
+
+    def adicionar_playlist(self, url, nome):
+        raise NotImplementedError
+
+    def remover_playlist(self, id):
+        raise NotImplementedError
+
+    # --- CONTROLE MENSAL ---
+    def listar_controles(self):
+        """musicas_controle do mais recente para o mais antigo"""
+        raise NotImplementedError
+
+    def listar_controles_pagina(self, limite, cursor=None, ordem='id', desc=True, track_id=None, busca=None):
+        raise NotImplementedError
+
+    def plays_hoje_por_track(self):
+        """{track_id: soma de plays_hoje na fila e no arquivo}"""
+        raise NotImplementedError
+
+    def remover_controle(self, song_id):
+        """Remove a música do controle, seu histórico e suas entradas na fila/arquivo"""
+        raise NotImplementedError
+
+    def remover_controles(self, song_ids):
+        """remover_controle em lote; retorna {controles, plays_diarios, fila, arquivo} removidos"""
+        raise NotImplementedError
+
+    def remover_todas_musicas(self):
+        """Esvazia controle, histórico, fila e arquivo; retorna as contagens como remover_controles"""
+        raise NotImplementedError
+
+    # --- HISTÓRICO ---
+    def historico_plays(self, track_id, limite=30):
+        """[{data, plays}] do dia mais recente para o mais antigo"""
+        raise NotImplementedError
+
+    def historico_plays_lote(self, track_ids, inicio, fim):
+        """[{track_id, data, plays}] das músicas em `track_ids` entre as datas inicio e fim (inclusive)"""
+        raise NotImplementedError
+
+    def plays_por_dia(self, desde):
+        """[{track_id, data, plays}] de todas as músicas a partir da data `desde`"""
+        raise NotImplementedError
+
+    def versao_plays(self, desde):
+        """Valor que muda quando há plays novos desde `desde` ou mudanças no controle mensal"""
+        raise NotImplementedError
+
+    # --- EXPORTAÇÃO ---
+    def exportar(self, conjunto, lote):
+        """Gerador: as linhas de EXPORTACOES[conjunto] em listas de até `lote` dicts"""
+        raise NotImplementedError
+
+    # --- DEBUG ---
+    def resumo_debug(self, timeout_seg):
+        raise NotImplementedError
+
+    # --- RÉPLICA DE LEITURA ---
+    @contextmanager
+    def replica(self):
+        """
+        Dentro do bloco, as leituras que toleram alguns segundos de atraso
+        (listagens, histórico, estatísticas, debug) podem ir para a réplica.
+        Sem réplica configurada não faz nada.
+        """
+        yield
+
+    def estado_replica(self):
+        return {"configurada": False}
+
+
+# --- POSTGRES ---
+
+class ConexaoPool(psycopg2.extensions.connection):
+    """Conexão do pool; `preparada` indica se os PREPARADOS já existem nela"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.preparada = False
+
+
+class PoolConexoes:
+    """
+    ThreadedConnectionPool que espera até `espera_seg` por uma conexão livre
+    (o do psycopg2 falha na hora quando esgota). Recriado quando o processo
+    muda (fork do gunicorn), para nenhum worker herdar sockets de outro.
+    """
+
+    def __init__(self, minimo, maximo, espera_seg, **conexao):
+        self.minimo = minimo
+        self.maximo = maximo
+        self.espera_seg = espera_seg
+        self._conexao = conexao
+        self._lock = threading.Lock()
+        self._pid = None
+        self._pool = None
+        self._vagas = None
+        self._herdados = []
+
+    def _atual(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                if self._pool is not None:
+                    # Nunca fechar as conexões herdadas: o close() encerraria a sessão do processo pai
+                    self._herdados.append(self._pool)
+                self._pool = psycopg2.pool.ThreadedConnectionPool(self.minimo, self.maximo, **self._conexao)
+                self._vagas = threading.BoundedSemaphore(self.maximo)
+                self._pid = os.getpid()
+            return self._pool, self._vagas
+
+    def obter(self):
+        pool, vagas = self._atual()
+        if not vagas.acquire(timeout=self.espera_seg):
+            raise psycopg2.pool.PoolError(f"Nenhuma conexão livre em {self.espera_seg}s (DB_POOL_MAX={self.maximo})")
+        try:
+            return pool.getconn()
+        except Exception:
+            vagas.release()
+            raise
+
+    def devolver(self, conn, descartar=False):
+        pool, vagas = self._atual()
+        try:
+            pool.putconn(conn, close=descartar)
+        finally:
+            vagas.release()
+
+
+class PostgresStorage(Storage):
+
+    def __init__(self, dsn, dsn_leitura=None):
+        self.dsn = dsn
+        self.dsn_leitura = dsn_leitura
+        sql_profiler.configurar(lambda: psycopg2.connect(self.dsn), {nome: sql for nome, (_, sql) in PREPARADOS.items()})
+        self._pool = PoolConexoes(
+            DB_POOL_MIN, DB_POOL_MAX, DB_POOL_ESPERA_SEG,
+            dsn=dsn, cursor_factory=CursorInstrumentado, connection_factory=ConexaoPool,
+            options=f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}'
+        )
+        self._replica = None
+        if dsn_leitura:
+            self._replica = PoolConexoes(
+                DB_POOL_MIN, DB_POOL_MAX, DB_POOL_ESPERA_SEG,
+                dsn=dsn_leitura, cursor_factory=CursorInstrumentado, connection_factory=ConexaoPool,
+                options=f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}',
+                connect_timeout=DB_REPLICA_CONNECT_TIMEOUT_SEG
+            )
+        self._local = threading.local()
+        self._replica_lock = threading.Lock()
+        self._replica_lag = None
+        self._replica_verificada_em = None
+        self._replica_erro = None
+
+    def conectar(self, dsn=None):
+        """Cria conexão avulsa (fora do pool) com o PostgreSQL (cursores medidos pelo sql_profiler)"""
+        return psycopg2.connect(dsn or self.dsn, cursor_factory=CursorInstrumentado,
+                                options=f'-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}')
+
+    # --- RÉPLICA DE LEITURA ---
+    @contextmanager
+    def replica(self):
+        anterior = getattr(self._local, 'replica', False)
+        self._local.replica = True
+        try:
+            yield
+        finally:
+            self._local.replica = anterior
+
+    def _medir_lag(self):
+        """Atraso da réplica em segundos (0 se ela já aplicou tudo o que recebeu)"""
+        conn = self._replica.obter()
+        descartar = False
+        try:
+            with conn.cursor() as cur:
+                cur.execute('''
+                    SELECT CASE
+                        WHEN NOT pg_is_in_recovery() THEN 0
+                        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                        ELSE COALESCE(EXTRACT(EPOCH FROM NOW() - pg_last_xact_replay_timestamp()), 0)
+                    END::float8 AS lag
+                ''')
+                return cur.fetchone()['lag']
+        except psycopg2.Error:
+            descartar = bool(conn.closed)
+            raise
+        finally:
+            if not conn.closed:
+                conn.rollback()
+            self._replica.devolver(conn, descartar or bool(conn.closed))
+
+    def _replica_disponivel(self):
+        """Réplica respondendo e com atraso até DB_REPLICA_LAG_MAX_SEG (medido a cada DB_REPLICA_VERIFICACAO_SEG)"""
+        with self._replica_lock:
+            agora = time.monotonic()
+            if self._replica_verificada_em is None or agora - self._replica_verificada_em >= DB_REPLICA_VERIFICACAO_SEG:
+                try:
+                    self._replica_lag = self._medir_lag()
+                    self._replica_erro = None
+                    REPLICA_LAG.set(self._replica_lag)
+                except psycopg2.Error as e:
+                    self._replica_lag = None
+                    self._replica_erro = str(e).strip()
+                    logger.warning(f"⚠️ Réplica de leitura indisponível, lendo do primário: {self._replica_erro}")
+                self._replica_verificada_em = time.monotonic()
+            return self._replica_lag is not None and self._replica_lag <= DB_REPLICA_LAG_MAX_SEG
+
+    def _replica_falhou(self, erro):
+        """Conexão com a réplica caiu: leituras no primário até a próxima verificação"""
+        with self._replica_lock:
+            self._replica_lag = None
+            self._replica_erro = str(erro).strip()
+            self._replica_verificada_em = time.monotonic()
+
+    def estado_replica(self):
+        if self._replica is None:
+            return {"configurada": False}
+        with self._replica_lock:
+            return {
+                "configurada": True,
+                "em_uso": self._replica_lag is not None and self._replica_lag <= DB_REPLICA_LAG_MAX_SEG,
+                "lag_seg": self._replica_lag,
+                "lag_max_seg": DB_REPLICA_LAG_MAX_SEG,
+                "erro": self._replica_erro
+            }
+
+    def _escolher_pool(self, leitura):
+        if not (leitura and getattr(self._local, 'replica', False)):
+            return self._pool
+        if self._replica is not None and self._replica_disponivel():
+            CONSULTAS_LEITURA.labels('replica').inc()
+            return self._replica
+        CONSULTAS_LEITURA.labels('primario').inc()
+        return self._pool
+
+    def _preparar(self, conn):
+        """PREPARE dos comandos quentes, uma vez por conexão, numa transação própria"""
+        if conn.preparada:
+            return
+        try:
+            with conn.cursor() as cur:
+                # PREPARE não é desfeito por rollback: limpa sobras de uma tentativa anterior
+                cur.execute('DEALLOCATE ALL')
+                for prepare, _, _ in _TEXTOS_PREPARADOS.values():
+                    cur.execute(prepare)
+            conn.commit()
+            conn.preparada = True
+        except psycopg2.Error as e:
+            # Ex: tabelas ainda não criadas; a conexão segue com o SQL direto e tenta de novo depois
+            conn.rollback()
+            logger.warning(f"⚠️ Comandos preparados indisponíveis nesta conexão: {e}")
+
+    @staticmethod
+    def _preparado(cur, nome, params=None):
+        """Executa um comando de PREPARADOS com o seu statement_timeout (SET LOCAL vale até o fim da transação)"""
+        _, execucao, direto = _TEXTOS_PREPARADOS[nome]
+        cur.execute(execucao if cur.connection.preparada else direto, params)
+
+    @contextmanager
+    def _transacao(self, leitura=False):
+        """
+        Cursor numa transação de uma conexão do pool: commit no fim, rollback em erro.
+        leitura=True marca consultas que podem ir para a réplica (dentro de replica()).
+        """
+        pool = self._escolher_pool(leitura)
+        try:
+            conn = pool.obter()
+        except psycopg2.OperationalError as e:
+            if pool is self._pool:
+                raise
+            self._replica_falhou(e)
+            pool = self._pool
+            conn = pool.obter()
+        descartar = False
+        try:
+            if pool is self._pool:
+                self._preparar(conn)
+            cur = conn.cursor()
+            yield cur
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            try:
+                conn.rollback()
+            except psycopg2.Error:
+                descartar = True
+            if pool is self._replica and (descartar or conn.closed):
+                self._replica_falhou(e)
+            raise
+        finally:
+            # Conexão que caiu (ex: banco reiniciado) não volta para o pool
+            pool.devolver(conn, descartar or bool(conn.closed))
+
+    def _consultar(self, sql, params=None, leitura=False):
+        with self._transacao(leitura) as cur:
+            cur.execute(sql, params)
+            return [dict(row) for row in cur.fetchall()]
+
+    def _executar(self, sql, params=None):
+        with self._transacao() as cur:
+            cur.execute(sql, params)
+            return cur.rowcount
+
+    def _pagina(self, tabela, limite, cursor, ordem, desc, filtros=(), params=()):
+        """SELECT keyset: ORDER BY (ordem, id) continuando depois de `cursor`"""
+        _validar_ordem(tabela, ordem, cursor)
+        filtros = list(filtros)
+        params = list(params)
+        chaves = 'id' if ordem == 'id' else f'{ordem}, id'
+        if cursor is not None:
+            filtros.append(f"({chaves}) {'<' if desc else '>'} ({', '.join(['%s'] * len(cursor))})")
+            params.extend(cursor)
+        where = f"WHERE {' AND '.join(filtros)}" if filtros else ''
+        sentido = 'DESC' if desc else 'ASC'
+        ordenacao = ', '.join(f'{c} {sentido}' for c in chaves.split(', '))
+        return self._consultar(f'SELECT * FROM {tabela} {where} ORDER BY {ordenacao} LIMIT %s', (*params, limite),
+                               leitura=True)
+
+    @staticmethod
+    def _padrao_busca(busca):
+        """Padrão ILIKE de 'contém', com os curingas do texto escapados"""
+        return '%' + busca.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+    # --- ESQUEMA ---
+    def inicializar(self, config_padrao):
+        """Inicializa as tabelas do banco de dados"""
+        conn = self.conectar()
+        cur = conn.cursor()
+        # Migrações e índices podem passar do timeout padrão da sessão
+        cur.execute('SET statement_timeout = 0')
+
+        # Tabela de músicas/playlist (Versão Base)
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS playlist (
+                id SERIAL PRIMARY KEY,
+                link_musica TEXT NOT NULL,
+                nome_musica TEXT NOT NULL,
+                plays_desejados INTEGER DEFAULT 0,
+                plays_atuais INTEGER DEFAULT 0,
+                plays_mensais INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'Pendente',
+                duracao_min REAL DEFAULT 3.0,
+                data_adicao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Migração: Adicionar novos campos na tabela playlist
+        new_columns = [
+            ("track_id", "TEXT"),
+            ("playlist_id", "TEXT"),
+            ("plays_hoje", "INTEGER DEFAULT 0"),
+            ("data_ultimo_play", "DATE DEFAULT CURRENT_DATE"),
+            ("proxima_troca", "TIMESTAMP")  # só na fila quente: não vai para o arquivo
+        ]
+
+        for col_name, col_type in new_columns:
+            try:
+                cur.execute(f'ALTER TABLE playlist ADD COLUMN IF NOT EXISTS {col_name} {col_type}')
+            except Exception:
+                # Fallback para versões antigas do Postgres
+                conn.rollback()
+                try:
+                    cur.execute(f'ALTER TABLE playlist ADD COLUMN {col_name} {col_type}')
+                except Exception:
+                    conn.rollback()
+
+        # Nova Tabela: playlists (para gerenciamento)
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS playlists (
+                id SERIAL PRIMARY KEY,
+                url TEXT NOT NULL,
+                nome TEXT,
+                data_adicao TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Nova Tabela: musicas_controle (meta mensal)
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS musicas_controle (
+                id SERIAL PRIMARY KEY,
+                track_id TEXT UNIQUE NOT NULL,
+                nome TEXT,
+                meta_mensal INTEGER DEFAULT 0,
+                plays_diarios INTEGER DEFAULT 0,
+                mes_atual TEXT,
+                plays_mes_atual INTEGER DEFAULT 0
+            )
+        ''')
+
+        # Tabela de configuração
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS config (
+                id SERIAL PRIMARY KEY,
+                chave TEXT UNIQUE NOT NULL,
+                valor TEXT NOT NULL
+            )
+        ''')
+
+        # Versão da config (incrementada a cada escrita, invalida o cache dos workers)
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS config_versao (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                versao BIGINT NOT NULL DEFAULT 0
+            )
+        ''')
+        cur.execute('INSERT INTO config_versao (id, versao) VALUES (1, 0) ON CONFLICT (id) DO NOTHING')
+
+        # Tabela de dispositivos conectados (heartbeat)
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS devices (
+                id SERIAL PRIMARY KEY,
+                device_id TEXT UNIQUE NOT NULL,
+                last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Nova Tabela: plays_diarios (histórico de plays por dia)
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS plays_diarios (
+                id SERIAL PRIMARY KEY,
+                track_id TEXT NOT NULL,
+                data DATE NOT NULL,
+                plays INTEGER DEFAULT 0,
+                UNIQUE(track_id, data)
+            )
+        ''')
+
+        # Nova Tabela: playlist_arquivo (entradas concluídas retiradas da fila quente)
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS playlist_arquivo (
+                arquivo_id SERIAL PRIMARY KEY,
+                id INTEGER NOT NULL,
+                link_musica TEXT NOT NULL,
+                nome_musica TEXT NOT NULL,
+                plays_desejados INTEGER DEFAULT 0,
+                plays_atuais INTEGER DEFAULT 0,
+                plays_mensais INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'Concluído',
+                duracao_min REAL DEFAULT 3.0,
+                data_adicao TIMESTAMP,
+                track_id TEXT,
+                playlist_id TEXT,
+                plays_hoje INTEGER DEFAULT 0,
+                data_ultimo_play DATE,
+                data_arquivamento TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_playlist_arquivo_track ON playlist_arquivo (track_id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_playlist_track ON playlist (track_id)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_devices_last_seen ON devices (last_seen)')
+        cur.execute('CREATE INDEX IF NOT EXISTS idx_playlist_status ON playlist (status, id)')
+
+        # Chaves de idempotência do /api/add_music_smart
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS idempotencia (
+                chave TEXT PRIMARY KEY,
+                resposta TEXT,
+                criado_em TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Checkpoint do motor: o ciclo em andamento (uma linha só; veja registrar_ciclo)
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS motor_checkpoint (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                ciclo BIGINT NOT NULL DEFAULT 0,
+                musica_id INTEGER,
+                track_id TEXT,
+                link_musica TEXT,
+                nome_musica TEXT,
+                duracao_min REAL,
+                inicio TIMESTAMP,
+                fim_previsto TIMESTAMP,
+                plays_aplicados INTEGER
+            )
+        ''')
+        cur.execute('INSERT INTO motor_checkpoint (id) VALUES (1) ON CONFLICT (id) DO NOTHING')
+
+        # Snapshots compartilhados entre os workers (ex: estado do painel).
+        # `balde` é o último reivindicado; `balde_dados`, o do texto gravado;
+        # `versao` muda a cada gravação (os workers conferem só ela).
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS snapshots (
+                nome TEXT PRIMARY KEY,
+                balde BIGINT NOT NULL,
+                balde_dados BIGINT,
+                dados TEXT,
+                versao BIGINT NOT NULL DEFAULT 0
+            )
+        ''')
+        cur.execute('ALTER TABLE snapshots ADD COLUMN IF NOT EXISTS versao BIGINT NOT NULL DEFAULT 0')
+
+        # Uma entrada por (track_id, playlist_id) na fila quente. Na primeira vez
+        # as duplicadas já existentes são fundidas antes de criar o índice.
+        cur.execute("SELECT 1 FROM pg_indexes WHERE indexname = 'uq_playlist_track_playlist'")
+        if not cur.fetchone():
+            conn.commit()
+            resultado = self.compactar_duplicadas()
+            if resultado['removidas']:
+                logger.info(f"🧹 {resultado['removidas']} entradas duplicadas fundidas em {resultado['grupos']} grupos.")
+            cur.execute('''
+                CREATE UNIQUE INDEX IF NOT EXISTS uq_playlist_track_playlist ON playlist (track_id, playlist_id)
+                WHERE track_id IS NOT NULL AND playlist_id IS NOT NULL
+            ''')
+
+        # Inserir configuração padrão se não existir
+        for chave, valor in config_padrao.items():
+            cur.execute('''
+                INSERT INTO config (chave, valor) VALUES (%s, %s)
+                ON CONFLICT (chave) DO NOTHING
+            ''', (chave, str(valor)))
+
+        conn.commit()
+        cur.close()
+        conn.close()
+
+    # --- FILA ---
+    def carregar_playlist(self):
+        """Carrega todas as músicas da fila quente"""
+        return self._consultar('SELECT * FROM playlist ORDER BY id')
+
+    def musica_em_execucao(self):
+        with self._transacao() as cur:
+            self._preparado(cur, 'musica_em_execucao')
+            row = cur.fetchone()
+            return dict(row) if row else None
+
+    def salvar_musica(self, link, nome, plays_desejados, duracao_min):
+        """Adiciona uma nova música"""
+        self._executar('''
+            INSERT INTO playlist (link_musica, nome_musica, plays_desejados, duracao_min, status)
+            VALUES (%s, %s, %s, %s, 'Pendente')
+        ''', (link, nome, plays_desejados, duracao_min))
+
+    def atualizar_musica(self, id, plays_atuais, plays_mensais, status):
+        """Atualiza uma música existente"""
+        with self._transacao() as cur:
+            self._preparado(cur, 'atualizar_musica', (plays_atuais, plays_mensais, status, id))
+
+    def deletar_musica(self, id):
+        """Remove uma música"""
+        self._executar('DELETE FROM playlist WHERE id = %s', (id,))
+
+    def mover_para_topo(self, id):
+        """Move uma música para o topo da fila"""
+        self.mover_para_topo_lote([id])
+
+    def resetar_fila(self):
+        with self._transacao() as cur:
+            cur.execute("UPDATE playlist SET plays_atuais = 0, status = 'Pendente'")
+            # O arquivo inteiro volta para a fila, inclusive as entradas manuais (sem track_id)
+            self._reviver_arquivadas(cur, 'playlist_arquivo a')
+
+    def deletar_musicas(self, ids):
+        return self._executar('DELETE FROM playlist WHERE id = ANY(%s)', (list(ids),))
+
+    def resetar_musicas(self, ids):
+        return self._executar(
+            "UPDATE playlist SET plays_atuais = 0, status = 'Pendente' WHERE id = ANY(%s)", (list(ids),)
+        )
+
+    def alterar_status(self, ids, status):
+        _validar_status(status)
+        return self._executar('UPDATE playlist SET status = %s WHERE id = ANY(%s)', (status, list(ids)))
+
+    def mover_para_topo_lote(self, ids):
+        ids = list(dict.fromkeys(ids))
+        if not ids:
+            return 0
+        with self._transacao() as cur:
+            # Dois pedidos simultâneos calculariam o mesmo mínimo e colidiriam na chave primária
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('playlist_mover_para_topo'))")
+            cur.execute('SELECT MIN(id) as min_id FROM playlist')
+            result = cur.fetchone()
+            min_id = result['min_id'] if result and result['min_id'] else 0
+
+            # Os ids passam a ficar abaixo do mínimo, na ordem recebida
+            # (Isso é uma simplificação, em produção usaríamos uma coluna de ordem)
+            novos = [min_id - len(ids) + i for i in range(len(ids))]
+            cur.execute('''
+                UPDATE playlist p SET id = v.novo
+                FROM unnest(%s::integer[], %s::integer[]) AS v(id, novo)
+                WHERE p.id = v.id
+            ''', (ids, novos))
+            movidas = cur.rowcount
+            # O checkpoint do motor acompanha a música do ciclo em andamento
+            cur.execute('''
+                UPDATE motor_checkpoint c SET musica_id = v.novo
+                FROM unnest(%s::integer[], %s::integer[]) AS v(id, novo)
+                WHERE c.id = 1 AND c.musica_id = v.id
+            ''', (ids, novos))
+            return movidas
+
+    def registrar_plays(self, musica_id, track_id, plays_a_somar, proxima_troca=None):
+        """Soma os plays de um ciclo na fila, no controle mensal e no histórico diário"""
+        with self._transacao() as cur:
+            self._somar_plays(cur, musica_id, track_id, plays_a_somar, proxima_troca)
+
+    def _somar_plays(self, cur, musica_id, track_id, plays_a_somar, proxima_troca):
+        # Atualiza playlist
+        self._preparado(cur, 'somar_plays_fila',
+                        (plays_a_somar, plays_a_somar, plays_a_somar, proxima_troca, musica_id))
+
+        # Atualiza controle (Meta Mensal)
+        if track_id:
+            self._preparado(cur, 'somar_plays_controle', (plays_a_somar, track_id))
+
+            # Registra histórico diário para gráficos
+            self._preparado(cur, 'somar_plays_diarios', (track_id, plays_a_somar, plays_a_somar))
+
+    def arquivar_concluidas(self):
+        """Move as entradas concluídas da fila quente para playlist_arquivo"""
+        # DELETE ... RETURNING é atômico: vários workers podem rodar o job sem duplicar linhas
+        return self._executar(f'''
+            WITH movidas AS (
+                DELETE FROM playlist WHERE status = 'Concluído'
+                RETURNING {COLUNAS_FILA}
+            )
+            INSERT INTO playlist_arquivo ({COLUNAS_FILA})
+            SELECT {COLUNAS_FILA} FROM movidas
+        ''')
+
+    def listar_arquivo(self, limite, antes_de=None, track_id=None):
+        filtros = []
+        params = []
+        if antes_de is not None:
+            filtros.append('arquivo_id < %s')
+            params.append(antes_de)
+        if track_id:
+            filtros.append('track_id = %s')
+            params.append(track_id)
+        where = f"WHERE {' AND '.join(filtros)}" if filtros else ''
+        return self._consultar(f'''
+            SELECT * FROM playlist_arquivo {where}
+            ORDER BY arquivo_id DESC
+            LIMIT %s
+        ''', (*params, limite))
+
+    def listar_fila_pagina(self, limite, cursor=None, desc=False, status=None, track_id=None, busca=None):
+        filtros = []
+        params = []
+        if status:
+            filtros.append('status = ANY(%s)')
+            params.append(list(status))
+        if track_id:
+            filtros.append('track_id = %s')
+            params.append(track_id)
+        if busca:
+            filtros.append('nome_musica ILIKE %s')
+            params.append(self._padrao_busca(busca))
+        return self._pagina('playlist', limite, cursor, 'id', desc, filtros, params)
+
+    def tempos_fila(self, dispositivos, folga_seg):
+        # Agregado no banco: o dashboard não precisa carregar a fila inteira
+        rows = self._consultar('''
+            SELECT
+                COALESCE(SUM(CEIL(GREATEST(plays_desejados - plays_atuais, 0)::numeric / %(d)s)::float8
+                             * (duracao_min * 60 + %(folga)s)), 0) AS restante,
+                COALESCE(SUM(CEIL(GREATEST(plays_desejados, 0)::numeric / %(d)s)::float8
+                             * (duracao_min * 60 + %(folga)s)), 0) AS planejado
+            FROM playlist
+            WHERE status <> 'Concluído'
+        ''', {'d': max(dispositivos, 1), 'folga': folga_seg})
+        return rows[0]['restante'], rows[0]['planejado']
+
+    def executar_reset_diario(self, valores_config):
+        """Executa o reset diário dos plays (e grava valores_config na mesma transação)"""
+        with self._transacao() as cur:
+            # Resetar plays_hoje de todas as músicas (fila e arquivo)
+            cur.execute("UPDATE playlist SET plays_hoje = 0")
+            cur.execute("UPDATE playlist_arquivo SET plays_hoje = 0 WHERE plays_hoje <> 0")
+
+            # Reativar músicas que não atingiram a meta mensal
+            # 1. As que ainda estão na fila quente
+            cur.execute('''
+                UPDATE playlist p
+                SET plays_atuais = 0, status = 'Pendente'
+                FROM musicas_controle c
+                WHERE p.track_id = c.track_id AND c.plays_mes_atual < c.meta_mensal
+            ''')
+            reativadas = cur.rowcount
+
+            # 2. As que já foram arquivadas voltam para a fila em um único comando
+            reativadas += self._reviver_arquivadas(cur, '''
+                playlist_arquivo a USING musicas_controle c
+                WHERE a.track_id = c.track_id AND c.plays_mes_atual < c.meta_mensal
+            ''')
+
+            self._salvar_config(cur, valores_config)
+        return reativadas
+
+    def _reviver_arquivadas(self, cur, origem, params=None, zerar=True):
+        """
+        Move para a fila, num único comando, as linhas de `origem` (o que vem
+        depois do DELETE FROM, com o arquivo como `a`). Com `zerar`, voltam como
+        Pendente e com plays_atuais/plays_hoje zerados. Mantém o id original
+        sempre que ele estiver livre (preserva a ordem); o par (track_id,
+        playlist_id) que já está na fila é fundido a ela como em
+        mesclar_duplicadas, sem perder contadores. Retorna as linhas movidas.
+        """
+        if zerar:
+            atuais, hoje, status = '0', '0', "'Pendente'"
+        else:
+            atuais, hoje = 'n.atuais_par', 'n.hoje_par'
+            status = "CASE WHEN n.atuais_par >= n.desejados_par THEN 'Concluído' ELSE 'Pendente' END"
+        cur.execute(f'''
+            WITH movidas AS (
+                DELETE FROM {origem}
+                RETURNING a.*
+            ), pares AS (
+                -- Entradas arquivadas do mesmo par viram uma só antes de entrar na fila
+                SELECT m.*,
+                    ROW_NUMBER() OVER (par ORDER BY m.arquivo_id) AS ordem_par,
+                    SUM(COALESCE(m.plays_atuais, 0)) OVER par AS atuais_par,
+                    SUM(COALESCE(m.plays_mensais, 0)) OVER par AS mensais_par,
+                    SUM(COALESCE(m.plays_hoje, 0)) OVER par AS hoje_par,
+                    MAX(m.plays_desejados) OVER par AS desejados_par,
+                    MAX(m.data_ultimo_play) OVER par AS ultimo_play_par,
+                    MIN(m.data_adicao) OVER par AS adicao_par
+                FROM movidas m
+                WINDOW par AS (PARTITION BY m.track_id, m.playlist_id,
+                               CASE WHEN m.track_id IS NULL OR m.playlist_id IS NULL THEN m.arquivo_id END)
+            ), numeradas AS (
+                SELECT p.*, ROW_NUMBER() OVER (PARTITION BY p.id ORDER BY p.arquivo_id) AS ordem
+                FROM pares p
+                WHERE p.ordem_par = 1
+            )
+            INSERT INTO playlist ({COLUNAS_FILA})
+            SELECT
+                CASE WHEN n.ordem = 1 AND NOT EXISTS (SELECT 1 FROM playlist p WHERE p.id = n.id)
+                     THEN n.id
+                     ELSE nextval(pg_get_serial_sequence('playlist', 'id'))
+                END,
+                n.link_musica, n.nome_musica, n.desejados_par, {atuais}, n.mensais_par,
+                {status}, n.duracao_min, n.adicao_par, n.track_id, n.playlist_id, {hoje}, n.ultimo_play_par
+            FROM numeradas n
+            ON CONFLICT (track_id, playlist_id) WHERE track_id IS NOT NULL AND playlist_id IS NOT NULL
+            DO UPDATE SET
+                plays_atuais = COALESCE(playlist.plays_atuais, 0) + EXCLUDED.plays_atuais,
+                plays_mensais = COALESCE(playlist.plays_mensais, 0) + EXCLUDED.plays_mensais,
+                plays_hoje = COALESCE(playlist.plays_hoje, 0) + EXCLUDED.plays_hoje,
+                plays_desejados = GREATEST(playlist.plays_desejados, EXCLUDED.plays_desejados),
+                data_ultimo_play = GREATEST(playlist.data_ultimo_play, EXCLUDED.data_ultimo_play),
+                data_adicao = LEAST(playlist.data_adicao, EXCLUDED.data_adicao),
+                status = CASE
+                    WHEN playlist.status = 'Em Execução' THEN playlist.status
+                    WHEN COALESCE(playlist.plays_atuais, 0) + EXCLUDED.plays_atuais
+                         >= GREATEST(playlist.plays_desejados, EXCLUDED.plays_desejados) THEN 'Concluído'
+                    ELSE 'Pendente'
+                END
+        ''', params)
+        return cur.rowcount
+
+    def salvar_validacao(self, resultado):
+        """Salva o resultado da validação no banco"""
+        musica = resultado['musica']
+        plays_diarios = len(resultado['entradas']) * resultado['entradas'][0]['plays_desejados']  # Total diário estimado
+
+        with self._transacao() as cur:
+            # 1. Salva/Atualiza o controle da música (meta mensal)
+            cur.execute('''
+                INSERT INTO musicas_controle (track_id, nome, meta_mensal, plays_diarios, mes_atual)
+                VALUES (%s, %s, %s, %s, TO_CHAR(CURRENT_DATE, 'YYYY-MM'))
+                ON CONFLICT (track_id) DO UPDATE SET
+                    meta_mensal = %s,
+                    plays_diarios = %s,
+                    nome = %s
+            ''', (musica['track_id'], musica['nome'], musica['meta_mensal'], plays_diarios,
+                  musica['meta_mensal'], plays_diarios, musica['nome']))
+
+            # 2. Adiciona (ou atualiza) as entradas na fila de execução
+            for entrada in resultado['entradas']:
+                # Se o par já foi arquivado, a entrada volta para a fila com seus contadores
+                self._reviver_arquivadas(cur, 'playlist_arquivo a WHERE a.track_id = %s AND a.playlist_id = %s',
+                                         (entrada['track_id'], entrada['playlist_id']), zerar=False)
+
+                # Concluída só volta a tocar se o novo alvo do dia for maior que o já tocado
+                cur.execute('''
+                    INSERT INTO playlist (link_musica, nome_musica, plays_desejados, duracao_min, status, track_id, playlist_id)
+                    VALUES (%s, %s, %s, %s, 'Pendente', %s, %s)
+                    ON CONFLICT (track_id, playlist_id) WHERE track_id IS NOT NULL AND playlist_id IS NOT NULL
+                    DO UPDATE SET
+                        link_musica = EXCLUDED.link_musica,
+                        nome_musica = EXCLUDED.nome_musica,
+                        plays_desejados = EXCLUDED.plays_desejados,
+                        duracao_min = EXCLUDED.duracao_min,
+                        status = CASE
+                            WHEN playlist.status = 'Concluído' AND playlist.plays_atuais < EXCLUDED.plays_desejados
+                            THEN 'Pendente' ELSE playlist.status
+                        END
+                ''', (entrada['link_musica'], entrada['nome_musica'], entrada['plays_desejados'],
+                      entrada['duracao_min'], entrada['track_id'], entrada['playlist_id']))
+
+    def compactar_duplicadas(self):
+        with self._transacao() as cur:
+            # Ninguém grava na fila nem no arquivo enquanto as duplicadas são fundidas
+            cur.execute('LOCK TABLE playlist, playlist_arquivo IN SHARE ROW EXCLUSIVE MODE')
+            cur.execute(f'''
+                WITH todas AS (
+                    SELECT 'fila' AS origem, NULL::integer AS arquivo_id, {COLUNAS_FILA} FROM playlist
+                    UNION ALL
+                    SELECT 'arquivo', arquivo_id, {COLUNAS_FILA} FROM playlist_arquivo
+                ), validas AS (
+                    SELECT * FROM todas WHERE track_id IS NOT NULL AND playlist_id IS NOT NULL
+                )
+                SELECT * FROM validas
+                WHERE (track_id, playlist_id) IN (
+                    SELECT track_id, playlist_id FROM validas
+                    GROUP BY track_id, playlist_id HAVING COUNT(*) > 1
+                )
+            ''')
+            grupos = {}
+            for linha in cur.fetchall():
+                grupos.setdefault((linha['track_id'], linha['playlist_id']), []).append(dict(linha))
+
+            removidas = 0
+            for linhas in grupos.values():
+                base, repetidas = mesclar_duplicadas(linhas)
+                tabela, coluna, chave = (
+                    ('playlist', 'id', base['id']) if base['origem'] == 'fila'
+                    else ('playlist_arquivo', 'arquivo_id', base['arquivo_id'])
+                )
+                cur.execute(f'''
+                    UPDATE {tabela} SET plays_atuais = %s, plays_mensais = %s, plays_hoje = %s,
+                        plays_desejados = %s, status = %s, data_ultimo_play = %s, data_adicao = %s
+                    WHERE {coluna} = %s
+                ''', (base['plays_atuais'], base['plays_mensais'], base['plays_hoje'], base['plays_desejados'],
+                      base['status'], base['data_ultimo_play'], base['data_adicao'], chave))
+                for linha in repetidas:
+                    if linha['origem'] == 'fila':
+                        cur.execute('DELETE FROM playlist WHERE id = %s', (linha['id'],))
+                    else:
+                        cur.execute('DELETE FROM playlist_arquivo WHERE arquivo_id = %s', (linha['arquivo_id'],))
+                    removidas += 1
+        return {"grupos": len(grupos), "removidas": removidas}
+
+    # --- MOTOR ---
+    def ler_checkpoint_motor(self):
+        rows = self._consultar('''
+            SELECT ciclo, musica_id, track_id, link_musica, nome_musica, duracao_min,
+                   inicio, fim_previsto, plays_aplicados
+            FROM motor_checkpoint WHERE id = 1 AND ciclo > 0
+        ''')
+        return rows[0] if rows else None
+
+    def registrar_ciclo(self, musica, plays_a_somar, inicio, fim_previsto):
+        with self._transacao() as cur:
+            # Com dois workers disputando, o segundo UPDATE espera o primeiro e reavalia o WHERE
+            cur.execute('''
+                UPDATE motor_checkpoint SET
+                    ciclo = ciclo + 1, musica_id = %s, track_id = %s, link_musica = %s, nome_musica = %s,
+                    duracao_min = %s, inicio = %s, fim_previsto = %s, plays_aplicados = %s
+                WHERE id = 1 AND (fim_previsto IS NULL OR fim_previsto <= %s)
+            ''', (musica['id'], musica.get('track_id'), musica['link_musica'], musica['nome_musica'],
+                  musica['duracao_min'], inicio, fim_previsto, plays_a_somar, inicio))
+            if cur.rowcount == 0:
+                return False
+            self._somar_plays(cur, musica['id'], musica.get('track_id'), plays_a_somar, fim_previsto)
+            return True
+
+    # --- IDEMPOTÊNCIA ---
+    def reservar_idempotencia(self, chave, validade_seg):
+        with self._transacao() as cur:
+            cur.execute(
+                'DELETE FROM idempotencia WHERE criado_em < NOW() - make_interval(secs => %s)', (validade_seg,)
+            )
+            cur.execute('''
+                INSERT INTO idempotencia (chave) VALUES (%s)
+                ON CONFLICT (chave) DO NOTHING
+                RETURNING chave
+            ''', (chave,))
+            if cur.fetchone():
+                return None
+            cur.execute('SELECT resposta FROM idempotencia WHERE chave = %s', (chave,))
+            row = cur.fetchone()
+            return {"resposta": row['resposta'] if row else None}
+
+    def concluir_idempotencia(self, chave, resposta):
+        self._executar('UPDATE idempotencia SET resposta = %s WHERE chave = %s', (resposta, chave))
+
+    def liberar_idempotencia(self, chave):
+        self._executar('DELETE FROM idempotencia WHERE chave = %s', (chave,))
+
+    # --- SNAPSHOTS ---
+    def reivindicar_snapshot(self, nome, balde):
+        # ON CONFLICT ... WHERE: só uma transação consegue avançar o balde
+        return self._executar('''
+            INSERT INTO snapshots (nome, balde) VALUES (%s, %s)
+            ON CONFLICT (nome) DO UPDATE SET balde = EXCLUDED.balde
+            WHERE snapshots.balde < EXCLUDED.balde
+        ''', (nome, balde)) == 1
+
+    def salvar_snapshot(self, nome, balde, dados, substituir=False):
+        return self._executar('''
+            UPDATE snapshots SET dados = %s, balde_dados = %s, versao = versao + 1
+            WHERE nome = %s AND (balde_dados IS NULL OR balde_dados < %s OR (%s AND balde_dados = %s))
+        ''', (dados, balde, nome, balde, substituir, balde)) == 1
+
+    def ler_snapshot(self, nome):
+        rows = self._consultar('SELECT dados FROM snapshots WHERE nome = %s', (nome,))
+        return rows[0]['dados'] if rows else None
+
+    def versao_snapshot(self, nome):
+        rows = self._consultar('SELECT versao FROM snapshots WHERE nome = %s', (nome,))
+        return rows[0]['versao'] if rows else None
+
+    # --- DISPOSITIVOS ---
+    def registrar_heartbeat(self, device_id):
+        """Registra que um dispositivo está ativo"""
+        with self._transacao() as cur:
+            self._preparado(cur, 'heartbeat', (device_id,))
+
+    def registrar_heartbeats(self, device_ids):
+        # Ordenado para que dois workers nunca travem as mesmas linhas em ordens diferentes
+        self._executar('''
+            INSERT INTO devices (device_id, last_seen)
+            SELECT unnest(%s::text[]), CURRENT_TIMESTAMP
+            ON CONFLICT (device_id) DO UPDATE SET last_seen = CURRENT_TIMESTAMP
+        ''', (sorted(set(device_ids)),))
+
+    def contar_dispositivos_ativos(self, timeout_seg):
+        """Conta dispositivos que fizeram heartbeat nos últimos timeout_seg segundos"""
+        with self._transacao() as cur:
+            self._preparado(cur, 'contar_dispositivos', (timeout_seg,))
+            row = cur.fetchone()
+            return row['count'] if row else 0
+
+    # --- CONFIG ---
+    def carregar_config(self):
+        with self._transacao() as cur:
+            cur.execute('SELECT versao FROM config_versao WHERE id = 1')
+            row = cur.fetchone()
+            cur.execute('SELECT chave, valor FROM config')
+            valores = {r['chave']: r['valor'] for r in cur.fetchall()}
+        return (row['versao'] if row else 0), valores
+
+    def ler_versao_config(self):
+        rows = self._consultar('SELECT versao FROM config_versao WHERE id = 1')
+        return rows[0]['versao'] if rows else 0
+
+    def salvar_config(self, valores):
+        with self._transacao() as cur:
+            return self._salvar_config(cur, valores)
+
+    def _salvar_config(self, cur, valores):
+        for chave, valor in valores.items():
+            cur.execute('''
+                INSERT INTO config (chave, valor) VALUES (%s, %s)
+                ON CONFLICT (chave) DO UPDATE SET valor = EXCLUDED.valor
+            ''', (chave, str(valor)))
+        cur.execute('UPDATE config_versao SET versao = versao + 1 WHERE id = 1 RETURNING versao')
+        return cur.fetchone()['versao']
+
+    # --- PLAYLISTS CADASTRADAS ---
+    def listar_playlists(self):
+        """Retorna todas as playlists cadastradas"""
+        return self._consultar('SELECT * FROM playlists ORDER BY id', leitura=True)
+
+    def listar_playlists_pagina(self, limite, cursor=None, desc=False, busca=None):
+        filtros = []
+        params = []
+        if busca:
+            filtros.append('nome ILIKE %s')
+            params.append(self._padrao_busca(busca))
+        return self._pagina('playlists', limite, cursor, 'id', desc, filtros, params)
+
+    def adicionar_playlist(self, url, nome):
+        """Adiciona uma nova playlist"""
+        self._executar('INSERT INTO playlists (url, nome) VALUES (%s, %s)', (url, nome))
+
+    def remover_playlist(self, id):
+        """Remove uma playlist pelo ID"""
+        self._executar('DELETE FROM playlists WHERE id = %s', (id,))
+
+    # --- CONTROLE MENSAL ---
+    def listar_controles(self):
+        return self._consultar('SELECT * FROM musicas_controle ORDER BY id DESC', leitura=True)
+
+    def listar_controles_pagina(self, limite, cursor=None, ordem='id', desc=True, track_id=None, busca=None):
+        filtros = []
+        params = []
+        if track_id:
+            filtros.append('track_id = %s')
+            params.append(track_id)
+        if busca:
+            filtros.append('nome ILIKE %s')
+            params.append(self._padrao_busca(busca))
+        return self._pagina('musicas_controle', limite, cursor, ordem, desc, filtros, params)
+
+    def plays_hoje_por_track(self):
+        # Uma única consulta agrupada em vez de uma por música
+        rows = self._consultar('''
+            SELECT track_id, SUM(plays_hoje) AS hoje FROM (
+                SELECT track_id, plays_hoje FROM playlist WHERE track_id IS NOT NULL
+                UNION ALL
+                SELECT track_id, plays_hoje FROM playlist_arquivo WHERE track_id IS NOT NULL
+            ) t
+            GROUP BY track_id
+        ''', leitura=True)
+        return {row['track_id']: row['hoje'] or 0 for row in rows}
+
+    def remover_controle(self, song_id):
+        self.remover_controles([song_id])
+
+    def remover_controles(self, song_ids):
+        # Um comando só: as músicas, o histórico diário e as entradas na fila e no arquivo
+        rows = self._consultar('''
+            WITH controles AS (
+                DELETE FROM musicas_controle WHERE id = ANY(%s) RETURNING track_id
+            ), diarios AS (
+                DELETE FROM plays_diarios WHERE track_id IN (SELECT track_id FROM controles) RETURNING 1
+            ), fila AS (
+                DELETE FROM playlist WHERE track_id IN (SELECT track_id FROM controles) RETURNING 1
+            ), arquivo AS (
+                DELETE FROM playlist_arquivo WHERE track_id IN (SELECT track_id FROM controles) RETURNING 1
+            )
+            SELECT
+                (SELECT COUNT(*) FROM controles) AS controles,
+                (SELECT COUNT(*) FROM diarios) AS plays_diarios,
+                (SELECT COUNT(*) FROM fila) AS fila,
+                (SELECT COUNT(*) FROM arquivo) AS arquivo
+        ''', (list(song_ids),))
+        return rows[0]
+
+    def remover_todas_musicas(self):
+        with self._transacao() as cur:
+            # TRUNCATE em vez de DELETE: não deixa tuplas mortas para o vacuum
+            cur.execute('LOCK TABLE musicas_controle, plays_diarios, playlist, playlist_arquivo IN ACCESS EXCLUSIVE MODE')
+            cur.execute('''
+                SELECT
+                    (SELECT COUNT(*) FROM musicas_controle) AS controles,
+                    (SELECT COUNT(*) FROM plays_diarios) AS plays_diarios,
+                    (SELECT COUNT(*) FROM playlist) AS fila,
+                    (SELECT COUNT(*) FROM playlist_arquivo) AS arquivo
+            ''')
+            contagens = dict(cur.fetchone())
+            cur.execute('TRUNCATE musicas_controle, plays_diarios, playlist, playlist_arquivo')
+            return contagens
+
+    # --- HISTÓRICO ---
+    def historico_plays(self, track_id, limite=30):
+        return self._consultar('''
+            SELECT data, plays FROM plays_diarios
+            WHERE track_id = %s
+            ORDER BY data DESC
+            LIMIT %s
+        ''', (track_id, limite), leitura=True)
+
+    def historico_plays_lote(self, track_ids, inicio, fim):
+        # Uma consulta para todas as músicas (índice único de (track_id, data))
+        return self._consultar('''
+            SELECT track_id, data, plays FROM plays_diarios
+            WHERE track_id = ANY(%s) AND data BETWEEN %s AND %s
+            ORDER BY track_id, data
+        ''', (list(track_ids), inicio, fim), leitura=True)
+
+    def plays_por_dia(self, desde):
+        return self._consultar(
+            'SELECT track_id, data, plays FROM plays_diarios WHERE data >= %s ORDER BY track_id, data', (desde,), leitura=True
+        )
+
+    def versao_plays(self, desde):
+        # Duas agregações leves em vez de carregar os dados do mês
+        rows = self._consultar('''
+            SELECT
+                (SELECT COALESCE(SUM(plays), 0) FROM plays_diarios WHERE data >= %s) AS plays,
+                (SELECT COUNT(*) FROM plays_diarios WHERE data >= %s) AS dias,
+                (SELECT COALESCE(SUM(meta_mensal), 0) FROM musicas_controle) AS metas,
+                (SELECT COUNT(*) FROM musicas_controle) AS musicas
+        ''', (desde, desde), leitura=True)
+        return tuple(rows[0].values())
+
+    # --- EXPORTAÇÃO ---
+    def exportar(self, conjunto, lote):
+        tabela, ordem, colunas = EXPORTACOES[conjunto]
+        conn = self.conectar(self.dsn_leitura if self._escolher_pool(True) is self._replica else None)
+        try:
+            conn.set_session(readonly=True)
+            # Cursor nomeado (do lado do servidor): só `lote` linhas por vez na memória do worker
+            with conn.cursor(name=f'exportar_{conjunto}') as cur:
+                cur.itersize = lote
+                cur.execute(f"SELECT {', '.join(c for c, _ in colunas)} FROM {tabela} ORDER BY {ordem}")
+                # O gerador fica fora do instrumentar: cada lote buscado é medido (e vira um span 'db')
+                buscar = medir_db(cur.fetchmany, nome='exportar')
+                while True:
+                    linhas = buscar(lote)
+                    if not linhas:
+                        break
+                    yield [dict(linha) for linha in linhas]
+        finally:
+            conn.rollback()
+            conn.close()
+
+    # --- DEBUG ---
+    def resumo_debug(self, timeout_seg):
+        with self._transacao(leitura=True) as cur:
+            # Devices
+            cur.execute('''
+                SELECT COUNT(*) as count FROM devices
+                WHERE last_seen > NOW() - make_interval(secs => %s)
+            ''', (timeout_seg,))
+            dev_count = cur.fetchone()['count']
+
+            # Devices Raw
+            cur.execute("SELECT device_id, last_seen, NOW() as now, NOW() - last_seen as diff FROM devices ORDER BY last_seen DESC LIMIT 5")
+            dev_raw = [dict(row) for row in cur.fetchall()]
+
+            # Playlist Queue
+            cur.execute("SELECT id, nome_musica, status, plays_atuais, plays_desejados FROM playlist WHERE status != 'Concluído' ORDER BY id LIMIT 5")
+            queue = [dict(row) for row in cur.fetchall()]
+
+            # Playlists Table (Collections)
+            cur.execute("SELECT id, nome, url FROM playlists")
+            cols = [dict(row) for row in cur.fetchall()]
+
+            # Count tables
+            cur.execute("SELECT COUNT(*) as count FROM playlist")
+            total_songs = cur.fetchone()['count']
+
+            cur.execute("SELECT COUNT(*) as count FROM playlist WHERE status = 'Em Execução'")
+            executing_songs = cur.fetchone()['count']
+
+            cur.execute("SELECT COUNT(*) as count FROM playlist_arquivo")
+            archived_songs = cur.fetchone()['count']
+
+            cur.execute("SELECT COUNT(*) as count FROM musicas_controle")
+            tracked_songs = cur.fetchone()['count']
+
+        return {
+            "devices_online_count": dev_count,
+            "devices_raw": dev_raw,
+            "queue_pending_top_5": queue,
+            "playlists_collections_count": len(cols),
+            "playlists_collections": cols,
+            "total_songs_in_playlist_table": total_songs,
+            "archived_songs": archived_songs,
+            "executing_songs": executing_songs,
+            "tracked_songs_count": tracked_songs
+        }
+
+
+# --- MEMÓRIA ---
+
+class MemoryStorage(Storage):
+    """
+    Implementação em memória (por processo). `relogio` devolve o datetime
+    atual e pode ser trocado por um relógio virtual em simulações.
+    """
+
+    def __init__(self, relogio=None):
+        self.relogio = relogio or datetime.datetime.now
+        self._lock = threading.RLock()
+        self._fila = {}
+        self._arquivo = []
+        self._playlists = []
+        self._controles = {}
+        self._plays_diarios = {}
+        self._devices = {}
+        self._config = {}
+        self._config_versao = 0
+        self._idempotencia = {}
+        self._snapshots = {}
+        self._checkpoint = None
+        self._seq = {'playlist': 0, 'arquivo': 0, 'playlists': 0, 'controle': 0}
+
+    def _proximo(self, nome):
+        self._seq[nome] += 1
+        return self._seq[nome]
+
+    def _hoje(self):
+        return self.relogio().date()
+
+    @staticmethod
+    def _copiar(linhas):
+        return [dict(linha) for linha in linhas]
+
+    def _pagina(self, tabela, linhas, limite, cursor, ordem, desc):
+        _validar_ordem(tabela, ordem, cursor)
+        linhas = sorted(linhas, key=lambda l: chave_pagina(l, ordem), reverse=desc)
+        if cursor is not None:
+            cursor = tuple(cursor)
+            linhas = [l for l in linhas if (chave_pagina(l, ordem) < cursor if desc else chave_pagina(l, ordem) > cursor)]
+        return self._copiar(linhas[:limite])
+
+    @staticmethod
+    def _contem(texto, busca):
+        return not busca or busca.lower() in (texto or '').lower()
+
+    # --- ESQUEMA ---
+    def inicializar(self, config_padrao):
+        with self._lock:
+            for chave, valor in config_padrao.items():
+                self._config.setdefault(chave, str(valor))
+
+    # --- FILA ---
+    def carregar_playlist(self):
+        with self._lock:
+            return self._copiar(self._fila[id] for id in sorted(self._fila))
+
+    def musica_em_execucao(self):
+        with self._lock:
+            for id in sorted(self._fila):
+                if self._fila[id]['status'] == STATUS_EXECUCAO:
+                    return dict(self._fila[id])
+            return None
+
+    def _inserir_fila(self, **campos):
+        id = campos.pop('id', None)
+        if id is None:
+            id = self._proximo('playlist')
+        linha = {
+            "id": id, "link_musica": None, "nome_musica": None, "plays_desejados": 0,
+            "plays_atuais": 0, "plays_mensais": 0, "status": STATUS_PENDENTE, "duracao_min": 3.0,
+            "data_adicao": self.relogio(), "track_id": None, "playlist_id": None,
+            "plays_hoje": 0, "data_ultimo_play": self._hoje(), "proxima_troca": None
+        }
+        linha.update(campos)
+        self._fila[id] = linha
+        return linha
+
+    def salvar_musica(self, link, nome, plays_desejados, duracao_min):
+        with self._lock:
+            self._inserir_fila(link_musica=link, nome_musica=nome,
+                               plays_desejados=plays_desejados, duracao_min=duracao_min)
+
+    def atualizar_musica(self, id, plays_atuais, plays_mensais, status):
+        with self._lock:
+            linha = self._fila.get(id)
+            if linha:
+                linha.update(plays_atuais=plays_atuais, plays_mensais=plays_mensais, status=status)
+
+    def deletar_musica(self, id):
+        with self._lock:
+            self._fila.pop(id, None)
+
+    def mover_para_topo(self, id):
+        self.mover_para_topo_lote([id])
+
+    def resetar_fila(self):
+        with self._lock:
+            for linha in self._fila.values():
+                linha.update(plays_atuais=0, status=STATUS_PENDENTE)
+            self._reviver_arquivadas(lambda linha: True)
+
+    def deletar_musicas(self, ids):
+        with self._lock:
+            return sum(1 for id in set(ids) if self._fila.pop(id, None) is not None)
+
+    def resetar_musicas(self, ids):
+        return self._atualizar_lote(ids, plays_atuais=0, status=STATUS_PENDENTE)
+
+    def alterar_status(self, ids, status):
+        _validar_status(status)
+        return self._atualizar_lote(ids, status=status)
+
+    def _atualizar_lote(self, ids, **campos):
+        with self._lock:
+            linhas = [self._fila[id] for id in set(ids) if id in self._fila]
+            for linha in linhas:
+                linha.update(campos)
+            return len(linhas)
+
+    def mover_para_topo_lote(self, ids):
+        ids = list(dict.fromkeys(ids))
+        with self._lock:
+            if not ids or not self._fila:
+                return 0
+            min_id = min(self._fila)
+            # Tira todas antes de renumerar: um id novo pode coincidir com um id pedido
+            linhas = [(i, self._fila.pop(id)) for i, id in enumerate(ids) if id in self._fila]
+            for i, linha in linhas:
+                if self._checkpoint and self._checkpoint['musica_id'] == linha['id']:
+                    self._checkpoint['musica_id'] = min_id - len(ids) + i
+                linha['id'] = min_id - len(ids) + i
+                self._fila[linha['id']] = linha
+            return len(linhas)
+
+    def registrar_plays(self, musica_id, track_id, plays_a_somar, proxima_troca=None):
+        with self._lock:
+            hoje = self._hoje()
+            linha = self._fila.get(musica_id)
+            if linha:
+                linha['plays_atuais'] += plays_a_somar
+                linha['plays_mensais'] += plays_a_somar
+                linha['plays_hoje'] += plays_a_somar
+                linha['data_ultimo_play'] = hoje
+                linha['status'] = STATUS_EXECUCAO
+                linha['proxima_troca'] = proxima_troca
+            if track_id:
+                controle = self._controles.get(track_id)
+                if controle:
+                    controle['plays_mes_atual'] += plays_a_somar
+                chave = (track_id, hoje)
+                self._plays_diarios[chave] = self._plays_diarios.get(chave, 0) + plays_a_somar
+
+    def arquivar_concluidas(self):
+        with self._lock:
+            concluidas = [id for id in sorted(self._fila) if self._fila[id]['status'] == STATUS_CONCLUIDO]
+            for id in concluidas:
+                linha = self._fila.pop(id)
+                linha.pop('proxima_troca', None)
+                linha['arquivo_id'] = self._proximo('arquivo')
+                linha['data_arquivamento'] = self.relogio()
+                self._arquivo.append(linha)
+            return len(concluidas)
+
+    def listar_arquivo(self, limite, antes_de=None, track_id=None):
+        with self._lock:
+            linhas = [
+                l for l in reversed(self._arquivo)
+                if (antes_de is None or l['arquivo_id'] < antes_de)
+                and (not track_id or l['track_id'] == track_id)
+            ]
+            return self._copiar(linhas[:limite])
+
+    def listar_fila_pagina(self, limite, cursor=None, desc=False, status=None, track_id=None, busca=None):
+        with self._lock:
+            linhas = [
+                l for l in self._fila.values()
+                if (not status or l['status'] in status)
+                and (not track_id or l['track_id'] == track_id)
+                and self._contem(l['nome_musica'], busca)
+            ]
+            return self._pagina('playlist', linhas, limite, cursor, 'id', desc)
+
+    def tempos_fila(self, dispositivos, folga_seg):
+        dispositivos = max(dispositivos, 1)
+        restante = planejado = 0
+        with self._lock:
+            for l in self._fila.values():
+                if l['status'] == STATUS_CONCLUIDO:
+                    continue
+                ciclo = l['duracao_min'] * 60 + folga_seg
+                restante += math.ceil(max(l['plays_desejados'] - l['plays_atuais'], 0) / dispositivos) * ciclo
+                planejado += math.ceil(max(l['plays_desejados'], 0) / dispositivos) * ciclo
+        return restante, planejado
+
+    def _abaixo_da_meta(self, track_id):
+        controle = self._controles.get(track_id)
+        return bool(controle) and controle['plays_mes_atual'] < controle['meta_mensal']
+
+    def executar_reset_diario(self, valores_config):
+        with self._lock:
+            reativadas = 0
+            for linha in self._fila.values():
+                linha['plays_hoje'] = 0
+                if self._abaixo_da_meta(linha['track_id']):
+                    linha.update(plays_atuais=0, status=STATUS_PENDENTE)
+                    reativadas += 1
+
+            for linha in self._arquivo:
+                linha['plays_hoje'] = 0
+            reativadas += self._reviver_arquivadas(lambda linha: self._abaixo_da_meta(linha['track_id']))
+
+            self.salvar_config(valores_config)
+            return reativadas
+
+    def salvar_validacao(self, resultado):
+        musica = resultado['musica']
+        plays_diarios = len(resultado['entradas']) * resultado['entradas'][0]['plays_desejados']
+        with self._lock:
+            controle = self._controles.get(musica['track_id'])
+            if controle:
+                controle.update(meta_mensal=musica['meta_mensal'], plays_diarios=plays_diarios, nome=musica['nome'])
+            else:
+                self._controles[musica['track_id']] = {
+                    "id": self._proximo('controle'), "track_id": musica['track_id'], "nome": musica['nome'],
+                    "meta_mensal": musica['meta_mensal'], "plays_diarios": plays_diarios,
+                    "mes_atual": self._hoje().strftime('%Y-%m'), "plays_mes_atual": 0
+                }
+            for entrada in resultado['entradas']:
+                track_id, playlist_id = entrada['track_id'], entrada['playlist_id']
+                campos = dict(
+                    link_musica=entrada['link_musica'], nome_musica=entrada['nome_musica'],
+                    plays_desejados=entrada['plays_desejados'], duracao_min=entrada['duracao_min']
+                )
+                # Se o par já foi arquivado, a entrada volta para a fila com seus contadores
+                self._reviver_arquivadas(
+                    lambda linha: linha['track_id'] == track_id and linha['playlist_id'] == playlist_id,
+                    zerar=False
+                )
+                linha = self._na_fila(track_id, playlist_id)
+                if not linha:
+                    self._inserir_fila(track_id=track_id, playlist_id=playlist_id, **campos)
+                    continue
+                if linha['status'] == STATUS_CONCLUIDO and linha['plays_atuais'] < campos['plays_desejados']:
+                    campos['status'] = STATUS_PENDENTE
+                linha.update(campos)
+
+    def _na_fila(self, track_id, playlist_id):
+        if track_id is None or playlist_id is None:
+            return None
+        for linha in self._fila.values():
+            if linha['track_id'] == track_id and linha['playlist_id'] == playlist_id:
+                return linha
+        return None
+
+    def _reviver_arquivadas(self, filtro, zerar=True):
+        """
+        Devolve para a fila as entradas arquivadas em que filtro(linha) é
+        verdadeiro (com `zerar`, como Pendente e sem plays_atuais/plays_hoje).
+        O par que já está na fila é fundido a ela como em mesclar_duplicadas.
+        """
+        restantes, revividas = [], 0
+        for linha in self._arquivo:
+            if not filtro(linha):
+                restantes.append(linha)
+                continue
+            campos = {k: v for k, v in linha.items() if k not in ('arquivo_id', 'data_arquivamento')}
+            if zerar:
+                campos.update(plays_atuais=0, plays_hoje=0, status=STATUS_PENDENTE)
+            existente = self._na_fila(campos['track_id'], campos['playlist_id'])
+            if existente:
+                base, _ = mesclar_duplicadas([dict(existente, origem='fila'), dict(campos, origem='arquivo')])
+                existente.update({k: base[k] for k in (
+                    'plays_atuais', 'plays_mensais', 'plays_hoje', 'plays_desejados',
+                    'status', 'data_ultimo_play', 'data_adicao'
+                )})
+            else:
+                campos['id'] = campos['id'] if campos['id'] not in self._fila else self._proximo('playlist')
+                self._inserir_fila(**campos)
+            revividas += 1
+        self._arquivo = restantes
+        return revividas
+
+    def compactar_duplicadas(self):
+        with self._lock:
+            grupos = {}
+            for linha in self._fila.values():
+                if linha['track_id'] is not None and linha['playlist_id'] is not None:
+                    grupos.setdefault((linha['track_id'], linha['playlist_id']), []).append({**linha, "origem": "fila"})
+            for linha in self._arquivo:
+                if linha['track_id'] is not None and linha['playlist_id'] is not None:
+                    grupos.setdefault((linha['track_id'], linha['playlist_id']), []).append({**linha, "origem": "arquivo"})
+            grupos = {chave: linhas for chave, linhas in grupos.items() if len(linhas) > 1}
+
+            removidas = 0
+            for linhas in grupos.values():
+                base, repetidas = mesclar_duplicadas(linhas)
+                campos = {k: base[k] for k in ('plays_atuais', 'plays_mensais', 'plays_hoje', 'plays_desejados',
+                                               'status', 'data_ultimo_play', 'data_adicao')}
+                if base['origem'] == 'fila':
+                    self._fila[base['id']].update(campos)
+                else:
+                    next(l for l in self._arquivo if l['arquivo_id'] == base['arquivo_id']).update(campos)
+                for linha in repetidas:
+                    if linha['origem'] == 'fila':
+                        del self._fila[linha['id']]
+                    else:
+                        self._arquivo = [l for l in self._arquivo if l['arquivo_id'] != linha['arquivo_id']]
+                    removidas += 1
+            return {"grupos": len(grupos), "removidas": removidas}
+
+    # --- MOTOR ---
+    def ler_checkpoint_motor(self):
+        with self._lock:
+            return dict(self._checkpoint) if self._checkpoint else None
+
+    def registrar_ciclo(self, musica, plays_a_somar, inicio, fim_previsto):
+        with self._lock:
+            if self._checkpoint and self._checkpoint['fim_previsto'] > inicio:
+                return False
+            self._checkpoint = {
+                "ciclo": (self._checkpoint['ciclo'] if self._checkpoint else 0) + 1,
+                "musica_id": musica['id'], "track_id": musica.get('track_id'),
+                "link_musica": musica['link_musica'], "nome_musica": musica['nome_musica'],
+                "duracao_min": musica['duracao_min'], "inicio": inicio, "fim_previsto": fim_previsto,
+                "plays_aplicados": plays_a_somar
+            }
+            self.registrar_plays(musica['id'], musica.get('track_id'), plays_a_somar, fim_previsto)
+            return True
+
+    # --- IDEMPOTÊNCIA ---
+    def reservar_idempotencia(self, chave, validade_seg):
+        with self._lock:
+            limite = self.relogio() - datetime.timedelta(seconds=validade_seg)
+            self._idempotencia = {c: r for c, r in self._idempotencia.items() if r['criado_em'] >= limite}
+            if chave not in self._idempotencia:
+                self._idempotencia[chave] = {"resposta": None, "criado_em": self.relogio()}
+                return None
+            return {"resposta": self._idempotencia[chave]['resposta']}
+
+    def concluir_idempotencia(self, chave, resposta):
+        with self._lock:
+            if chave in self._idempotencia:
+                self._idempotencia[chave]['resposta'] = resposta
+
+    def liberar_idempotencia(self, chave):
+        with self._lock:
+            self._idempotencia.pop(chave, None)
+
+    # --- SNAPSHOTS ---
+    def reivindicar_snapshot(self, nome, balde):
+        with self._lock:
+            snapshot = self._snapshots.setdefault(nome, {"balde": None, "balde_dados": None, "dados": None, "versao": 0})
+            if snapshot['balde'] is not None and snapshot['balde'] >= balde:
+                return False
+            snapshot['balde'] = balde
+            return True
+
+    def salvar_snapshot(self, nome, balde, dados, substituir=False):
+        with self._lock:
+            snapshot = self._snapshots.get(nome)
+            if not snapshot or not (snapshot['balde_dados'] is None or snapshot['balde_dados'] < balde
+                                    or (substituir and snapshot['balde_dados'] == balde)):
+                return False
+            snapshot.update(balde_dados=balde, dados=dados, versao=snapshot['versao'] + 1)
+            return True
+
+    def ler_snapshot(self, nome):
+        with self._lock:
+            return self._snapshots.get(nome, {}).get('dados')
+
+    def versao_snapshot(self, nome):
+        with self._lock:
+            return self._snapshots.get(nome, {}).get('versao')
+
+    # --- DISPOSITIVOS ---
+    def registrar_heartbeat(self, device_id):
+        with self._lock:
+            self._devices[device_id] = self.relogio()
+
+    def registrar_heartbeats(self, device_ids):
+        with self._lock:
+            agora = self.relogio()
+            for device_id in device_ids:
+                self._devices[device_id] = agora
+
+    def contar_dispositivos_ativos(self, timeout_seg):
+        with self._lock:
+            limite = self.relogio() - datetime.timedelta(seconds=timeout_seg)
+            return sum(1 for visto in self._devices.values() if visto > limite)
+
+    # --- CONFIG ---
+    def carregar_config(self):
+        with self._lock:
+            return self._config_versao, dict(self._config)
+
+    def ler_versao_config(self):
+        return self._config_versao
+
+    def salvar_config(self, valores):
+        with self._lock:
+            for chave, valor in valores.items():
+                self._config[chave] = str(valor)
+            self._config_versao += 1
+            return self._config_versao
+
+    # --- PLAYLISTS CADASTRADAS ---
+    def listar_playlists(self):
+        with self._lock:
+            return self._copiar(self._playlists)
+
+    def listar_playlists_pagina(self, limite, cursor=None, desc=False, busca=None):
+        with self._lock:
+            linhas = [p for p in self._playlists if self._contem(p['nome'], busca)]
+            return self._pagina('playlists', linhas, limite, cursor, 'id', desc)
+
+    def adicionar_playlist(self, url, nome):
+        with self._lock:
+            self._playlists.append({
+                "id": self._proximo('playlists'), "url": url, "nome": nome, "data_adicao": self.relogio()
+            })
+
+    def remover_playlist(self, id):
+        with self._lock:
+            self._playlists = [p for p in self._playlists if p['id'] != id]
+
+    # --- CONTROLE MENSAL ---
+    def listar_controles(self):
+        with self._lock:
+            return self._copiar(sorted(self._controles.values(), key=lambda c: c['id'], reverse=True))
+
+    def listar_controles_pagina(self, limite, cursor=None, ordem='id', desc=True, track_id=None, busca=None):
+        with self._lock:
+            linhas = [
+                c for c in self._controles.values()
+                if (not track_id or c['track_id'] == track_id) and self._contem(c['nome'], busca)
+            ]
+            return self._pagina('musicas_controle', linhas, limite, cursor, ordem, desc)
+
+    def plays_hoje_por_track(self):
+        with self._lock:
+            totais = {}
+            for linha in list(self._fila.values()) + self._arquivo:
+                if linha['track_id']:
+                    totais[linha['track_id']] = totais.get(linha['track_id'], 0) + linha['plays_hoje']
+            return totais
+
+    def remover_controle(self, song_id):
+        self.remover_controles([song_id])
+
+    def remover_controles(self, song_ids):
+        with self._lock:
+            song_ids = set(song_ids)
+            track_ids = {t for t, c in self._controles.items() if c['id'] in song_ids}
+            return self._remover_tracks(track_ids)
+
+    def remover_todas_musicas(self):
+        with self._lock:
+            return self._remover_tracks(set(self._controles), tudo=True)
+
+    def _remover_tracks(self, track_ids, tudo=False):
+        manter = (lambda t: False) if tudo else (lambda t: t not in track_ids)
+        antes = (len(self._controles), len(self._plays_diarios), len(self._fila), len(self._arquivo))
+        self._controles = {t: c for t, c in self._controles.items() if manter(t)}
+        self._plays_diarios = {k: v for k, v in self._plays_diarios.items() if manter(k[0])}
+        self._fila = {id: l for id, l in self._fila.items() if manter(l['track_id'])}
+        self._arquivo = [l for l in self._arquivo if manter(l['track_id'])]
+        depois = (len(self._controles), len(self._plays_diarios), len(self._fila), len(self._arquivo))
+        return dict(zip(('controles', 'plays_diarios', 'fila', 'arquivo'), (a - d for a, d in zip(antes, depois))))
+
+    # --- HISTÓRICO ---
+    def historico_plays(self, track_id, limite=30):
+        with self._lock:
+            datas = sorted((d for (t, d) in self._plays_diarios if t == track_id), reverse=True)[:limite]
+            return [{"data": d, "plays": self._plays_diarios[(track_id, d)]} for d in datas]
+
+    def historico_plays_lote(self, track_ids, inicio, fim):
+        track_ids = set(track_ids)
+        with self._lock:
+            return [
+                {"track_id": t, "data": d, "plays": p}
+                for (t, d), p in sorted(self._plays_diarios.items()) if t in track_ids and inicio <= d <= fim
+            ]
+
+    def plays_por_dia(self, desde):
+        with self._lock:
+            return [
+                {"track_id": t, "data": d, "plays": p}
+                for (t, d), p in sorted(self._plays_diarios.items()) if d >= desde
+            ]
+
+    def versao_plays(self, desde):
+        with self._lock:
+            plays = [p for (t, d), p in self._plays_diarios.items() if d >= desde]
+            metas = sum(c['meta_mensal'] or 0 for c in self._controles.values())
+            return (sum(plays), len(plays), metas, len(self._controles))
+
+    # --- EXPORTAÇÃO ---
+    def exportar(self, conjunto, lote):
+        tabela, _, colunas = EXPORTACOES[conjunto]
+        with self._lock:
+            if tabela == 'plays_diarios':
+                linhas = [{"track_id": t, "data": d, "plays": p} for (t, d), p in sorted(self._plays_diarios.items())]
+            elif tabela == 'musicas_controle':
+                linhas = sorted(self._controles.values(), key=lambda c: c['id'])
+            elif tabela == 'playlist':
+                linhas = [self._fila[id] for id in sorted(self._fila)]
+            else:
+                linhas = list(self._arquivo)
+            linhas = [{c: linha.get(c) for c, _ in colunas} for linha in linhas]
+        for inicio in range(0, len(linhas), lote):
+            yield linhas[inicio:inicio + lote]
+
+    # --- DEBUG ---
+    def resumo_debug(self, timeout_seg):
+        with self._lock:
+            agora = self.relogio()
+            recentes = sorted(self._devices.items(), key=lambda d: d[1], reverse=True)[:5]
+            fila = self.carregar_playlist()
+            return {
+                "devices_online_count": self.contar_dispositivos_ativos(timeout_seg),
+                "devices_raw": [
+                    {"device_id": d, "last_seen": visto, "now": agora, "diff": agora - visto}
+                    for d, visto in recentes
+                ],
+                "queue_pending_top_5": [
+                    {k: l[k] for k in ('id', 'nome_musica', 'status', 'plays_atuais', 'plays_desejados')}
+                    for l in fila if l['status'] != STATUS_CONCLUIDO
+                ][:5],
+                "playlists_collections_count": len(self._playlists),
+                "playlists_collections": [
+                    {k: p[k] for k in ('id', 'nome', 'url')} for p in self._playlists
+                ],
+                "total_songs_in_playlist_table": len(fila),
+                "archived_songs": len(self._arquivo),
+                "executing_songs": sum(1 for l in fila if l['status'] == STATUS_EXECUCAO),
+                "tracked_songs_count": len(self._controles)
+            }
+
+
+def criar_storage(backend=None, dsn=None, relogio=None):
+    """Cria o backend escolhido (parâmetro ou STORAGE_BACKEND; padrão: postgres)"""
+    backend = backend or os.environ.get('STORAGE_BACKEND', 'postgres')
+    if backend == 'memory':
+        return MemoryStorage(relogio)
+    if backend == 'postgres':
+        return PostgresStorage(
+            dsn or os.environ.get('DATABASE_URL', 'postgresql://localhost/loop_playlist'),
+            os.environ.get('DATABASE_READ_URL') or None
+        )
+    raise ValueError(f"STORAGE_BACKEND desconhecido: {backend}")
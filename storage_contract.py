@@ -0,0 +1,424 @@
+"""
+Verificação de contrato dos backends de storage.
+
+Roda o mesmo roteiro contra qualquer implementação de storage.Storage e
+confere que ambas se comportam igual. ATENÇÃO: no Postgres as tabelas do
+LooP são esvaziadas; use um banco descartável.
+
+    python storage_contract.py memory
+    DATABASE_URL=postgresql://localhost/loop_teste python storage_contract.py postgres
+"""
+import sys
+import datetime
+import threading
+
+from storage import criar_storage, chave_pagina, EXPORTACOES, STATUS_PENDENTE, STATUS_EXECUCAO, STATUS_CONCLUIDO
+
+CONFIG_PADRAO = {"quantidade_aparelhos": "200", "reset_automatico": "1", "last_reset_date": ""}
+
+
+def resultado_validacao(track_id, meta_mensal=100, plays=10, playlists=('pl1', 'pl2')):
+    """Mesmo formato devolvido por app.validar_musica_playlists"""
+    return {
+        "musica": {"track_id": track_id, "nome": f"Artista - {track_id}", "duracao": 3.0, "meta_mensal": meta_mensal},
+        "entradas": [
+            {
+                "link_musica": f"https://open.spotify.com/track/{track_id}?context=spotify%3Aplaylist%3A{pl}",
+                "nome_musica": f"Artista - {track_id} ({pl})",
+                "plays_desejados": plays,
+                "duracao_min": 3.0,
+                "track_id": track_id,
+                "playlist_id": pl
+            }
+            for pl in playlists
+        ],
+        "playlists_encontradas": list(playlists)
+    }
+
+
+def verificar_fila(s):
+    s.salvar_musica('link-a', 'A', 5, 2.5)
+    s.salvar_musica('link-b', 'B', 3, 3.0)
+    fila = s.carregar_playlist()
+    assert [m['nome_musica'] for m in fila] == ['A', 'B']
+    assert fila[0]['status'] == STATUS_PENDENTE and fila[0]['plays_atuais'] == 0
+
+    assert s.musica_em_execucao() is None
+    a, b = fila
+    s.atualizar_musica(a['id'], 2, 2, STATUS_EXECUCAO)
+    assert s.carregar_playlist()[0]['status'] == STATUS_EXECUCAO
+    atual = s.musica_em_execucao()
+    assert atual['id'] == a['id'] and atual['link_musica'] == 'link-a' and atual['plays_atuais'] == 2
+    assert atual['proxima_troca'] is None
+    prazo = datetime.datetime(2030, 1, 1, 12, 0, 0)
+    s.registrar_plays(a['id'], None, 1, prazo)
+    assert s.musica_em_execucao()['proxima_troca'] == prazo
+
+    s.mover_para_topo(b['id'])
+    assert [m['nome_musica'] for m in s.carregar_playlist()] == ['B', 'A']
+
+    s.resetar_fila()
+    assert all(m['plays_atuais'] == 0 and m['status'] == STATUS_PENDENTE for m in s.carregar_playlist())
+
+    s.deletar_musica(a['id'])
+    assert [m['nome_musica'] for m in s.carregar_playlist()] == ['B']
+
+
+def verificar_lote(s):
+    INEXISTENTE = 10 ** 6
+    for nome in 'ABCD':
+        s.salvar_musica(f'link-{nome.lower()}', nome, 5, 2.5)
+    a, b, c, d = s.carregar_playlist()
+
+    assert s.mover_para_topo_lote([d['id'], c['id'], d['id'], INEXISTENTE]) == 2
+    assert [m['nome_musica'] for m in s.carregar_playlist()] == ['D', 'C', 'A', 'B']
+    ids = {m['nome_musica']: m['id'] for m in s.carregar_playlist()}
+
+    assert s.alterar_status([ids['A'], ids['B']], STATUS_CONCLUIDO) == 2
+    try:
+        s.alterar_status([ids['A']], 'Qualquer')
+        raise AssertionError("status inválido aceito")
+    except ValueError:
+        pass
+    s.atualizar_musica(ids['C'], 3, 3, STATUS_EXECUCAO)
+    assert s.resetar_musicas([ids['A'], ids['C'], INEXISTENTE]) == 2
+    fila = {m['nome_musica']: m for m in s.carregar_playlist()}
+    assert fila['A']['status'] == STATUS_PENDENTE and fila['B']['status'] == STATUS_CONCLUIDO
+    assert fila['C']['plays_atuais'] == 0 and fila['C']['status'] == STATUS_PENDENTE
+
+    assert s.deletar_musicas([ids['A'], ids['D'], INEXISTENTE]) == 2
+    assert [m['nome_musica'] for m in s.carregar_playlist()] == ['C', 'B']
+
+
+def verificar_checkpoint_motor(s):
+    assert s.ler_checkpoint_motor() is None
+    s.salvar_validacao(resultado_validacao('m1', playlists=('pl1',)))
+    musica = s.carregar_playlist()[0]
+    inicio = datetime.datetime(2030, 1, 1, 12, 0, 0)
+    fim = inicio + datetime.timedelta(seconds=190)
+
+    assert s.registrar_ciclo(musica, 7, inicio, fim)
+    checkpoint = s.ler_checkpoint_motor()
+    assert checkpoint['ciclo'] == 1 and checkpoint['musica_id'] == musica['id'] and checkpoint['track_id'] == 'm1'
+    assert checkpoint['fim_previsto'] == fim and checkpoint['plays_aplicados'] == 7
+    assert s.musica_em_execucao()['proxima_troca'] == fim
+
+    # Ciclo em andamento: ninguém soma de novo
+    assert not s.registrar_ciclo(musica, 7, inicio + datetime.timedelta(seconds=60), fim)
+    assert s.carregar_playlist()[0]['plays_atuais'] == 7 and s.ler_checkpoint_motor()['ciclo'] == 1
+
+    assert s.registrar_ciclo(musica, 3, fim, fim + datetime.timedelta(seconds=190))
+    assert s.carregar_playlist()[0]['plays_atuais'] == 10 and s.ler_checkpoint_motor()['ciclo'] == 2
+
+    # Mover a música para o topo leva junto o id gravado no checkpoint
+    s.salvar_musica('link-outra', 'Outra', 5, 1.0)
+    outra = next(m for m in s.carregar_playlist() if m['nome_musica'] == 'Outra')
+    s.mover_para_topo_lote([outra['id'], musica['id']])
+    atual = s.musica_em_execucao()
+    assert s.ler_checkpoint_motor()['musica_id'] == atual['id'] != musica['id']
+
+    # Vários workers disputando o mesmo ciclo ao mesmo tempo: só um soma os plays
+    inicio = fim + datetime.timedelta(seconds=190)
+    barreira = threading.Barrier(4)
+    resultados = []
+
+    def disputar():
+        barreira.wait()
+        resultados.append(s.registrar_ciclo(atual, 5, inicio, inicio + datetime.timedelta(seconds=190)))
+
+    threads = [threading.Thread(target=disputar) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(resultados) == [False, False, False, True]
+    assert s.musica_em_execucao()['plays_atuais'] == 15 and s.ler_checkpoint_motor()['ciclo'] == 3
+
+
+def verificar_validacao_e_plays(s):
+    s.salvar_validacao(resultado_validacao('t1', meta_mensal=100, plays=10))
+    fila = s.carregar_playlist()
+    assert len(fila) == 2 and all(m['track_id'] == 't1' for m in fila)
+    controle = s.listar_controles()[0]
+    assert controle['track_id'] == 't1' and controle['plays_diarios'] == 20 and controle['meta_mensal'] == 100
+
+    s.registrar_plays(fila[0]['id'], 't1', 4)
+    s.registrar_plays(fila[0]['id'], 't1', 3)
+    linha = s.carregar_playlist()[0]
+    assert (linha['plays_atuais'], linha['plays_mensais'], linha['plays_hoje']) == (7, 7, 7)
+    assert linha['status'] == STATUS_EXECUCAO
+    assert s.listar_controles()[0]['plays_mes_atual'] == 7
+    assert s.plays_hoje_por_track() == {'t1': 7}
+
+    historico = s.historico_plays('t1')
+    assert len(historico) == 1 and historico[0]['plays'] == 7
+    assert isinstance(historico[0]['data'], datetime.date)
+
+    hoje = historico[0]['data']
+    assert s.plays_por_dia(hoje) == [{"track_id": 't1', "data": hoje, "plays": 7}]
+    assert s.plays_por_dia(hoje + datetime.timedelta(days=1)) == []
+    assert s.historico_plays_lote(['t1', 'outra'], hoje, hoje) == [{"track_id": 't1', "data": hoje, "plays": 7}]
+    assert s.historico_plays_lote(['t1'], hoje - datetime.timedelta(days=5), hoje - datetime.timedelta(days=1)) == []
+    versao = s.versao_plays(hoje)
+    assert s.versao_plays(hoje) == versao
+    s.registrar_plays(fila[0]['id'], 't1', 1)
+    assert s.versao_plays(hoje) != versao
+
+    # Revalidar atualiza o controle sem duplicar a linha de controle
+    s.salvar_validacao(resultado_validacao('t1', meta_mensal=300, plays=10, playlists=('pl1',)))
+    controles = s.listar_controles()
+    assert len(controles) == 1 and controles[0]['meta_mensal'] == 300
+
+
+def verificar_upsert(s):
+    s.salvar_validacao(resultado_validacao('u1', plays=10))
+    s.salvar_validacao(resultado_validacao('u1', plays=10))
+    fila = s.carregar_playlist()
+    assert [m['playlist_id'] for m in fila] == ['pl1', 'pl2']
+
+    pl1 = fila[0]
+    s.registrar_plays(pl1['id'], 'u1', 10)
+    s.atualizar_musica(pl1['id'], 10, 10, STATUS_CONCLUIDO)
+    assert s.arquivar_concluidas() == 1
+
+    # Mesmo alvo: volta do arquivo com os contadores, mas continua concluída
+    s.salvar_validacao(resultado_validacao('u1', plays=10, playlists=('pl1',)))
+    assert s.listar_arquivo(10) == []
+    linha = next(m for m in s.carregar_playlist() if m['playlist_id'] == 'pl1')
+    assert (linha['id'], linha['status'], linha['plays_atuais']) == (pl1['id'], STATUS_CONCLUIDO, 10)
+
+    # Alvo maior: volta a tocar
+    s.salvar_validacao(resultado_validacao('u1', plays=15, playlists=('pl1',)))
+    linha = next(m for m in s.carregar_playlist() if m['playlist_id'] == 'pl1')
+    assert (linha['status'], linha['plays_atuais'], linha['plays_desejados']) == (STATUS_PENDENTE, 10, 15)
+    assert len(s.carregar_playlist()) == 2
+    assert s.compactar_duplicadas() == {"grupos": 0, "removidas": 0}
+
+
+def verificar_idempotencia(s):
+    assert s.reservar_idempotencia('k1', 3600) is None
+    assert s.reservar_idempotencia('k1', 3600) == {"resposta": None}
+    s.concluir_idempotencia('k1', '{"ok": 1}')
+    assert s.reservar_idempotencia('k1', 3600) == {"resposta": '{"ok": 1}'}
+    s.liberar_idempotencia('k1')
+    assert s.reservar_idempotencia('k1', 3600) is None
+
+
+def verificar_snapshots(s):
+    assert s.ler_snapshot('painel') is None and s.versao_snapshot('painel') is None
+    assert s.reivindicar_snapshot('painel', 10)
+    assert not s.reivindicar_snapshot('painel', 10)
+    assert s.salvar_snapshot('painel', 10, 'dez')
+    assert s.ler_snapshot('painel') == 'dez'
+    versao = s.versao_snapshot('painel')
+
+    # Um worker atrasado não sobrescreve um snapshot mais novo
+    assert s.reivindicar_snapshot('painel', 12)
+    assert s.salvar_snapshot('painel', 12, 'doze')
+    assert not s.reivindicar_snapshot('painel', 11)
+    assert not s.salvar_snapshot('painel', 11, 'onze')
+    assert not s.salvar_snapshot('painel', 11, 'onze', substituir=True)
+    assert s.ler_snapshot('painel') == 'doze'
+
+    # Depois de uma escrita na fila o balde atual é regravado, e a versão muda
+    assert not s.salvar_snapshot('painel', 12, 'doze de novo')
+    assert s.salvar_snapshot('painel', 12, 'doze de novo', substituir=True)
+    assert s.ler_snapshot('painel') == 'doze de novo'
+    assert s.versao_snapshot('painel') == versao + 2
+
+
+def verificar_arquivo_e_reset(s):
+    s.salvar_validacao(resultado_validacao('abaixo', meta_mensal=100, plays=5, playlists=('pl1',)))
+    s.salvar_validacao(resultado_validacao('atingida', meta_mensal=5, plays=5, playlists=('pl1',)))
+    for m in s.carregar_playlist():
+        s.registrar_plays(m['id'], m['track_id'], 5)
+        s.atualizar_musica(m['id'], 5, 5, STATUS_CONCLUIDO)
+
+    assert s.arquivar_concluidas() == 2
+    assert s.carregar_playlist() == []
+    assert s.arquivar_concluidas() == 0
+
+    arquivo = s.listar_arquivo(10)
+    assert len(arquivo) == 2 and arquivo[0]['arquivo_id'] > arquivo[1]['arquivo_id']
+    assert len(s.listar_arquivo(10, antes_de=arquivo[0]['arquivo_id'])) == 1
+    assert [l['track_id'] for l in s.listar_arquivo(10, track_id='abaixo')] == ['abaixo']
+    assert s.plays_hoje_por_track() == {'abaixo': 5, 'atingida': 5}
+
+    id_original = s.listar_arquivo(10, track_id='abaixo')[0]['id']
+    reativadas = s.executar_reset_diario({'last_reset_date': '2030-01-01'})
+    assert reativadas == 1
+    fila = s.carregar_playlist()
+    assert [(m['id'], m['track_id'], m['status'], m['plays_atuais'], m['plays_hoje']) for m in fila] == \
+        [(id_original, 'abaixo', STATUS_PENDENTE, 0, 0)]
+    assert [l['track_id'] for l in s.listar_arquivo(10)] == ['atingida']
+    assert s.plays_hoje_por_track() == {'abaixo': 0, 'atingida': 0}
+    assert s.carregar_config()[1]['last_reset_date'] == '2030-01-01'
+
+    # resetar_fila devolve o arquivo inteiro, inclusive as entradas manuais (sem track_id)
+    s.salvar_musica('link-manual', 'Manual', 2, 1.0)
+    manual = next(m for m in s.carregar_playlist() if m['track_id'] is None)
+    s.atualizar_musica(manual['id'], 2, 2, STATUS_CONCLUIDO)
+    assert s.arquivar_concluidas() == 1
+    s.resetar_fila()
+    assert s.listar_arquivo(10) == []
+    assert sorted((m['track_id'] or '', m['status'], m['plays_atuais']) for m in s.carregar_playlist()) == \
+        [('', STATUS_PENDENTE, 0), ('abaixo', STATUS_PENDENTE, 0), ('atingida', STATUS_PENDENTE, 0)]
+
+
+def verificar_paginacao(s):
+    for n in range(5):
+        s.salvar_musica(f'link-{n}', f'Música {n}%', 4, 1.0)
+    s.salvar_validacao(resultado_validacao('p1', plays=4, playlists=('pl1',)))
+    fila = s.carregar_playlist()
+    s.atualizar_musica(fila[-1]['id'], 4, 4, STATUS_CONCLUIDO)
+
+    # Percorre a fila de 2 em 2 pelo cursor
+    ids = []
+    cursor = None
+    while True:
+        pagina = s.listar_fila_pagina(2, cursor)
+        ids += [m['id'] for m in pagina]
+        if len(pagina) < 2:
+            break
+        cursor = chave_pagina(pagina[-1], 'id')
+    assert ids == [m['id'] for m in fila]
+    assert [m['id'] for m in s.listar_fila_pagina(10, desc=True)] == ids[::-1]
+
+    assert len(s.listar_fila_pagina(10, status=[STATUS_PENDENTE, STATUS_EXECUCAO])) == 5
+    assert [m['track_id'] for m in s.listar_fila_pagina(10, track_id='p1')] == ['p1']
+    assert [m['nome_musica'] for m in s.listar_fila_pagina(10, busca='música 3')] == ['Música 3%']
+    assert len(s.listar_fila_pagina(10, busca='%')) == 5  # curingas são texto literal
+
+    # 5 pendentes (4 plays, 1 min) com 2 dispositivos: 2 ciclos de 70s cada
+    restante, planejado = s.tempos_fila(2, 10)
+    assert (restante, planejado) == (700, 700)
+    s.registrar_plays(fila[1]['id'], None, 3)
+    assert s.tempos_fila(2, 10) == (630, 700)
+    assert s.tempos_fila(0, 10) == (1190, 1400)
+
+    for track_id in ('c', 'a', 'b'):
+        s.salvar_validacao(resultado_validacao(track_id, playlists=('pl1',)))
+    por_track = s.listar_controles_pagina(2, ordem='track_id', desc=False)
+    assert [c['track_id'] for c in por_track] == ['a', 'b']
+    cursor = chave_pagina(por_track[-1], 'track_id')
+    assert [c['track_id'] for c in s.listar_controles_pagina(2, cursor, ordem='track_id', desc=False)] == ['c', 'p1']
+    assert [c['track_id'] for c in s.listar_controles_pagina(10)] == ['b', 'a', 'c', 'p1']
+    assert [c['track_id'] for c in s.listar_controles_pagina(10, busca='ARTISTA - A')] == ['a']
+
+    s.adicionar_playlist('https://open.spotify.com/playlist/x', 'Rock')
+    s.adicionar_playlist('https://open.spotify.com/playlist/y', 'Pop')
+    assert [p['nome'] for p in s.listar_playlists_pagina(1, desc=True)] == ['Pop']
+    assert [p['nome'] for p in s.listar_playlists_pagina(10, busca='roc')] == ['Rock']
+
+
+def verificar_exportacao(s):
+    for n in range(5):
+        s.salvar_validacao(resultado_validacao(f'e{n}', playlists=('pl1',)))
+    fila = s.carregar_playlist()
+    s.registrar_plays(fila[0]['id'], 'e0', 2)
+
+    lotes = list(s.exportar('fila', 2))
+    assert [len(lote) for lote in lotes] == [2, 2, 1]
+    assert [m['id'] for lote in lotes for m in lote] == [m['id'] for m in fila]
+    colunas = [c for c, _ in EXPORTACOES['fila'][2]]
+    assert list(lotes[0][0]) == colunas
+
+    assert [[(l['track_id'], l['plays']) for l in lote] for lote in s.exportar('plays_diarios', 10)] == [[('e0', 2)]]
+    assert sum(len(lote) for lote in s.exportar('musicas_controle', 3)) == 5
+    assert list(s.exportar('arquivo', 10)) == []
+
+
+def verificar_dispositivos(s):
+    assert s.contar_dispositivos_ativos(300) == 0
+    s.registrar_heartbeat('d1')
+    s.registrar_heartbeat('d2')
+    s.registrar_heartbeat('d1')
+    assert s.contar_dispositivos_ativos(300) == 2
+    assert s.resumo_debug(300)['devices_online_count'] == 2
+    s.registrar_heartbeats(['d2', 'd3', 'd4', 'd3'])
+    assert s.contar_dispositivos_ativos(300) == 4
+
+
+def verificar_config(s):
+    versao, valores = s.carregar_config()
+    assert valores == CONFIG_PADRAO
+    nova = s.salvar_config({'quantidade_aparelhos': 50, 'reset_automatico': 0})
+    assert nova == versao + 1 == s.ler_versao_config()
+    assert s.carregar_config()[1]['quantidade_aparelhos'] == '50'
+
+    # inicializar não sobrescreve valores existentes
+    s.inicializar(CONFIG_PADRAO)
+    assert s.carregar_config()[1]['quantidade_aparelhos'] == '50'
+
+
+def verificar_playlists(s):
+    s.adicionar_playlist('https://open.spotify.com/playlist/x', 'X')
+    s.adicionar_playlist('https://open.spotify.com/playlist/y', 'Y')
+    playlists = s.listar_playlists()
+    assert [p['nome'] for p in playlists] == ['X', 'Y']
+    s.remover_playlist(playlists[0]['id'])
+    assert [p['nome'] for p in s.listar_playlists()] == ['Y']
+
+
+def verificar_remocoes(s):
+    s.salvar_validacao(resultado_validacao('r1'))
+    s.salvar_validacao(resultado_validacao('r2'))
+    fila = s.carregar_playlist()
+    s.registrar_plays(fila[0]['id'], 'r1', 1)
+    s.atualizar_musica(fila[0]['id'], 1, 1, STATUS_CONCLUIDO)
+    s.arquivar_concluidas()
+
+    r1 = next(c for c in s.listar_controles() if c['track_id'] == 'r1')
+    s.remover_controle(r1['id'])
+    assert [c['track_id'] for c in s.listar_controles()] == ['r2']
+    assert all(m['track_id'] == 'r2' for m in s.carregar_playlist())
+    assert s.listar_arquivo(10) == [] and s.historico_plays('r1') == []
+
+    s.salvar_validacao(resultado_validacao('r3'))
+    s.salvar_validacao(resultado_validacao('r4'))
+    controles = {c['track_id']: c['id'] for c in s.listar_controles()}
+    removidas = s.remover_controles([controles['r2'], controles['r3'], 10 ** 6])
+    assert dict(removidas) == {"controles": 2, "plays_diarios": 0, "fila": 4, "arquivo": 0}
+    assert [c['track_id'] for c in s.listar_controles()] == ['r4']
+
+    assert dict(s.remover_todas_musicas()) == {"controles": 1, "plays_diarios": 0, "fila": 2, "arquivo": 0}
+    assert s.listar_controles() == [] and s.carregar_playlist() == []
+
+
+VERIFICACOES = [
+    verificar_fila, verificar_lote, verificar_checkpoint_motor, verificar_validacao_e_plays, verificar_upsert, verificar_idempotencia, verificar_snapshots,
+    verificar_arquivo_e_reset, verificar_paginacao, verificar_exportacao, verificar_dispositivos, verificar_config,
+    verificar_playlists, verificar_remocoes
+]
+
+
+def storage_limpo(backend):
+    s = criar_storage(backend)
+    s.inicializar(CONFIG_PADRAO)
+    if backend == 'postgres':
+        with s._transacao() as cur:
+            cur.execute('''
+                TRUNCATE playlist, playlist_arquivo, playlists, musicas_controle,
+                         plays_diarios, devices, config, idempotencia, snapshots, motor_checkpoint RESTART IDENTITY
+            ''')
+            cur.execute('UPDATE config_versao SET versao = 0')
+        s.inicializar(CONFIG_PADRAO)
+    return s
+
+
+def main():
+    backend = sys.argv[1] if len(sys.argv) > 1 else 'memory'
+    falhas = 0
+    for verificacao in VERIFICACOES:
+        try:
+            verificacao(storage_limpo(backend))
+            print(f"✅ {verificacao.__name__}")
+        except Exception as e:
+            falhas += 1
+            print(f"❌ {verificacao.__name__}: {type(e).__name__} {e}")
+    print(f"\n{len(VERIFICACOES) - falhas}/{len(VERIFICACOES)} verificações OK ({backend})")
+    sys.exit(1 if falhas else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""
+Tracing leve por requisição.
+
+Uma requisição amostrada (TRACE_TAXA; TRACE_TAXA_DISPOSITIVOS nas rotas dos
+dispositivos; header X-Trace: 1 força) ganha um Trace no contexto atual.
+Cada função do storage (metrics.medir_db) e cada chamada ao Spotify
+(AgendadorSpotify.chamar) vira um span filho. Sem trace ativo, span() devolve
+um objeto vazio e o custo é uma leitura de ContextVar.
+
+Ao fim da requisição o resumo por categoria vai no header Server-Timing, e
+os traces com pelo menos TRACE_LENTO_MS entram num buffer circular
+(TRACE_BUFFER por processo) exposto em /debug/traces.
+"""
+import os
+import time
+import random
+import datetime
+import threading
+import contextvars
+from collections import deque
+
+TRACE_TAXA = float(os.environ.get('TRACE_TAXA', 0.01))
+TRACE_TAXA_DISPOSITIVOS = float(os.environ.get('TRACE_TAXA_DISPOSITIVOS', 0.01))
+TRACE_LENTO_MS = float(os.environ.get('TRACE_LENTO_MS', 200))
+TRACE_BUFFER = int(os.environ.get('TRACE_BUFFER', 100))
+TRACE_MAX_SPANS = 200  # por trace; o resto só entra nos totais
+
+_atual = contextvars.ContextVar('trace', default=None)
+
+
+class Trace:
+    def __init__(self, nome, request_id=None):
+        self.nome = nome
+        self.request_id = request_id
+        self.inicio = time.time()
+        self._inicio = time.perf_counter()
+        self.duracao_ms = None
+        self.spans = []
+        self.spans_descartados = 0
+        self.totais = {}  # categoria -> [ms, chamadas], só dos spans mais externos da categoria
+        self._pilha = []
+
+    def _agora_ms(self):
+        return (time.perf_counter() - self._inicio) * 1000
+
+    def encerrar(self):
+        if self.duracao_ms is None:
+            self.duracao_ms = self._agora_ms()
+        return self
+
+    def proprio_ms(self):
+        """Tempo fora de qualquer span (Python do próprio app)"""
+        return max(0.0, (self.duracao_ms or self._agora_ms()) - sum(ms for ms, _ in self.totais.values()))
+
+    def como_dict(self):
+        return {
+            "nome": self.nome,
+            "request_id": self.request_id,
+            "inicio": datetime.datetime.fromtimestamp(self.inicio).isoformat(timespec='milliseconds'),
+            "duracao_ms": round(self.duracao_ms or 0, 2),
+            "app_ms": round(self.proprio_ms(), 2),
+            "totais": {c: {"ms": round(ms, 2), "chamadas": n} for c, (ms, n) in self.totais.items()},
+            "spans": self.spans,
+            "spans_descartados": self.spans_descartados
+        }
+
+
+class _Span:
+    __slots__ = ('_trace', '_nome', '_categoria', '_inicio')
+
+    def __init__(self, trace, nome, categoria):
+        self._trace = trace
+        self._nome = nome
+        self._categoria = categoria
+
+    def __enter__(self):
+        self._inicio = self._trace._agora_ms()
+        self._trace._pilha.append(self._categoria)
+        return self
+
+    def __exit__(self, tipo, erro, tb):
+        trace = self._trace
+        duracao = trace._agora_ms() - self._inicio
+        trace._pilha.pop()
+        # Span dentro de outro da mesma categoria (ex: storage chamando storage) não soma de novo
+        if self._categoria not in trace._pilha:
+            total = trace.totais.setdefault(self._categoria, [0.0, 0])
+            total[0] += duracao
+            total[1] += 1
+        if len(trace.spans) < TRACE_MAX_SPANS:
+            span = {
+                "nome": self._nome,
+                "categoria": self._categoria,
+                "inicio_ms": round(self._inicio, 2),
+                "duracao_ms": round(duracao, 2),
+                "nivel": len(trace._pilha)
+            }
+            if tipo is not None:
+                span['erro'] = tipo.__name__
+            trace.spans.append(span)
+        else:
+            trace.spans_descartados += 1
+        return False
+
+
+class _SpanVazio:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, tipo, erro, tb):
+        return False
+
+
+_VAZIO = _SpanVazio()
+
+
+def span(nome, categoria):
+    """Span filho do trace atual (nada acontece se a requisição não está sendo rastreada)"""
+    trace = _atual.get()
+    if trace is None:
+        return _VAZIO
+    return _Span(trace, nome, categoria)
+
+
+def iniciar(nome, request_id=None, taxa=TRACE_TAXA, forcar=False):
+    """Começa um trace no contexto atual se a requisição for amostrada; devolve o token (ou None)"""
+    if not forcar and (taxa <= 0 or random.random() >= taxa):
+        return None
+    return _atual.set(Trace(nome, request_id))
+
+
+def finalizar(token):
+    """Encerra o trace do token, guarda-o se for lento e o devolve"""
+    trace = _atual.get()
+    try:
+        _atual.reset(token)
+    except ValueError:
+        _atual.set(None)
+    if trace is None:
+        return None
+    trace.encerrar()
+    if trace.duracao_ms >= TRACE_LENTO_MS:
+        registro.adicionar(trace)
+    return trace
+
+
+def server_timing(trace):
+    """Valor do header Server-Timing: total por categoria, tempo do app e total"""
+    partes = [
+        f'{categoria};dur={ms:.2f};desc="{n}x"'
+        for categoria, (ms, n) in sorted(trace.totais.items())
+    ]
+    partes.append(f'app;dur={trace.proprio_ms():.2f}')
+    partes.append(f'total;dur={trace.duracao_ms:.2f}')
+    return ', '.join(partes)
+
+
+class RegistroTraces:
+    """Buffer circular (por processo) dos traces lentos mais recentes"""
+
+    def __init__(self, tamanho):
+        self._lock = threading.Lock()
+        self._traces = deque(maxlen=tamanho)
+        self.desde = time.time()
+
+    def adicionar(self, trace):
+        with self._lock:
+            self._traces.append(trace)
+
+    def lentos(self, n=20, min_ms=0.0):
+        """Os n mais lentos do buffer, do mais lento para o mais rápido"""
+        with self._lock:
+            traces = [t for t in self._traces if t.duracao_ms >= min_ms]
+        traces.sort(key=lambda t: t.duracao_ms, reverse=True)
+        return [t.como_dict() for t in traces[:n]]
+
+    def limpar(self):
+        with self._lock:
+            self._traces.clear()
+            self.desde = time.time()
+
+
+registro = RegistroTraces(TRACE_BUFFER)